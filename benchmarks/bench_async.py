@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+#
+# Scaling benchmark for the event-driven client
+#
+# Polls N simulated loggers (hello + several get values transactions each)
+# with a serial loop of blocking calls and with pakbus_async on one thread.
+#
+
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import sys
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python'))
+import pakbus
+import pakbus_async
+import pakbus_sim
+
+NodeId = 0x001
+MyNodeId = 0x802
+
+
+#
+# Serial loop with the blocking API
+#
+def poll_serial(address, stations, count):
+    for i in range(stations):
+        s = pakbus.open_socket(address[0], address[1])
+        pakbus.ping_node(s, NodeId, MyNodeId)
+        for j in range(count):
+            assert pakbus.getvalues(s, NodeId, MyNodeId, 'Public', 'IEEE4B', 'x') == [12.5]
+        pakbus.send(s, pakbus.pkt_bye_cmd(NodeId, MyNodeId))
+        s.close()
+
+
+#
+# All stations concurrently with the event-driven client
+#
+def poll_station(client, count):
+    yield client.connect()
+    yield client.ping_node()
+    for j in range(count):
+        values = yield client.getvalues('Public', 'IEEE4B', 'x')
+        assert values == [12.5]
+    client.close()
+
+def poll_async(address, stations, count):
+    loop = pakbus_async.Loop()
+    tasks = [loop.spawn(poll_station(pakbus_async.Client(loop, address[0], address[1], NodeId, MyNodeId), count)) for i in range(stations)]
+    for result in loop.run_until_complete(loop.gather(tasks)):
+        if isinstance(result, Exception):
+            raise result
+
+
+if __name__ == '__main__':
+    import optparse
+    parser = optparse.OptionParser()
+    parser.add_option('-l', '--latency', type = 'float', default = 0.02, help = 'logger response delay in seconds [default: %default]')
+    parser.add_option('-n', '--count', type = 'int', default = 3, help = 'get values transactions per station [default: %default]')
+    parser.add_option('-s', '--stations', default = '1,10,50,100,200', help = 'comma-separated numbers of stations [default: %default]')
+    (options, args) = parser.parse_args()
+
+    sim = pakbus_sim.Simulator(latency = options.latency)
+    sim.add_node(NodeId, [pakbus_sim.Table('Public', [('x', 'IEEE4B', 1, 12.5)], interval = 1, size = 1)])
+    address = sim.start()
+    print 'latency: %.3f s, transactions per station: %d' % (options.latency, options.count + 1)
+    print '%8s %12s %12s %12s' % ('stations', 'serial [s]', 'async [s]', 'speedup')
+    for stations in [int(n) for n in options.stations.split(',')]:
+        t0 = time.time()
+        poll_serial(address, stations, options.count)
+        t_serial = time.time() - t0
+        t0 = time.time()
+        poll_async(address, stations, options.count)
+        t_async = time.time() - t0
+        print '%8d %12.3f %12.3f %11.1fx' % (stations, t_serial, t_async, t_serial / t_async)
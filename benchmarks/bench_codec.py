@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+
+#
+# Benchmark for decoding CR1000 collect data records
+#
+# Compares parse_collectdata() with compiled codecs against the former
+# field-by-field decoding loop with one struct.unpack() per value.
+#
+
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import sys
+import time
+import random
+import struct
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python'))
+import pakbus
+
+
+# Field list of a typical CR1000 meteo table: (name, type, dimension)
+fields = [
+    ('BattV',       'FP2',    1),
+    ('PTemp_C',     'FP2',    1),
+    ('AirTC',       'IEEE4B', 1),
+    ('RH',          'FP2',    1),
+    ('WS_ms',       'IEEE4B', 1),
+    ('WindDir',     'FP2',    1),
+    ('Rain_mm',     'IEEE4B', 1),
+    ('SlrW',        'IEEE4B', 1),
+    ('T_soil',      'IEEE4B', 4),
+    ('Status',      'UInt4',  1),
+]
+
+
+#
+# Former decode_bin() implementation (for reference)
+#
+def decode_bin_reference(Types, buff, length = 1):
+    offset = 0
+    values = []
+    for Type in Types:
+        fmt = pakbus.datatype[Type]['fmt']
+        size = pakbus.datatype[Type]['size']
+        if Type == 'FP2':
+            fp2 = struct.unpack(fmt, buff[offset:offset+size])
+            mant = fp2[0] & 0x1FFF
+            exp  = fp2[0] >> 13 & 0x3
+            sign = fp2[0] >> 15
+            value = ((-1)**sign * float(mant) / 10**exp, )
+        else:
+            value = struct.unpack(fmt, buff[offset:offset+size])
+        if len(value) == 1:
+            value = value[0]
+        values.append(value)
+        offset += size
+    return values, offset
+
+
+#
+# Former field-by-field record loop of parse_collectdata() (for reference)
+#
+def parse_reference(raw, nrecs):
+    offset = 14 # skip fragment header and time of first record
+    records = []
+    for n in range(nrecs):
+        record = {'Fields': {}}
+        for fieldname, fieldtype, dimension in fields:
+            record['Fields'][fieldname], size = decode_bin_reference(dimension * [fieldtype], raw[offset:])
+            offset += size
+        records.append(record)
+    return records
+
+
+#
+# Generate table definition and collect data responses
+#
+def make_data(nrecs, perpkt):
+    tdf = chr(1) + pakbus.encode_bin(['ASCIIZ', 'UInt4', 'Byte', 'NSec', 'NSec'], ['Meteo', 100000, 0x0e, (0, 0), (60, 0)])
+    for name, ftype, dim in fields:
+        tdf += chr(pakbus.datatype[ftype]['code'])
+        tdf += pakbus.encode_bin(['ASCIIZ', 'ASCIIZ', 'ASCIIZ', 'ASCIIZ', 'ASCIIZ', 'UInt4', 'UInt4', 'UInt4'], [name, '', 'Smp', '', '', 1, dim, 0])
+    tdf += chr(0)
+    tabledef = pakbus.parse_tabledef(tdf)
+
+    random.seed(0)
+    responses = []
+    for beg in range(1, nrecs + 1, perpkt):
+        n = min(perpkt, nrecs + 1 - beg)
+        raw = struct.pack('>HLH2l', 1, beg, n, 600000000 + beg * 60, 0)
+        for i in range(n):
+            for name, ftype, dim in fields:
+                for j in range(dim):
+                    if ftype == 'FP2':
+                        raw += struct.pack('>H', random.randrange(0x6000))
+                    elif ftype == 'IEEE4B':
+                        raw += struct.pack('>f', random.uniform(-50, 50))
+                    else:
+                        raw += struct.pack('>L', random.randrange(1 << 32))
+        responses.append((raw + '\x00', n))
+    return tabledef, responses
+
+
+if __name__ == '__main__':
+    import optparse
+    parser = optparse.OptionParser()
+    parser.add_option('-n', '--records', type = 'int', default = 100000, help = 'number of records [default: %default]')
+    parser.add_option('-p', '--per-packet', type = 'int', default = 20, help = 'records per collect data response [default: %default]')
+    (options, args) = parser.parse_args()
+
+    tabledef, responses = make_data(options.records, options.per_packet)
+    print 'records: %d in %d responses' % (options.records, len(responses))
+
+    t0 = time.time()
+    for raw, n in responses:
+        parse_reference(raw, n)
+    t_old = time.time() - t0
+
+    t0 = time.time()
+    for raw, n in responses:
+        pakbus.parse_collectdata(raw, tabledef)
+    t_new = time.time() - t0
+
+    print '%-28s %10s %12s' % ('decoder', 'time [s]', 'records/s')
+    print '%-28s %10.3f %12.0f' % ('field-by-field (former)', t_old, options.records / t_old)
+    print '%-28s %10.3f %12.0f' % ('compiled codec', t_new, options.records / t_new)
+
+    # Columnar decoding (NumPy is optional)
+    if pakbus.numpy is not None:
+        t0 = time.time()
+        for raw, n in responses:
+            pakbus.parse_collectdata_columns(raw, tabledef)
+        t_col = time.time() - t0
+        print '%-28s %10.3f %12.0f' % ('NumPy columns', t_col, options.records / t_col)
+
+    print 'speedup: %.1fx' % (t_old / t_new)
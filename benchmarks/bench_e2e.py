@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+
+#
+# End-to-end throughput and latency of PakBus transactions
+#
+# Runs N simulated data loggers (pakbus_sim, in a separate process so the
+# simulator does not compete with the client for the interpreter lock) and
+# drives them concurrently through the public API, one thread and connection
+# per station:
+#
+# - getvalues:  latency of single get values transactions (p50/p99)
+# - clock_sync: latency of clock_sync() (10 clock readings each, p50/p99)
+# - upload:     throughput of fileupload() (adaptive swath)
+# - download:   throughput of filedownload() (adaptive swath)
+# - collect:    records per second collected with iter_records() (collect
+#               data transactions following MoreRecsExist)
+#
+# Throughputs are totals over all stations (amount of data divided by the
+# wall time of the phase). The numbers of stations and the simulated links
+# are swept; results can also be written as JSON.
+#
+
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import sys
+import time
+import json
+import random
+import threading
+import multiprocessing
+import bench_rows
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python'))
+import pakbus
+import pakbus_sim
+
+MyNodeId = 0x802
+
+# name, latency [s], bandwidth [bytes/s], byte error rate
+links = [
+    ('lan',         0.001,  None,   0.0),
+    ('cellular',    0.100,  50000,  0.0),
+    ('radio',       0.050,  11520,  0.0),
+    ('lossy radio', 0.050,  11520,  2e-5),
+]
+
+
+#
+# Tables of a simulated station: constant public value and a data table
+#
+def make_tables(records):
+    return [
+        pakbus_sim.Table('Public', [('x', 'IEEE4B', 1, 12.5)], interval = 1, size = 1),
+        pakbus_sim.Table('Data', bench_rows.fields, interval = 60, size = records, live = False),
+    ]
+
+
+#
+# Simulator process: start the stations, send their addresses, serve until told to stop
+#
+def serve(conn, count, link, records, FileData):
+    name, latency, bandwidth, ber = link
+    loggers = pakbus_sim.start_fleet(count, lambda i: make_tables(records), files = {'CPU:bench.dat': FileData}, latency = latency, bandwidth = bandwidth, ber = ber)
+    conn.send(loggers)
+    conn.recv()
+
+
+#
+# Percentile of a list of values (None if empty)
+#
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[int(round(p * (len(values) - 1)))]
+
+
+#
+# Station client: one connection, runs the phases on request
+#
+class Station(object):
+
+    def __init__(self, host, port, NodeId):
+        self.NodeId = NodeId
+        self.s = pakbus.open_socket(host, port, 30)
+        for i in range(3):  # hello may be lost on lossy links
+            if self.s and pakbus.ping_node(self.s, NodeId, MyNodeId):
+                break
+        else:
+            raise StandardError('simulated station %s:%d not reachable' % (host, port))
+        FileData, RespCode = pakbus.fileupload(self.s, NodeId, MyNodeId, '.TDF')
+        if RespCode:
+            raise StandardError('cannot read table definitions of %s:%d' % (host, port))
+        self.tabledef = pakbus.parse_tabledef(FileData)
+
+    def getvalues(self, count, FileData):
+        latencies = []
+        failed = 0
+        for i in range(count):
+            t0 = time.time()
+            if pakbus.getvalues(self.s, self.NodeId, MyNodeId, 'Public', 'IEEE4B', 'x') == [12.5]:
+                latencies.append(time.time() - t0)
+            else:
+                failed += 1
+        return latencies, 0, failed
+
+    def clock_sync(self, count, FileData):
+        latencies = []
+        failed = 0
+        for i in range(count):
+            t0 = time.time()
+            tdiff, adjust = pakbus.clock_sync(self.s, self.NodeId, MyNodeId, max_adjust = 0)
+            if tdiff is None:
+                failed += 1
+            else:
+                latencies.append(time.time() - t0)
+        return latencies, 0, failed
+
+    def upload(self, count, FileData):
+        data, RespCode = pakbus.fileupload(self.s, self.NodeId, MyNodeId, 'CPU:bench.dat')
+        if data != FileData:
+            return [], 0, 1
+        return [], len(data), 0
+
+    def download(self, count, FileData):
+        RespCode = pakbus.filedownload(self.s, self.NodeId, MyNodeId, 'CPU:upload.dat', FileData)
+        if RespCode:
+            return [], 0, 1
+        return [], len(FileData), 0
+
+    def collect(self, count, FileData):
+        records = 0
+        try:
+            for batch in pakbus.iter_records(self.s, self.NodeId, MyNodeId, self.tabledef, 'Data', batch = 1000, compact = True):
+                records += len(batch)
+        except StandardError:
+            return [], records, 1
+        return [], records, 0
+
+    def close(self):
+        pakbus.send(self.s, pakbus.pkt_bye_cmd(self.NodeId, MyNodeId))
+        self.s.close()
+
+
+#
+# Run one phase on all stations concurrently, return (latencies, amount, failed, seconds)
+#
+def run_phase(stations, phase, count, FileData):
+    results = []
+    lock = threading.Lock()
+
+    def worker(station):
+        try:
+            result = getattr(station, phase)(count, FileData)
+        except Exception:
+            result = ([], 0, 1)
+        lock.acquire()
+        results.append(result)
+        lock.release()
+
+    threads = [threading.Thread(target = worker, args = (station, )) for station in stations]
+    t0 = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - t0
+
+    latencies = []
+    amount = failed = 0
+    for l, a, f in results:
+        latencies.extend(l)
+        amount += a
+        failed += f
+    return latencies, amount, failed, elapsed
+
+
+#
+# Measure all phases for one link and number of stations
+#
+def measure(link, count, options, FileData):
+    conn, child = multiprocessing.Pipe()
+    p = multiprocessing.Process(target = serve, args = (child, count, link, options.records, FileData))
+    p.daemon = True
+    p.start()
+    try:
+        stations = [Station(host, port, NodeId) for host, port, NodeId in conn.recv()]
+        result = {'link': link[0], 'stations': count, 'failed': 0}
+        for phase in ('getvalues', 'clock_sync', 'upload', 'download', 'collect'):
+            latencies, amount, failed, elapsed = run_phase(stations, phase, options.count, FileData)
+            result['failed'] += failed
+            if phase in ('getvalues', 'clock_sync'):
+                result[phase] = {'p50': percentile(latencies, 0.5), 'p99': percentile(latencies, 0.99), 'count': len(latencies)}
+            else:
+                result[phase] = {'per_second': amount / elapsed, 'amount': amount, 'seconds': elapsed}
+        for station in stations:
+            station.close()
+    finally:
+        conn.send('stop')
+        p.join(5)
+    return result
+
+
+def ms(value):
+    if value is None:
+        return '-'
+    return '%.1f' % (value * 1e3)
+
+
+if __name__ == '__main__':
+    import optparse
+    parser = optparse.OptionParser()
+    parser.add_option('-s', '--stations', default = '1,10,50', help = 'comma-separated numbers of concurrent stations [default: %default]')
+    parser.add_option('-l', '--links', default = ','.join([link[0] for link in links]), help = 'comma-separated link names [default: %default]')
+    parser.add_option('-n', '--count', type = 'int', default = 20, help = 'get values transactions and clock_sync() calls per station [default: %default]')
+    parser.add_option('-r', '--records', type = 'int', default = 2000, help = 'records collected per station [default: %default]')
+    parser.add_option('-k', '--size', type = 'int', default = 32, help = 'size of uploaded and downloaded files in kilobytes [default: %default]')
+    parser.add_option('-o', '--output', help = 'write results to this JSON file')
+    (options, args) = parser.parse_args()
+
+    rnd = random.Random(1)
+    FileData = ''.join([chr(rnd.randrange(256)) for i in range(options.size * 1024)])
+    selected = [link for name in options.links.split(',') for link in links if link[0] == name.strip()]
+
+    print '%d get values and clock_sync() calls, %d KB files and %d records per station' % (options.count, options.size, options.records)
+    print '%-12s %8s %10s %10s %10s %16s %16s %7s' % ('', '', 'collect', 'upload', 'download', 'getvalues [ms]', 'clock_sync [ms]', '')
+    print '%-12s %8s %10s %10s %10s %8s %7s %8s %7s %7s' % ('link', 'stations', 'rec/s', 'KB/s', 'KB/s', 'p50', 'p99', 'p50', 'p99', 'failed')
+    results = []
+    for link in selected:
+        for count in [int(n) for n in options.stations.split(',')]:
+            r = measure(link, count, options, FileData)
+            results.append(r)
+            print '%-12s %8d %10.0f %10.1f %10.1f %8s %7s %8s %7s %7d' % (r['link'], count, r['collect']['per_second'], r['upload']['per_second'] / 1024, r['download']['per_second'] / 1024,
+                ms(r['getvalues']['p50']), ms(r['getvalues']['p99']), ms(r['clock_sync']['p50']), ms(r['clock_sync']['p99']), r['failed'])
+            sys.stdout.flush()
+
+    if options.output:
+        json.dump({'options': options.__dict__, 'results': results}, open(options.output, 'w'), indent = 1, sort_keys = True)
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+#
+# Benchmark for writing collected records to TOA5 and TOB1 files
+#
+# Writes records parsed from synthetic collect data responses in batches of
+# 1000 records (as yielded by iter_records()) to a temporary directory, for
+# dictionary records and compact rows. Each batch continues the record numbers
+# and times of the previous one (records already written are skipped); only
+# the time spent in the writer is measured.
+#
+
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import sys
+import time
+import shutil
+import struct
+import tempfile
+import bench_rows
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python'))
+import pakbus
+import pakbus_export
+
+
+#
+# Former hand-written export loop (for reference)
+#
+def write_loop(filename, records):
+    f = open(filename, 'a')
+    for record in records:
+        line = [time.strftime('"%Y-%m-%d %H:%M:%S"', time.gmtime(pakbus.nsec_base + record['TimeOfRec'][0])), str(record['RecNbr'])]
+        for name, Type, dim in bench_rows.fields:
+            for value in record['Fields'][name]:
+                line.append(str(value))
+        f.write(','.join(line) + '\r\n')
+    f.close()
+
+
+#
+# Parse the records of response as a batch starting at BegRecNbr
+#
+def make_batch(tabledef, response, BegRecNbr, compact):
+    header = struct.pack('>HLHll', 1, BegRecNbr, 1000, BegRecNbr * 60, 0)
+    RecData, MoreRecsExist = pakbus.parse_collectdata(header + response[len(header):], tabledef, compact = compact)
+    return RecData[0]['RecFrag']
+
+
+if __name__ == '__main__':
+    import optparse
+    parser = optparse.OptionParser()
+    parser.add_option('-n', '--count', type = 'int', default = 500000, help = 'number of records [default: %default]')
+    (options, args) = parser.parse_args()
+
+    tabledef = pakbus.parse_tabledef(bench_rows.make_tabledef())
+    response = bench_rows.make_response(1, 1000)
+
+    directory = tempfile.mkdtemp()
+    try:
+        print '%d records, %d fields (%d values) per record' % (options.count, len(bench_rows.fields), sum([dim for name, Type, dim in bench_rows.fields]))
+        print '%-22s %12s %12s %10s' % ('writer', 'records/s', 'MB/s', 'MB')
+        tests = [('loop (former)', None, False)]
+        for writer in (pakbus_export.TOA5Writer, pakbus_export.TOB1Writer):
+            for compact in (False, True):
+                tests.append(('%s %s' % (writer.format, compact and 'rows' or 'dicts'), writer, compact))
+        for name, writer, compact in tests:
+            filename = os.path.join(directory, name.replace(' ', '_') + '.dat')
+            elapsed = 0.0
+            w = writer and writer(filename, tabledef, 'Meteo')
+            for i in range(0, options.count, 1000):
+                records = make_batch(tabledef, response, 1 + i, compact)
+                t0 = time.time()
+                if writer is None:
+                    write_loop(filename, records)
+                else:
+                    w.write(records)
+                elapsed += time.time() - t0
+            t0 = time.time()
+            if writer is not None:
+                w.close()
+            elapsed += time.time() - t0
+            size = os.path.getsize(filename)
+            print '%-22s %12.0f %12.1f %10.1f' % (name, options.count / elapsed, size / elapsed / 1e6, size / 1e6)
+            os.remove(filename)
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+#
+# Fleet benchmark for the collection scheduler
+#
+# Polls N simulated loggers (hello + several get values transactions each),
+# a few of which are dead (nothing listening), with a serial loop and with
+# pakbus_fleet.Scheduler.
+#
+
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import socket
+import sys
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python'))
+import pakbus
+import pakbus_fleet
+import pakbus_sim
+
+
+#
+# Collection job: hello + get values, bounded by the station deadline
+#
+def poll_station(station, deadline):
+    NodeId, MyNodeId = station['node_id'], station['my_node_id']
+    s = pakbus.open_socket(station['host'], station['port'], min(station['timeout'], deadline - time.time()))
+    if s is None:
+        raise socket.error('cannot connect to %s:%d' % (station['host'], station['port']))
+    try:
+        if not pakbus.ping_node(s, NodeId, MyNodeId):
+            raise socket.timeout('no reply from PakBus node 0x%.3x' % NodeId)
+        for j in range(station['count']):
+            assert pakbus.getvalues(s, NodeId, MyNodeId, 'Public', 'IEEE4B', 'x') == [12.5]
+        pakbus.send(s, pakbus.pkt_bye_cmd(NodeId, MyNodeId))
+    finally:
+        s.close()
+    return {}
+
+
+#
+# Station list; dead stations point at a port with nothing listening on it
+#
+def make_stations(address, dead_address, n, dead, count):
+    stations = []
+    for i in range(n):
+        station = dict(pakbus_fleet.station_defaults)
+        if i < dead:
+            host, port = dead_address
+        else:
+            host, port = address
+        station.update({'name': 'station%03d' % i, 'host': host, 'port': port, 'count': count, 'deadline': 5.0, 'timeout': 1.0})
+        stations.append(station)
+    return stations
+
+
+def poll_serial(stations):
+    failed = 0
+    for station in stations:
+        try:
+            poll_station(station, time.time() + station['deadline'])
+        except Exception:
+            failed += 1
+    return failed
+
+
+def poll_fleet(stations, workers):
+    # all simulated stations share one host address, so lift the per-host cap
+    scheduler = pakbus_fleet.Scheduler(stations, poll_station, workers = workers, per_host = len(stations), jitter = 0)
+    results = scheduler.run_once()
+    return len([r for r in results if r['error']])
+
+
+if __name__ == '__main__':
+    import optparse
+    parser = optparse.OptionParser()
+    parser.add_option('-l', '--latency', type = 'float', default = 0.02, help = 'logger response delay in seconds [default: %default]')
+    parser.add_option('-n', '--count', type = 'int', default = 3, help = 'get values transactions per station [default: %default]')
+    parser.add_option('-s', '--stations', default = '10,50,200', help = 'comma-separated numbers of stations [default: %default]')
+    parser.add_option('-d', '--dead', type = 'int', default = 2, help = 'number of unreachable stations [default: %default]')
+    parser.add_option('-w', '--workers', type = 'int', default = 32, help = 'scheduler worker threads [default: %default]')
+    (options, args) = parser.parse_args()
+
+    sim = pakbus_sim.Simulator(latency = options.latency)
+    sim.add_node(pakbus_fleet.station_defaults['node_id'], [pakbus_sim.Table('Public', [('x', 'IEEE4B', 1, 12.5)], interval = 1, size = 1)])
+    address = sim.start()
+
+    # reserve a port with nothing listening on it
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(('127.0.0.1', 0))
+    dead_address = s.getsockname()
+    s.close()
+
+    print 'latency: %.3f s, transactions per station: %d, dead stations: %d, workers: %d' % (options.latency, options.count + 1, options.dead, options.workers)
+    print '%8s %12s %12s %12s' % ('stations', 'serial [s]', 'fleet [s]', 'speedup')
+    for n in [int(n) for n in options.stations.split(',')]:
+        stations = make_stations(address, dead_address, n, options.dead, options.count)
+        t0 = time.time()
+        failed_serial = poll_serial(stations)
+        t_serial = time.time() - t0
+        t0 = time.time()
+        failed_fleet = poll_fleet(stations, options.workers)
+        t_fleet = time.time() - t0
+        assert failed_serial == failed_fleet == min(n, options.dead)
+        print '%8d %12.3f %12.3f %11.1fx' % (n, t_serial, t_fleet, t_serial / t_fleet)
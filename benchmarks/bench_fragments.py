@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+#
+# Benchmark for collecting records that are larger than one packet
+#
+# A logger thread on a local socket pair sends a record of several kilobytes
+# in fragments (IsOffset set); pakbus.collect_data() requests the remaining
+# byte ranges with CollectMode 0x08 and reassembles the record.
+#
+
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import sys
+import time
+import socket
+import struct
+import threading
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python'))
+import pakbus
+
+NodeId = 0x001
+MyNodeId = 0x802
+
+
+#
+# Table definition with one large array field and a string
+#
+def make_tabledef(values):
+    raw = chr(1) + pakbus.encode_bin(['ASCIIZ', 'UInt4', 'Byte', 'NSec', 'NSec'], ['Profile', 100, 0x0e, (0, 0), (60, 0)])
+    for name, Type, dim in [('Batt', 'IEEE4B', 1), ('Profile', 'IEEE4B', values), ('Status', 'ASCII', 32)]:
+        raw += chr(pakbus.datatype[Type]['code']) + pakbus.encode_bin(['ASCIIZ', 'ASCIIZ', 'ASCIIZ', 'ASCIIZ', 'ASCIIZ', 'UInt4', 'UInt4', 'UInt4'], [name, '', 'Smp', '', '', 1, dim, 0])
+    return raw + chr(0)
+
+
+#
+# Logger thread answering collect data requests with record fragments
+#
+def serve(s, image, RecNbr, frag_size):
+    while True:
+        try:
+            hdr, msg = pakbus.decode_pkt(pakbus.recv(s))
+        except socket.error:
+            return
+        raw = msg['raw']
+        CollectMode = ord(raw[4])
+        if CollectMode == 0x08:
+            P1, P2 = struct.unpack('>LL', raw[9:17])
+        else:
+            P2 = 0
+        data = image[P2:P2 + frag_size]
+        body = struct.pack('>BBBHLL', 0x89, msg['TranNbr'], 0, 1, RecNbr, 0x80000000 | P2) + data + '\x00'
+        pakbus.send(s, pakbus.PakBus_hdr(hdr['SrcNodeId'], hdr['DstNodeId'], 0x1) + body)
+
+
+if __name__ == '__main__':
+    import optparse
+    parser = optparse.OptionParser()
+    parser.add_option('-f', '--fragment', type = 'int', default = 900, help = 'fragment size in bytes [default: %default]')
+    parser.add_option('-n', '--count', type = 'int', default = 50, help = 'records collected per size [default: %default]')
+    parser.add_option('-s', '--sizes', default = '2,8,32,128', help = 'comma-separated record sizes in kilobytes [default: %default]')
+    (options, args) = parser.parse_args()
+
+    print 'fragment size: %d bytes' % options.fragment
+    print '%10s %10s %14s %12s' % ('record', 'fragments', 'ms / record', 'MB / s')
+    for kb in [int(n) for n in options.sizes.split(',')]:
+        values = (kb * 1024 - 8 - 4 - 32) // 4
+        tabledef = pakbus.parse_tabledef(make_tabledef(values))
+        image = struct.pack('>2lf', 1000, 0, 12.5) + struct.pack('>%df' % values, *range(values)) + 'OK'.ljust(32, '\0')
+
+        a, b = socket.socketpair()
+        t = threading.Thread(target = serve, args = (b, image, 42, options.fragment))
+        t.setDaemon(True)
+        t.start()
+
+        t0 = time.time()
+        for i in range(options.count):
+            RecData, MoreRecsExist = pakbus.collect_data(a, NodeId, MyNodeId, tabledef, 'Profile')
+            record = RecData[0]['RecFrag'][0]
+        elapsed = (time.time() - t0) / options.count
+        assert record['RecNbr'] == 42 and record['Fields']['Profile'][-1] == values - 1 and record['Fields']['Status'] == ['OK'.ljust(32, '\0')]
+        a.close()
+        print '%8d K %10d %14.2f %12.2f' % (kb, (len(image) + options.fragment - 1) // options.fragment, elapsed * 1000, len(image) / elapsed / 1e6)
+
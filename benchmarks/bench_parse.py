@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+#
+# Benchmark for parsing large table definitions, directories and collect
+# data responses
+#
+# Synthetic inputs with a growing number of fields/files/records are parsed;
+# the time per item should stay constant if parsing is linear in the input
+# size (i.e. no parser copies the remaining buffer for every field).
+#
+
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import sys
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python'))
+import pakbus
+
+
+#
+# Table definition with one table of n fields
+#
+def make_tabledef(n):
+    raw = [chr(1), pakbus.encode_bin(['ASCIIZ', 'UInt4', 'Byte', 'NSec', 'NSec'], ['Big', 1000, 0x0e, (0, 0), (60, 0)])]
+    for i in range(n):
+        raw.append(chr(pakbus.datatype['IEEE4B']['code']) + pakbus.encode_bin(['ASCIIZ', 'ASCIIZ', 'ASCIIZ', 'ASCIIZ', 'ASCIIZ', 'UInt4', 'UInt4', 'UInt4'], ['Field%d' % i, '', 'Smp', 'W/m^2', '', 1, 1, 0]))
+    raw.append(chr(0))
+    return ''.join(raw)
+
+
+#
+# Directory listing with n files
+#
+def make_filedir(n):
+    raw = [chr(1)]
+    for i in range(n):
+        raw.append(pakbus.encode_bin(['ASCIIZ', 'UInt4', 'ASCIIZ', 'Byte', 'Byte'], ['CRD:file%05d.dat' % i, 1024 * i, '2013-01-01 00:00:00', 0x02, 0]))
+    raw.append(chr(0))
+    return ''.join(raw)
+
+
+#
+# Collect data response with n single-record fragments of a small table
+#
+def make_collectdata(n):
+    raw = []
+    for i in range(n):
+        raw.append(pakbus.encode_bin(['UInt2', 'UInt4', 'UInt2', 'NSec', 'IEEE4B', 'IEEE4B', ('ASCII', 16)], [1, i, 1, (i * 60, 0), 12.5, i, 'OK'.ljust(16, '\0')]))
+    raw.append(chr(0))
+    return ''.join(raw)
+
+
+def timeit(func, *args):
+    count = 0
+    t0 = time.time()
+    while True:
+        result = func(*args)
+        count += 1
+        elapsed = time.time() - t0
+        if elapsed > 0.5:
+            return elapsed / count, result
+
+
+if __name__ == '__main__':
+    import optparse
+    parser = optparse.OptionParser()
+    parser.add_option('-s', '--sizes', default = '1000,2000,4000,8000,16000', help = 'comma-separated numbers of fields/files/records [default: %default]')
+    (options, args) = parser.parse_args()
+
+    small = pakbus.encode_bin(['ASCIIZ', 'UInt4', 'Byte', 'NSec', 'NSec'], ['Small', 1000, 0x0e, (0, 0), (60, 0)])
+    small = chr(1) + small
+    for Type in ('IEEE4B', 'IEEE4B'):
+        small += chr(pakbus.datatype[Type]['code']) + pakbus.encode_bin(['ASCIIZ', 'ASCIIZ', 'ASCIIZ', 'ASCIIZ', 'ASCIIZ', 'UInt4', 'UInt4', 'UInt4'], ['Value', '', 'Smp', '', '', 1, 1, 0])
+    small += chr(pakbus.datatype['ASCII']['code']) + pakbus.encode_bin(['ASCIIZ', 'ASCIIZ', 'ASCIIZ', 'ASCIIZ', 'ASCIIZ', 'UInt4', 'UInt4', 'UInt4'], ['Status', '', 'Smp', '', '', 1, 16, 0]) + chr(0)
+    tabledef = pakbus.parse_tabledef(small)
+
+    print '%8s %10s %16s %16s %16s' % ('items', 'KB (TDF)', 'tabledef us/fld', 'filedir us/file', 'collect us/rec')
+    for n in [int(n) for n in options.sizes.split(',')]:
+        tdf = make_tabledef(n)
+        t_tdf, result = timeit(pakbus.parse_tabledef, tdf)
+        assert len(result[0]['Fields']) == n
+        t_dir, result = timeit(pakbus.parse_filedir, make_filedir(n))
+        assert len(result['files']) == n
+        t_col, result = timeit(pakbus.parse_collectdata, make_collectdata(n), tabledef)
+        assert len(result[0]) == n
+        print '%8d %10d %16.2f %16.2f %16.2f' % (n, len(tdf) // 1024, t_tdf / n * 1e6, t_dir / n * 1e6, t_col / n * 1e6)
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+#
+# Benchmark for receiving PakBus packets over a local socket pair
+#
+# Compares the buffered frame reader used by pakbus.recv() with the former
+# byte-at-a-time implementation: number of recv() system calls and run time.
+#
+
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import sys
+import time
+import socket
+import threading
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python'))
+import pakbus
+
+
+#
+# Socket wrapper counting recv() calls
+#
+class CountingSocket(object):
+
+    def __init__(self, s):
+        self.s = s
+        self.calls = 0
+
+    def recv(self, bufsize):
+        self.calls += 1
+        return self.s.recv(bufsize)
+
+
+#
+# Former byte-at-a-time implementation of pakbus.recv() (for reference)
+#
+def recv_bytewise(s):
+    pkt = ''
+    byte = None
+    while byte != '\xBD': byte = s.recv(1)
+    while byte == '\xBD': byte = s.recv(1)
+    while byte != '\xBD':
+        pkt += byte
+        byte = s.recv(1)
+    pkt = pakbus.unquote(pkt)
+    if pakbus.calcSigFor(pkt):
+        return None
+    else:
+        return pkt[:-2]
+
+
+#
+# Generate a ~1 KB file upload response packet
+#
+def make_packet(size):
+    data = ''.join([chr(i & 0xFF) for i in range(size)])  # contains \xBC and \xBD
+    hdr = pakbus.PakBus_hdr(0x802, 0x001, 0x1)
+    msg = pakbus.encode_bin(['Byte', 'Byte', 'Byte', 'UInt4', 'ASCII'], [0x9d, 0x01, 0x00, 0, data])
+    return hdr + msg
+
+
+#
+# Run one benchmark: send count packets through a socket pair and receive them
+#
+def run(reader, pkt, count):
+    a, b = socket.socketpair()
+    def writer():
+        for i in range(count):
+            pakbus.send(a, pkt)
+    t = threading.Thread(target = writer)
+    t.start()
+
+    s = CountingSocket(b)
+    t0 = time.time()
+    for i in range(count):
+        rcv = reader(s)
+        assert rcv == pkt
+    elapsed = time.time() - t0
+
+    t.join()
+    a.close()
+    b.close()
+    return s.calls, elapsed
+
+
+if __name__ == '__main__':
+    import optparse
+    parser = optparse.OptionParser()
+    parser.add_option('-n', '--count', type = 'int', default = 2000, help = 'number of packets [default: %default]')
+    parser.add_option('-s', '--size', type = 'int', default = 1024, help = 'payload size in bytes [default: %default]')
+    (options, args) = parser.parse_args()
+
+    pkt = make_packet(options.size)
+    print 'packets: %d, payload: %d bytes' % (options.count, options.size)
+
+    results = []
+    calls, elapsed = run(recv_bytewise, pkt, options.count)
+    results.append(('byte-at-a-time', calls, elapsed))
+    calls, elapsed = run(pakbus.recv, pkt, options.count)
+    results.append(('buffered framer', calls, elapsed))
+
+    print '%-16s %12s %10s %12s' % ('reader', 'recv() calls', 'time [s]', 'packets/s')
+    for name, calls, elapsed in results:
+        print '%-16s %12d %10.3f %12.0f' % (name, calls, elapsed, options.count / elapsed)
+    print 'speedup: %.1fx, syscall reduction: %.0fx' % (results[0][2] / results[1][2], float(results[0][1]) / results[1][1])
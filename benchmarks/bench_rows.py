@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+
+#
+# Benchmark for the memory used by collected records
+#
+# Parses a synthetic collect data response many times and keeps all records,
+# either as dictionaries (default) or as compact tuple rows (compact = True).
+# Each representation is measured in a separate process; the memory is the
+# growth of the resident set size (Linux /proc) while the records are held.
+#
+
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import sys
+import gc
+import time
+import random
+import struct
+import subprocess
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python'))
+import pakbus
+
+# Typical meteorological table: 10 scalar fields and a 4-value array
+fields = [('Batt', 'IEEE4B', 1), ('PTemp', 'IEEE4B', 1), ('AirTC', 'IEEE4B', 1), ('RH', 'IEEE4B', 1), ('WS', 'IEEE4B', 1),
+          ('WD', 'IEEE4B', 1), ('Rain', 'IEEE4B', 1), ('SlrW', 'IEEE4B', 1), ('BP', 'IEEE4B', 1), ('Status', 'UInt4', 1),
+          ('Soil', 'FP2', 4)]
+
+
+def make_tabledef():
+    raw = chr(1) + pakbus.encode_bin(['ASCIIZ', 'UInt4', 'Byte', 'NSec', 'NSec'], ['Meteo', 100000, 0x0e, (0, 0), (60, 0)])
+    for name, Type, dim in fields:
+        raw += chr(pakbus.datatype[Type]['code']) + pakbus.encode_bin(['ASCIIZ', 'ASCIIZ', 'ASCIIZ', 'ASCIIZ', 'ASCIIZ', 'UInt4', 'UInt4', 'UInt4'], [name, '', 'Smp', '', '', 1, dim, 0])
+    return raw + chr(0)
+
+
+#
+# Collect data response with n records starting at BegRecNbr
+#
+def make_response(BegRecNbr, n):
+    Types = []
+    for name, Type, dim in fields:
+        Types.extend(dim * [Type])
+    codec = pakbus.get_codec(Types)
+    raw = [struct.pack('>HLHll', 1, BegRecNbr, n, BegRecNbr * 60, 0)]
+    for i in range(n):
+        raw.append(codec.encode([random.uniform(0, 100) for j in range(9)] + [i] + [random.randrange(100) / 10.0 for j in range(4)]))
+    return ''.join(raw) + chr(0)
+
+
+#
+# Resident set size in bytes
+#
+def rss():
+    return int(open('/proc/self/statm').read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+#
+# Parse count records (in responses of 1000 records) and measure memory
+#
+def measure(count, compact):
+    tabledef = pakbus.parse_tabledef(make_tabledef())
+    response = make_response(1, 1000)
+    gc.collect()
+    before = rss()
+    t0 = time.time()
+    records = []
+    for i in range(0, count, 1000):
+        RecData, MoreRecsExist = pakbus.parse_collectdata(response, tabledef, compact = compact)
+        records.extend(RecData[0]['RecFrag'])
+    elapsed = time.time() - t0
+    gc.collect()
+    used = rss() - before
+    assert len(records) >= count and len(records[-1]['Fields']['Soil']) == 4
+    return used, elapsed
+
+
+if __name__ == '__main__':
+    import optparse
+    parser = optparse.OptionParser()
+    parser.add_option('-n', '--count', type = 'int', default = 1000000, help = 'number of records [default: %default]')
+    parser.add_option('--measure', choices = ['dict', 'compact'], help = 'measure one representation (used internally)')
+    (options, args) = parser.parse_args()
+
+    if options.measure:
+        used, elapsed = measure(options.count, options.measure == 'compact')
+        print used, elapsed
+        sys.exit()
+
+    print '%d records, %d fields (%d values) per record' % (options.count, len(fields), sum([dim for name, Type, dim in fields]))
+    print '%-10s %12s %14s %14s' % ('records', 'MB', 'bytes/record', 'us/record')
+    results = {}
+    for mode in ('dict', 'compact'):
+        out = subprocess.Popen([sys.executable, os.path.abspath(__file__), '-n', str(options.count), '--measure', mode], stdout = subprocess.PIPE).communicate()[0]
+        used, elapsed = out.split()
+        results[mode] = int(used)
+        print '%-10s %12.1f %14.1f %14.2f' % (mode, int(used) / 1e6, int(used) / float(options.count), float(elapsed) / options.count * 1e6)
+    print 'memory reduction: %.1fx' % (float(results['dict']) / results['compact'])
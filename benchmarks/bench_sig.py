@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+
+#
+# Micro-benchmark for the PakBus signature algorithm
+#
+# Compares the table-driven pakbus.calcSigFor() with the former bitwise
+# implementation on 1 KB and 64 KB buffers and checks that both agree. The
+# exit status is 1 if the speedup is below the threshold.
+#
+# The target is a 5x speedup and the default threshold stays at 5x. Under
+# CPython 2.7 the table-driven loop (one table lookup and one addition per
+# byte) reaches 4.0x to 5.5x at 1 KB and 4.7x to 6.8x at 64 KB, depending on
+# the machine and run, so both sizes miss the target on some runs and the
+# benchmark then reports the miss and fails. A list instead of the array for
+# the table and unrolling 16 bytes per iteration were no faster.
+#
+
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import sys
+import random
+import timeit
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python'))
+import pakbus
+
+
+#
+# Former bitwise implementation of pakbus.calcSigFor() (for reference)
+#
+def calcSigFor_bitwise(buff, seed = 0xAAAA):
+    sig = seed
+    for x in buff:
+        x = ord(x)
+        j = sig
+        sig = (sig <<1) & 0x1FF
+        if sig >= 0x100: sig += 1
+        sig = ((((sig + (j >>8) + x) & 0xFF) | (j <<8))) & 0xFFFF
+    return sig
+
+
+#
+# Best time per call in seconds
+#
+def best(func, buff, repeat, number):
+    return min(timeit.repeat(lambda: func(buff), repeat = repeat, number = number)) / number
+
+
+if __name__ == '__main__':
+    import optparse
+    parser = optparse.OptionParser()
+    parser.add_option('--threshold', type = 'float', default = 5.0, help = 'minimum speedup [default: %default]')
+    (options, args) = parser.parse_args()
+
+    random.seed(0)
+    slow = 0
+    print '%-8s %14s %14s %8s' % ('size', 'bitwise [ms]', 'table [ms]', 'speedup')
+    for size, number in [(1024, 200), (65536, 5)]:
+        buff = ''.join([chr(random.randrange(256)) for i in range(size)])
+        assert calcSigFor_bitwise(buff) == pakbus.calcSigFor(buff)
+        t_old = best(calcSigFor_bitwise, buff, 5, number)
+        t_new = best(pakbus.calcSigFor, buff, 5, number)
+        print '%-8d %14.3f %14.3f %7.1fx' % (size, t_old * 1e3, t_new * 1e3, t_old / t_new)
+        if t_old / t_new < options.threshold:
+            slow += 1
+    if slow:
+        print '%d sizes below the target speedup of %.1fx' % (slow, options.threshold)
+        sys.exit(1)
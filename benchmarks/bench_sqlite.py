@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+#
+# Benchmark for storing collected records in SQLite
+#
+# Stores records parsed from a synthetic collect data response in batches of
+# 1000 records (as passed to the sink of IncrementalCollector) in a temporary
+# database, with the former one INSERT and commit per record and with
+# pakbus_export.SQLiteSink for dictionary records and compact rows. The batches
+# are stored twice (the second time replacing the rows, as after an
+# overlapping collection).
+#
+
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import sys
+import time
+import shutil
+import sqlite3
+import tempfile
+import bench_rows
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python'))
+import pakbus
+import pakbus_export
+
+
+#
+# Former sink: one INSERT and commit per record (for reference)
+#
+def make_loop_sink(filename):
+    db = sqlite3.connect(filename)
+    columns = ['RecNbr', 'Seconds', 'Nanoseconds']
+    for name, Type, dim in bench_rows.fields:
+        columns.extend(['%s_%d' % (name, i) for i in range(dim)])
+    db.execute('CREATE TABLE Meteo (%s)' % ', '.join(columns))
+    statement = 'INSERT INTO Meteo VALUES (%s)' % ', '.join(len(columns) * ['?'])
+
+    def sink(logger, TableName, records):
+        for record in records:
+            row = [record['RecNbr'], record['TimeOfRec'][0], record['TimeOfRec'][1]]
+            for name, Type, dim in bench_rows.fields:
+                row.extend(record['Fields'][name])
+            db.execute(statement, row)
+            db.commit()
+    return sink
+
+
+if __name__ == '__main__':
+    import optparse
+    parser = optparse.OptionParser()
+    parser.add_option('-n', '--count', type = 'int', default = 200000, help = 'number of records [default: %default]')
+    parser.add_option('-l', '--loop-count', type = 'int', default = 5000, help = 'number of records for the former loop [default: %default]')
+    (options, args) = parser.parse_args()
+
+    tabledef = pakbus.parse_tabledef(bench_rows.make_tabledef())
+    batches = {}
+    for compact in (False, True):
+        batches[compact] = []
+        for RecNbr in range(0, options.count, 1000):
+            RecData, MoreRecsExist = pakbus.parse_collectdata(bench_rows.make_response(RecNbr, 1000), tabledef, compact = compact)
+            batches[compact].append(RecData[0]['RecFrag'])
+
+    directory = tempfile.mkdtemp()
+    try:
+        print '%d records, %d fields (%d values) per record' % (options.count, len(bench_rows.fields), sum([dim for name, Type, dim in bench_rows.fields]))
+        print '%-22s %10s %12s %12s' % ('sink', 'records', 'records/s', 'replace/s')
+        for name, compact in (('loop (former)', False), ('SQLiteSink dicts', False), ('SQLiteSink rows', True)):
+            filename = os.path.join(directory, name.replace(' ', '_') + '.db')
+            if name.startswith('loop'):
+                sink = make_loop_sink(filename)
+                count = min(options.loop_count, options.count)
+            else:
+                sink = pakbus_export.SQLiteSink(filename, tabledef)
+                count = options.count
+            rates = []
+            for repeat in range(name.startswith('loop') and 1 or 2):
+                t0 = time.time()
+                for records in batches[compact][:count // 1000]:
+                    sink('bench', 'Meteo', records)
+                rates.append(count / (time.time() - t0))
+            n = sqlite3.connect(filename).execute('SELECT COUNT(*) FROM Meteo').fetchone()[0]
+            if n != count:
+                raise StandardError('%s stored %d records instead of %d' % (name, n, count))
+            print '%-22s %10d %12.0f %12s' % (name, count, rates[0], len(rates) > 1 and '%.0f' % rates[1] or '-')
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+#
+# Benchmark for fixed vs. adaptive swath sizes in file transfers
+#
+# Uploads and downloads a file from/to a simulated data logger over simulated
+# links with different latency, bandwidth and byte error rates. The fixed
+# swath of 512 bytes is compared with the adaptive swath (Swath = None) that
+# is learned from the round-trip times and lost responses of the link.
+#
+
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import sys
+import time
+import random
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python'))
+import pakbus
+import pakbus_sim
+
+NodeId = 0x001
+MyNodeId = 0x802
+
+# name, latency [s], bandwidth [bytes/s], byte error rate
+links = [
+    ('lan',         0.001,  None,   0.0),
+    ('cellular',    0.100,  50000,  0.0),
+    ('radio',       0.050,  11520,  0.0),
+    ('lossy radio', 0.050,  11520,  2e-5),
+]
+
+
+#
+# Transfer file count times, return (seconds per transfer, failed transfers)
+#
+def transfer(sim, direction, FileData, Swath, window, count):
+    s = pakbus.open_socket(sim.server_address[0], sim.server_address[1], 30)
+    failed = 0
+    t0 = time.time()
+    for i in range(count):
+        if direction == 'upload':
+            data, RespCode = pakbus.fileupload(s, NodeId, MyNodeId, 'CPU:bench.dat', Swath = Swath, window = window)
+            ok = data == FileData
+        else:
+            RespCode = pakbus.filedownload(s, NodeId, MyNodeId, 'CPU:bench.dat', FileData, Swath = Swath, window = window)
+            ok = RespCode == 0 and str(sim.nodes[NodeId].files['CPU:bench.dat']) == FileData
+        if not ok:
+            failed += 1
+    elapsed = (time.time() - t0) / count
+    pakbus.send(s, pakbus.pkt_bye_cmd(NodeId, MyNodeId))
+    s.close()
+    return elapsed, failed
+
+
+if __name__ == '__main__':
+    import optparse
+    parser = optparse.OptionParser()
+    parser.add_option('-k', '--size', type = 'int', default = 64, help = 'file size in kilobytes [default: %default]')
+    parser.add_option('-n', '--count', type = 'int', default = 3, help = 'transfers per measurement [default: %default]')
+    parser.add_option('-w', '--window', type = 'int', default = 1, help = 'requests in flight [default: %default]')
+    parser.add_option('-s', '--seed', type = 'int', default = 1, help = 'random seed for packet loss [default: %default]')
+    (options, args) = parser.parse_args()
+
+    random.seed(options.seed)
+    FileData = ''.join([chr(random.randrange(256)) for i in range(options.size * 1024)])
+
+    print 'file size: %d KB, window: %d, %d transfers per measurement' % (options.size, options.window, options.count)
+    print '%-12s %-9s %12s %12s %8s %8s %8s' % ('link', 'direction', 'fixed KB/s', 'adapt KB/s', 'gain', 'swath', 'failed')
+    for name, latency, bandwidth, ber in links:
+        sim = pakbus_sim.Simulator(latency = latency, bandwidth = bandwidth, ber = ber)
+        sim.add_node(NodeId, files = {'CPU:bench.dat': FileData})
+        sim.start()
+        for direction in ('upload', 'download'):
+            pakbus.swath_controllers.clear()
+            fixed, fixed_failed = transfer(sim, direction, FileData, 0x0200, options.window, options.count)
+            adaptive, adaptive_failed = transfer(sim, direction, FileData, None, options.window, options.count)
+            swath = pakbus.swath_controllers.values()[0].swath
+            print '%-12s %-9s %12.1f %12.1f %7.2fx %8d %4d/%-3d' % (name, direction, options.size / fixed, options.size / adaptive, fixed / adaptive, swath, fixed_failed, adaptive_failed)
+        sim.stop()
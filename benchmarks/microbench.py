@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+
+#
+# Micro-benchmark suite for the codec hot paths
+#
+# Times the core functions of pakbus.py on synthetic inputs (generated with a
+# fixed random seed, so every run measures the same data) and writes the
+# results as JSON:
+#
+#   python microbench.py -o before.json
+#   python microbench.py -o after.json --compare before.json
+#   python microbench.py --compare before.json after.json
+#
+# The comparison lists the ratio of the times for each case and flags
+# slowdowns beyond the threshold; the exit status is 1 if there are any. Each
+# case reports the best of several timing runs, but results of separate runs
+# still vary by several percent on busy or virtual machines, so both result
+# files should come from the same idle machine.
+#
+
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import sys
+import time
+import json
+import random
+import struct
+import timeit
+import platform
+import bench_rows
+import bench_parse
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python'))
+import pakbus
+
+
+#
+# Random string of n bytes
+#
+def random_bytes(rnd, n):
+    return ''.join([chr(rnd.randrange(256)) for i in range(n)])
+
+
+#
+# Raw values of n fields of a data type (as expected by encode_bin()) and their encoding
+#
+def make_values(rnd, Type, n):
+    if Type == 'ASCII':
+        values = [random_bytes(rnd, 16).replace('\0', ' ') for i in range(n)]
+        return values, ''.join(values)
+    if Type == 'ASCIIZ':
+        values = ['value %d' % rnd.randrange(1000000) for i in range(n)]
+        return values, ''.join([value + '\0' for value in values])
+    fmt = pakbus.datatype[Type]['fmt']
+    order = ''
+    if fmt[0] in '<>':
+        order, fmt = fmt[0], fmt[1:]
+    raw = random_bytes(rnd, n * pakbus.datatype[Type]['size'])
+    values = struct.unpack(order + n * fmt, raw)
+    count = len(values) // n
+    if count > 1:   # NSec, SecNano and USec values are tuples
+        values = [values[i:i + count] for i in range(0, len(values), count)]
+    return list(values), raw
+
+
+#
+# Event-driven table with n records of a few fields (TDF and collect data response)
+#
+def make_event_table(n):
+    fields = [('Alarm', 'UInt2', 1), ('Level', 'IEEE4B', 1), ('Temp', 'FP2', 2), ('Message', 'ASCII', 16)]
+    tdf = chr(1) + pakbus.encode_bin(['ASCIIZ', 'UInt4', 'Byte', 'NSec', 'NSec'], ['Events', 10000, 0x0e, (0, 0), (0, 0)])
+    for name, Type, dim in fields:
+        tdf += chr(pakbus.datatype[Type]['code']) + pakbus.encode_bin(['ASCIIZ', 'ASCIIZ', 'ASCIIZ', 'ASCIIZ', 'ASCIIZ', 'UInt4', 'UInt4', 'UInt4'], [name, '', 'Smp', '', '', 1, dim, 0])
+    tdf += chr(0)
+    raw = [pakbus.encode_bin(['UInt2', 'UInt4', 'UInt2'], [1, 1, n])]
+    for i in range(n):
+        raw.append(pakbus.encode_bin(['NSec', 'UInt2', 'IEEE4B', 'FP2', 'FP2', ('ASCII', 16)], [(i * 17, i), i % 7, i * 0.5, 0x1000 + i % 100, 0x2000 + i % 100, 'event'.ljust(16, '\0')]))
+    raw.append(chr(0))
+    return tdf, ''.join(raw)
+
+
+#
+# Benchmark cases: list of (name, function, arguments, items per call)
+#
+def make_cases():
+    rnd = random.Random(1)
+    cases = []
+
+    # Signatures
+    for size in (1024, 65536):
+        buff = random_bytes(rnd, size)
+        cases.append(('calcSigFor %dB' % size, pakbus.calcSigFor, (buff, ), size))
+    cases.append(('calcSigNullifier', pakbus.calcSigNullifier, (0x1234, ), 1))
+
+    # Quoting (random data: about 1 in 128 bytes needs quoting)
+    buff = random_bytes(rnd, 1024)
+    cases.append(('quote 1KB', pakbus.quote, (buff, ), len(buff)))
+    cases.append(('unquote 1KB', pakbus.unquote, (pakbus.quote(buff), ), len(buff)))
+
+    # Encoding and decoding of 100 values per data type
+    for Type in sorted(pakbus.datatype.keys()):
+        values, raw = make_values(rnd, Type, 100)
+        if Type == 'ASCII':
+            Types = 100 * [('ASCII', 16)]
+        else:
+            Types = 100 * [Type]
+        cases.append(('encode_bin %s' % Type, pakbus.encode_bin, (Types, values), 100))
+        cases.append(('decode_bin %s' % Type, pakbus.decode_bin, (Types, raw), 100))
+
+    # Packets
+    tabledef = pakbus.parse_tabledef(bench_rows.make_tabledef())
+    pkt = pakbus.PakBus_hdr(0x802, 0x001, 0x1) + pakbus.encode_bin(['Byte', 'Byte', 'Byte'], [0x89, 1, 0]) + bench_rows.make_response(1, 20)
+    cases.append(('decode_pkt collectdata', pakbus.decode_pkt, (pkt, ), 1))
+    pkt = pakbus.PakBus_hdr(0x802, 0x001, 0x1) + pakbus.encode_bin(['Byte', 'Byte', 'Byte', 'IEEE4B'], [0x9a, 1, 0, 12.5])
+    cases.append(('decode_pkt getvalues', pakbus.decode_pkt, (pkt, ), 1))
+
+    # Table definitions of a large program, directory of a full card
+    cases.append(('parse_tabledef 2000 fields', pakbus.parse_tabledef, (bench_parse.make_tabledef(2000), ), 2000))
+    cases.append(('parse_filedir 1000 files', pakbus.parse_filedir, (bench_parse.make_filedir(1000), ), 1000))
+
+    # Collect data responses
+    cases.append(('parse_collectdata interval 1000 records', pakbus.parse_collectdata, (bench_rows.make_response(1, 1000), tabledef), 1000))
+    tdf, raw = make_event_table(1000)
+    cases.append(('parse_collectdata event 1000 records', pakbus.parse_collectdata, (raw, pakbus.parse_tabledef(tdf)), 1000))
+    return cases
+
+
+#
+# Best time per call in seconds (number of calls per run calibrated to min_time)
+#
+def measure(func, args, repeat, min_time):
+    timer = timeit.Timer(lambda: func(*args))
+    number = 1
+    while True:
+        elapsed = timer.timeit(number)
+        if elapsed >= min_time:
+            break
+        number *= max(2, min(10, int(min_time / max(elapsed, 1e-9))))
+    return min([elapsed] + timer.repeat(repeat - 1, number)) / number
+
+
+#
+# Run all cases matching one of the patterns, return results dictionary
+#
+def run(patterns, repeat, min_time):
+    results = {}
+    print '%-42s %14s %12s' % ('case', 'us/call', 'ns/item')
+    for name, func, args, items in make_cases():
+        if patterns and not [p for p in patterns if p in name]:
+            continue
+        seconds = measure(func, args, repeat, min_time)
+        results[name] = {'seconds': seconds, 'items': items}
+        print '%-42s %14.3f %12.1f' % (name, seconds * 1e6, seconds / items * 1e9)
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime()),
+        'repeat': repeat,
+        'min_time': min_time,
+        'results': results,
+    }
+
+
+#
+# Compare two result sets, return number of slowdowns beyond threshold
+#
+def compare(base, new, threshold):
+    print '%-42s %12s %12s %8s' % ('case', 'base us', 'new us', 'ratio')
+    slower = 0
+    for name in sorted(new['results'].keys()):
+        if not base['results'].has_key(name):
+            continue
+        t_base = base['results'][name]['seconds']
+        t_new = new['results'][name]['seconds']
+        ratio = t_new / t_base
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = 'SLOWER'
+            slower += 1
+        elif ratio < 1 / (1 + threshold):
+            flag = 'faster'
+        print '%-42s %12.3f %12.3f %7.2fx %s' % (name, t_base * 1e6, t_new * 1e6, ratio, flag)
+    print '%d cases slower than %.0f%% beyond the base' % (slower, threshold * 100)
+    return slower
+
+
+if __name__ == '__main__':
+    import optparse
+    parser = optparse.OptionParser(usage = '%prog [options] [result file]')
+    parser.add_option('-o', '--output', help = 'write results to this JSON file')
+    parser.add_option('-k', '--cases', action = 'append', help = 'run only cases containing this string (may be repeated)')
+    parser.add_option('-r', '--repeat', type = 'int', default = 5, help = 'timing runs per case, the best is reported [default: %default]')
+    parser.add_option('-t', '--min-time', type = 'float', default = 0.05, help = 'minimum duration of one timing run in seconds [default: %default]')
+    parser.add_option('-c', '--compare', metavar = 'FILE', help = 'compare with the results in FILE (and the given result file instead of a new run)')
+    parser.add_option('--threshold', type = 'float', default = 0.1, help = 'relative slowdown flagged in comparisons [default: %default]')
+    (options, args) = parser.parse_args()
+
+    if options.compare and args:
+        new = json.load(open(args[0]))
+    else:
+        new = run(options.cases, options.repeat, options.min_time)
+        if options.output:
+            json.dump(new, open(options.output, 'w'), indent = 1, sort_keys = True)
+    if options.compare:
+        print
+        if compare(json.load(open(options.compare)), new, options.threshold):
+            sys.exit(1)
@@ -18,8 +18,20 @@
 #
 # Global imports
 #
+import array
+import itertools
+import math
 import struct
 import string
+import threading
+import weakref
+from operator import itemgetter
+
+# NumPy is optional (only needed for columnar record parsing)
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 #
@@ -38,8 +50,8 @@ datatype = {
     'Int2':     { 'code':  5, 'fmt': '>h',  'size': 2 },
     'Int4':     { 'code':  6, 'fmt': '>l',  'size': 4 },
     'FP2':      { 'code':  7, 'fmt': '>H',  'size': 2 },
-    'FP3':      { 'code': 15, 'fmt': '3c',  'size': 3 },
-    'FP4':      { 'code':  8, 'fmt': '4c',  'size': 4 },
+    'FP3':      { 'code': 15, 'fmt': '3s',  'size': 3 },
+    'FP4':      { 'code':  8, 'fmt': '>L',  'size': 4 },
     'IEEE4B':   { 'code':  9, 'fmt': '>f',  'size': 4 },
     'IEEE8B':   { 'code': 18, 'fmt': '>d',  'size': 8 },
     'Bool8':    { 'code': 17, 'fmt': 'B',   'size': 1 },
@@ -66,6 +78,10 @@ datatype = {
 #
 if not vars().has_key('transact'):
     transact = 0     # Running 8-bit transaction counter (initialized only if it does not exist)
+transact_lock = threading.Lock()
+tran_local = threading.local()   # Session currently issuing packets in this thread
+metrics = None   # Metrics registry while instrumentation is enabled (see enable_metrics())
+tracer = None    # Tracer while tracing is enabled (see enable_tracing())
 
 
 #
@@ -78,8 +94,35 @@ if not vars().has_key('transact'):
 def send(s, pkt):
     # s: socket object
     # pkt: unquoted, unframed PakBus packet (just header + message)
-    frame = quote(pkt + calcSigNullifier(calcSigFor(pkt)))
-    s.send('\xBD' + frame + '\xBD')
+    frame = frame_pkt(pkt)
+    span = tracer is not None and tracer.begin('send')
+
+    # serialize concurrent senders if a dispatcher is attached to the socket
+    dispatcher = dispatchers.get(s)
+    if dispatcher:
+        dispatcher.send_lock.acquire()
+        try:
+            s.sendall(frame)
+        finally:
+            dispatcher.send_lock.release()
+    else:
+        s.sendall(frame)
+    if span:
+        span.end(bytes = len(frame))
+
+
+#
+# Add signature nullifier, quote and frame a PakBus packet (as sent by send())
+#
+def frame_pkt(pkt):
+    # pkt: unquoted, unframed PakBus packet (just header + message)
+    span = tracer is not None and tracer.begin('quote_sign')
+    frame = '\xBD' + quote(pkt + calcSigNullifier(calcSigFor(pkt))) + '\xBD'
+    if metrics is not None:
+        metrics.packet_sent(pkt, frame)
+    if span:
+        span.end(bytes = len(frame))
+    return frame
 
 
 #
@@ -91,28 +134,168 @@ def send(s, pkt):
 #
 def recv(s):
     # s: socket object
-    pkt = ''
-    byte = None
-    while byte != '\xBD': byte = s.recv(1) # Read until first \xBD frame character
-    while byte == '\xBD': byte = s.recv(1) # Read unitl first character other than \xBD
-    while byte != '\xBD': # Read until next occurence of \xBD character
-        pkt += byte
-        byte = s.recv(1)
-    pkt = unquote(pkt)  # Unquote quoted characters
-    if calcSigFor(pkt): # Calculate signature (should be zero)
-        return None     # Signature not zero!
-    else:
-        return pkt[:-2] # Strip last 2 signature bytes and return packet
+    return get_framer(s).recv()
+
+
+#
+# Buffered PakBus frame reader
+#
+# Reads large chunks from a socket, splits them on \xBD frame characters and
+# unquotes and signs each frame incrementally while it arrives. A single read
+# may complete several packets, which are queued and returned one at a time.
+#
+class Framer(object):
+
+    def __init__(self, s, bufsize = 4096):
+        # s:        socket object
+        # bufsize:  maximum number of bytes requested per s.recv() call
+
+        self.s = s
+        self.bufsize = bufsize
+        self.packets = []       # queue of received packets (None: bad signature)
+        self.synced = False     # set when the first \xBD frame character was seen
+        self.new_frame()
+
+    #
+    # Reset state for the next frame
+    #
+    def new_frame(self):
+        self.body = []          # unquoted pieces of the current frame
+        self.sig = 0xAAAA       # running signature of the current frame
+        self.escape = False     # \xBC quote character pending from last piece
+
+    #
+    # Feed raw bytes from the link into the framer
+    #
+    def feed(self, data):
+        # data: raw (quoted and framed) string as read from the socket
+
+        pos = 0
+        end = len(data)
+        if metrics is not None:
+            metrics.inc('pakbus_wire_bytes_received_total', end)
+
+        # Discard everything before the first frame character
+        if not self.synced:
+            pos = data.find('\xBD')
+            if pos < 0:
+                return
+            self.synced = True
+
+        span = tracer is not None and tracer.begin('unquote_sign')
+
+        while pos < end:
+            nxt = data.find('\xBD', pos)
+            if nxt == pos:
+                # frame character: complete current frame (if any)
+                if self.body or self.escape:
+                    self.end_frame()
+                pos += 1
+                continue
+            if nxt < 0:
+                nxt = end
+            self.add_piece(data[pos:nxt])
+            pos = nxt
+        if span:
+            span.end(bytes = end)
+
+    #
+    # Unquote and sign a piece of a frame
+    #
+    def add_piece(self, piece):
+        # piece: quoted string without frame characters
+
+        # re-attach quote character left over from previous piece
+        if self.escape:
+            piece = '\xBC' + piece
+            self.escape = False
+
+        # hold back a trailing quote character until its partner arrives
+        if piece[-1] == '\xBC':
+            piece = piece[:-1]
+            self.escape = True
+
+        piece = unquote(piece)
+        self.sig = calcSigFor(piece, self.sig)
+        self.body.append(piece)
+
+    #
+    # Complete current frame and queue the packet
+    #
+    def end_frame(self):
+        if self.escape:  # dangling quote character: keep it as it is
+            self.body.append('\xBC')
+            self.sig = calcSigFor('\xBC', self.sig)
+        pkt = ''.join(self.body)
+        if self.sig:    # Signature not zero!
+            self.packets.append(None)
+            if metrics is not None:
+                metrics.inc('pakbus_signature_failures_total')
+        else:           # Strip last 2 signature bytes
+            self.packets.append(pkt[:-2])
+            if metrics is not None:
+                metrics.packet_received(pkt)
+        self.new_frame()
+
+    #
+    # Return next packet, reading from the socket if necessary
+    #
+    def recv(self):
+        while not self.packets:
+            self.read()
+        return self.packets.pop(0)
+
+    #
+    # Read once from the socket and queue the packets completed by the data
+    #
+    def read(self):
+        import socket
+        span = tracer is not None and tracer.begin('read')
+        try:
+            data = self.s.recv(self.bufsize)
+        except:
+            if span:
+                span.end(error = True)
+            raise
+        if span:
+            span.end(bytes = len(data))
+        if not data:
+            raise socket.error('connection closed by remote host')
+        self.feed(data)
+
+
+#
+# Get framer attached to a socket (create one if necessary)
+#
+_framers = weakref.WeakKeyDictionary()
+
+def get_framer(s):
+    # s: socket object
+
+    try:
+        framer = _framers[s]
+    except KeyError:
+        framer = _framers[s] = Framer(s)
+    return framer
 
 
 #
 # Generate new 8-bit transaction number
 #
+# Inside Session methods the number is taken from the session's own counter.
+#
 def newTranNbr():
     global transact
-    transact += 1
-    transact &= 0xFF
-    return transact
+    session = getattr(tran_local, 'session', None)
+    if session is not None:
+        return session.newTranNbr()
+    transact_lock.acquire()
+    try:
+        transact += 1
+        transact &= 0xFF
+        return transact
+    finally:
+        transact_lock.release()
 
 
 ################################################################################
@@ -154,18 +337,45 @@ def PakBus_hdr(DstNodeId, SrcNodeId, HiProtoCode, ExpMoreCode = 0x2, LinkState =
 #
 ################################################################################
 
+#
+# Signature transition table
+#
+# One signature step maps (hi, lo) to (lo, (rotl(lo) + hi + x) & 0xFF). The
+# table holds everything but the addition of x for an extended state
+# (hi << 9 | lo), where lo may still carry the unreduced sum of the previous
+# step (up to 0x1FE). Processing a byte is then a single lookup and addition.
+#
+def _sig_table():
+    table = array.array('i')
+    for hi in range(0x100):
+        for lo in range(0x200):
+            lo &= 0xFF
+            table.append(lo << 9 | ((lo << 1 | lo >> 7) + hi) & 0xFF)
+    return table
+
+sig_table = _sig_table()
+
 #
 # Calculate signature for PakBus packets
 #
 def calcSigFor(buff, seed = 0xAAAA):
-    sig = seed
-    for x in buff:
-        x = ord(x)
-        j = sig
-        sig = (sig <<1) & 0x1FF
-        if sig >= 0x100: sig += 1
-        sig = ((((sig + (j >>8) + x) & 0xFF) | (j <<8))) & 0xFFFF
-    return sig
+    # buff: string (or buffer) to sign
+    # seed: signature of preceding data, allows to sign a packet piece by piece
+
+    t = sig_table
+    sig = (seed & 0xFF00) << 1 | (seed & 0xFF)  # convert to extended state
+    data = bytearray(buff)
+
+    # bulk processing: 8 bytes per loop iteration
+    it = iter(data)
+    for a, b, c, d, e, f, g, h in itertools.izip(it, it, it, it, it, it, it, it):
+        sig = t[t[t[t[t[t[t[t[sig] + a] + b] + c] + d] + e] + f] + g] + h
+
+    # remaining bytes
+    for x in data[len(data) & ~7:]:
+        sig = t[sig] + x
+
+    return (sig >> 1) & 0xFF00 | (sig & 0xFF)
 
 #
 # Calculate signature nullifier needed to create valid PakBus packets
@@ -223,14 +433,16 @@ def unquote(pkt):
 #
 # Create Hello Command packet
 #
-def pkt_hello_cmd(DstNodeId, SrcNodeId, IsRouter = 0x00, HopMetric = 0x02, VerifyIntv = 1800):
+def pkt_hello_cmd(DstNodeId, SrcNodeId, IsRouter = 0x00, HopMetric = 0x02, VerifyIntv = 1800, TranNbr = None):
     # DstNodeId:   Destination node ID (12-bit int)
     # SrcNodeId:   Source node ID (12-bit int)
     # IsRouter:    Flag if source node is a router (default: 0)
     # HopMetric:   Worst case interval to complete transaction (default: 0x02 -> 5 s)
     # VerifyIntv:  Link verification interval in seconds (default: 30 minutes)
+    # TranNbr:     Transaction number (optional, generated if not supplied)
 
-    TranNbr = newTranNbr()  # Generate new transaction number
+    if TranNbr is None:
+        TranNbr = newTranNbr()  # Generate new transaction number
     hdr = PakBus_hdr(DstNodeId, SrcNodeId, 0x0, 0x1, 0x9) # PakBus Control Packet
     msg = encode_bin(['Byte', 'Byte', 'Byte', 'Byte', 'UInt2'], [0x09, TranNbr, IsRouter, HopMetric, VerifyIntv])
     pkt = hdr + msg
@@ -258,7 +470,7 @@ def pkt_hello_response(DstNodeId, SrcNodeId, TranNbr, IsRouter = 0x00, HopMetric
 def msg_hello(msg):
     # msg: decoded default message - must contain msg['raw']
 
-    [msg['IsRouter'], msg['HopMetric'], msg['VerifyIntv']], size = decode_bin(['Byte', 'Byte', 'UInt2'], msg['raw'][2:])
+    [msg['IsRouter'], msg['HopMetric'], msg['VerifyIntv']], size = decode_bin(['Byte', 'Byte', 'UInt2'], msg['raw'], offset = 2)
     return msg
 
 
@@ -312,14 +524,16 @@ def pkt_bye_cmd(DstNodeId, SrcNodeId):
 #
 # Create DevConfig Get Settings Command packet
 #
-def pkt_devconfig_get_settings_cmd(DstNodeId, SrcNodeId, BeginSettingId = None, EndSettingId = None, SecurityCode = 0x0000):
+def pkt_devconfig_get_settings_cmd(DstNodeId, SrcNodeId, BeginSettingId = None, EndSettingId = None, SecurityCode = 0x0000, TranNbr = None):
     # DstNodeId:        Destination node ID (12-bit int)
     # SrcNodeId:        Source node ID (12-bit int)
     # BeginSettingId:   First setting for the datalogger to include in response
     # EndSettingId:     Last setting for the datalogger to include in response
     # SecurityCode:     16-bit security code (optional)
+    # TranNbr:          Transaction number (optional, generated if not supplied)
 
-    TranNbr = newTranNbr()  # Generate new transaction number
+    if TranNbr is None:
+        TranNbr = newTranNbr()  # Generate new transaction number
     hdr = PakBus_hdr(DstNodeId, SrcNodeId, 0x0) # PakBus Control Packet
     msg = encode_bin(['Byte', 'Byte'], [0x0f, TranNbr])
     if not BeginSettingId is None:
@@ -336,22 +550,22 @@ def msg_devconfig_get_settings_response(msg):
     # msg: decoded default message - must contain msg['raw']
 
     offset = 2
-    [msg['Outcome']], size = decode_bin(['Byte'], msg['raw'][offset:])
+    [msg['Outcome']], size = decode_bin(['Byte'], msg['raw'], offset = offset)
     offset += size
 
     # Generate dictionary of all settings
     msg['Settings'] = []
     if msg['Outcome'] == 0x01:
-        [msg['DeviceType'], msg['MajorVersion'], msg['MinorVersion'], msg['MoreSettings']], size = decode_bin(['UInt2', 'Byte', 'Byte', 'Byte'], msg['raw'][offset:])
+        [msg['DeviceType'], msg['MajorVersion'], msg['MinorVersion'], msg['MoreSettings']], size = decode_bin(['UInt2', 'Byte', 'Byte', 'Byte'], msg['raw'], offset = offset)
         offset += size
 
         while offset < len(msg['raw']):
             # Get setting ID
-            [SettingId], size = decode_bin(['UInt2'], msg['raw'][offset:])
+            [SettingId], size = decode_bin(['UInt2'], msg['raw'], offset = offset)
             offset += size
 
             # Get flags and length
-            [bit16], size = decode_bin(['UInt2'], msg['raw'][offset:])
+            [bit16], size = decode_bin(['UInt2'], msg['raw'], offset = offset)
             LargeValue = (bit16 & 0x8000) >> 15
             ReadOnly = (bit16 & 0x4000) >> 14
             SettingLen = bit16 & 0x3FFF
@@ -375,13 +589,15 @@ def msg_devconfig_get_settings_response(msg):
 #
 # Create DevConfig Set Settings Command packet
 #
-def pkt_devconfig_set_settings_cmd(DstNodeId, SrcNodeId, Settings = [], SecurityCode = 0x0000):
+def pkt_devconfig_set_settings_cmd(DstNodeId, SrcNodeId, Settings = [], SecurityCode = 0x0000, TranNbr = None):
     # DstNodeId:        Destination node ID (12-bit int)
     # SrcNodeId:        Source node ID (12-bit int)
     # Settings:         List of dictionarys with SettingId and SettingValue fields for each setting (like 'Settings' returned by msg_devconfig_get_settings_response()
     # SecurityCode:     16-bit security code (optional)
+    # TranNbr:          Transaction number (optional, generated if not supplied)
 
-    TranNbr = newTranNbr()  # Generate new transaction number
+    if TranNbr is None:
+        TranNbr = newTranNbr()  # Generate new transaction number
     hdr = PakBus_hdr(DstNodeId, SrcNodeId, 0x0) # PakBus Control Packet
     msg = encode_bin(['Byte', 'Byte', 'UInt2'], [0x10, TranNbr, SecurityCode])
 
@@ -400,7 +616,7 @@ def msg_devconfig_set_settings_response(msg):
     # msg: decoded default message - must contain msg['raw']
 
     offset = 2
-    [msg['Outcome']], size = decode_bin(['Byte'], msg['raw'][offset:])
+    [msg['Outcome']], size = decode_bin(['Byte'], msg['raw'], offset = offset)
     offset += size
 
     # Generate dictionary of all settings
@@ -408,7 +624,7 @@ def msg_devconfig_set_settings_response(msg):
     if msg['Outcome'] == 0x01:
         while offset < len(msg['raw']):
             # Get setting ID
-            [SettingId, SettingOutcome], size = decode_bin(['UInt2', 'Byte'], msg['raw'][offset:])
+            [SettingId, SettingOutcome], size = decode_bin(['UInt2', 'Byte'], msg['raw'], offset = offset)
             offset += size
 
             msg['SettingStatus'].append({'SettingId': SettingId, 'SettingOutcome': SettingOutcome})
@@ -447,13 +663,15 @@ def msg_devconfig_set_settings_response(msg):
 #
 # Create DevConfig Control Command packet
 #
-def pkt_devconfig_control_cmd(DstNodeId, SrcNodeId, Action = 0x04, SecurityCode = 0x0000):
+def pkt_devconfig_control_cmd(DstNodeId, SrcNodeId, Action = 0x04, SecurityCode = 0x0000, TranNbr = None):
     # DstNodeId:        Destination node ID (12-bit int)
     # SrcNodeId:        Source node ID (12-bit int)
     # Action:           The action that should be taken by the data logger (default: refresh session timer)
     # SecurityCode:     16-bit security code (optional)
+    # TranNbr:          Transaction number (optional, generated if not supplied)
 
-    TranNbr = newTranNbr()  # Generate new transaction number
+    if TranNbr is None:
+        TranNbr = newTranNbr()  # Generate new transaction number
     hdr = PakBus_hdr(DstNodeId, SrcNodeId, 0x0) # PakBus Control Packet
     msg = encode_bin(['Byte', 'Byte', 'UInt2', 'Byte'], [0x13, TranNbr, SecurityCode, Action])
     pkt = hdr + msg
@@ -466,7 +684,7 @@ def msg_devconfig_control_response(msg):
     # msg: decoded default message - must contain msg['raw']
 
     offset = 2
-    [msg['Outcome']], size = decode_bin(['Byte'], msg['raw'][offset:])
+    [msg['Outcome']], size = decode_bin(['Byte'], msg['raw'], offset = offset)
     return msg
 
 
@@ -485,17 +703,24 @@ def msg_devconfig_control_response(msg):
 #
 # Create Please Wait Message packet
 #
+def pkt_pleasewait(DstNodeId, SrcNodeId, TranNbr, CmdMsgType, WaitSec):
+    # DstNodeId:    Destination node ID (12-bit int)
+    # SrcNodeId:    Source node ID (12-bit int)
+    # TranNbr:      Transaction number of the delayed command
+    # CmdMsgType:   Message type of the delayed command
+    # WaitSec:      Number of seconds until the response is sent
 
-#
-# still missing ...
-#
+    hdr = PakBus_hdr(DstNodeId, SrcNodeId, 0x1) # BMP5 Application Packet
+    msg = encode_bin(['Byte', 'Byte', 'Byte', 'UInt2'], [0xa1, TranNbr, CmdMsgType, WaitSec])
+    pkt = hdr + msg
+    return pkt
 
 #
 # Decode Please Wait Message packet
 #
 def msg_pleasewait(msg):
     # msg: decoded default message - must contain msg['raw']
-    [msg['CmdMsgType'], msg['WaitSec']], size = decode_bin(['Byte', 'UInt2'], msg['raw'][2:])
+    [msg['CmdMsgType'], msg['WaitSec']], size = decode_bin(['Byte', 'UInt2'], msg['raw'], offset = 2)
     return msg
 
 
@@ -508,13 +733,15 @@ def msg_pleasewait(msg):
 #
 # Create Clock Command packet
 #
-def pkt_clock_cmd(DstNodeId, SrcNodeId, Adjustment = (0, 0), SecurityCode = 0x0000):
+def pkt_clock_cmd(DstNodeId, SrcNodeId, Adjustment = (0, 0), SecurityCode = 0x0000, TranNbr = None):
     # DstNodeId:    Destination node ID (12-bit int)
     # SrcNodeId:    Source node ID (12-bit int)
     # Adjustment:   Clock adjustment (seconds, nanoseconds)
     # SecurityCode: 16-bit security code (optional)
+    # TranNbr:      Transaction number (optional, generated if not supplied)
 
-    TranNbr = newTranNbr()  # Generate new transaction number
+    if TranNbr is None:
+        TranNbr = newTranNbr()  # Generate new transaction number
     hdr = PakBus_hdr(DstNodeId, SrcNodeId, 0x1) # BMP5 Application Packet
     msg = encode_bin(['Byte', 'Byte', 'UInt2', 'NSec'], [0x17, TranNbr, SecurityCode, Adjustment])
     pkt = hdr + msg
@@ -525,7 +752,7 @@ def pkt_clock_cmd(DstNodeId, SrcNodeId, Adjustment = (0, 0), SecurityCode = 0x00
 #
 def msg_clock_response(msg):
     # msg: decoded default message - must contain msg['raw']
-    [msg['RespCode'], msg['Time']], size = decode_bin(['Byte', 'NSec'], msg['raw'][2:])
+    [msg['RespCode'], msg['Time']], size = decode_bin(['Byte', 'NSec'], msg['raw'], offset = 2)
     return msg
 
 
@@ -563,7 +790,7 @@ def pkt_filedownload_cmd(DstNodeId, SrcNodeId, FileName, FileData, SecurityCode
 def msg_filedownload_response(msg):
     # msg: decoded default message - must contain msg['raw']
 
-    [msg['RespCode'], msg['FileOffset']], size = decode_bin(['Byte', 'UInt4'], msg['raw'][2:])
+    [msg['RespCode'], msg['FileOffset']], size = decode_bin(['Byte', 'UInt4'], msg['raw'], offset = 2)
     return msg
 
 
@@ -600,7 +827,7 @@ def pkt_fileupload_cmd(DstNodeId, SrcNodeId, FileName, SecurityCode = 0x0000, Fi
 def msg_fileupload_response(msg):
     # msg: decoded default message - must contain msg['raw']
 
-    [msg['RespCode'], msg['FileOffset']], size = decode_bin(['Byte', 'UInt4'], msg['raw'][2:7])
+    [msg['RespCode'], msg['FileOffset']], size = decode_bin(['Byte', 'UInt4'], msg['raw'], offset = 2)
     msg['FileData'] = msg['raw'][7:] # return raw file data for later parsing
     return msg
 
@@ -619,26 +846,26 @@ def parse_filedir(raw):
 
     offset = 0  # offset into raw buffer
     fd = { 'files': [] }     # initialize file directory structure
-    [fd['DirVersion']], size = decode_bin(['Byte'], raw[offset:])
+    [fd['DirVersion']], size = decode_bin(['Byte'], raw, offset = offset)
     offset += size
 
     # Extract file entries
     while True:
         file = {} # file description
-        [filename], size = decode_bin(['ASCIIZ'], raw[offset:])
+        [filename], size = decode_bin(['ASCIIZ'], raw, offset = offset)
         offset += size
 
         # end loop when file attribute list terminator reached
         if filename == '': break
 
         file['FileName'] = filename
-        [file['FileSize'], file['LastUpdate']], size = decode_bin(['UInt4', 'ASCIIZ'], raw[offset:])
+        [file['FileSize'], file['LastUpdate']], size = decode_bin(['UInt4', 'ASCIIZ'], raw, offset = offset)
         offset += size
 
         # Read file attribute list
         file['Attribute'] = [] # initialize file attribute list (up to 12)
         for i in range(12):
-            [attribute], size = decode_bin(['Byte'], raw[offset:])
+            [attribute], size = decode_bin(['Byte'], raw, offset = offset)
             offset += size
             if attribute:
                 file['Attribute'].append(attribute) # append file attribute to list
@@ -681,7 +908,7 @@ def pkt_filecontrol_cmd(DstNodeId, SrcNodeId, FileName, FileCmd, SecurityCode =
 def msg_filecontrol_response(msg):
     # msg: decoded default message - must contain msg['raw']
 
-    [msg['RespCode'], msg['HoldOff']], size = decode_bin(['Byte', 'UInt2'], msg['raw'][2:])
+    [msg['RespCode'], msg['HoldOff']], size = decode_bin(['Byte', 'UInt2'], msg['raw'], offset = 2)
     return msg
 
 
@@ -715,11 +942,11 @@ def msg_getprogstat_response(msg):
     # msg: decoded default message - must contain msg['raw']
 
     # Get response code
-    [msg['RespCode']], size = decode_bin(['Byte'], msg['raw'][2:])
+    [msg['RespCode']], size = decode_bin(['Byte'], msg['raw'], offset = 2)
 
     # Get report data if RespCode == 0
     if msg['RespCode'] == 0:
-        [msg['OSVer'], msg['OSSig'], msg['SerialNbr'], msg['PowUpProg'], msg['CompState'], msg['ProgName'], msg['ProgSig'], msg['CompTime'], msg['CompResult']], size = decode_bin(['ASCIIZ', 'UInt2', 'ASCIIZ', 'ASCIIZ', 'Byte', 'ASCIIZ', 'UInt2', 'NSec', 'ASCIIZ'], msg['raw'][3:])
+        [msg['OSVer'], msg['OSSig'], msg['SerialNbr'], msg['PowUpProg'], msg['CompState'], msg['ProgName'], msg['ProgSig'], msg['CompTime'], msg['CompResult']], size = decode_bin(['ASCIIZ', 'UInt2', 'ASCIIZ', 'ASCIIZ', 'Byte', 'ASCIIZ', 'UInt2', 'NSec', 'ASCIIZ'], msg['raw'], offset = 3)
 
     return msg
 
@@ -745,7 +972,7 @@ def parse_tabledef(raw):
     TableDef = []   # List of table definitions
 
     offset = 0  # offset into raw buffer
-    FslVersion, size = decode_bin(['Byte'], raw[offset:])
+    FslVersion, size = decode_bin(['Byte'], raw, offset = offset)
     offset += size
 
     # Parse list of table definitions
@@ -756,13 +983,13 @@ def parse_tabledef(raw):
         start = offset  # start of table definition
 
         # Extract table header data
-        [tblhdr['TableName'], tblhdr['TableSize'], tblhdr['TimeType'], tblhdr['TblTimeInto'], tblhdr['TblInterval']], size = decode_bin(['ASCIIZ', 'UInt4', 'Byte', 'NSec', 'NSec'], raw[offset:])
+        [tblhdr['TableName'], tblhdr['TableSize'], tblhdr['TimeType'], tblhdr['TblTimeInto'], tblhdr['TblInterval']], size = decode_bin(['ASCIIZ', 'UInt4', 'Byte', 'NSec', 'NSec'], raw, offset = offset)
         offset += size
 
         # Extract field definitions
         while True:
             fld = {}
-            [fieldtype], size = decode_bin(['Byte'], raw[offset:])
+            [fieldtype], size = decode_bin(['Byte'], raw, offset = offset)
             offset += size
 
             # end loop when field list terminator reached
@@ -779,25 +1006,25 @@ def parse_tabledef(raw):
                     break
 
             # Extract field name
-            [fld['FieldName']], size = decode_bin(['ASCIIZ'], raw[offset:])
+            [fld['FieldName']], size = decode_bin(['ASCIIZ'], raw, offset = offset)
             offset += size
 
             # Extract AliasName list
             fld['AliasName'] = []
             while True:
-                [aliasname], size = decode_bin(['ASCIIZ'], raw[offset:])
+                [aliasname], size = decode_bin(['ASCIIZ'], raw, offset = offset)
                 offset += size
                 if aliasname == '': break # Alias names list terminator reached
                 fld['AliasName'].append(aliasname)
 
             # Extract other mandatory field definition items
-            [fld['Processing'], fld['Units'], fld['Description'], fld['BegIdx'], fld['Dimension']], size = decode_bin(['ASCIIZ', 'ASCIIZ', 'ASCIIZ', 'UInt4', 'UInt4'], raw[offset:])
+            [fld['Processing'], fld['Units'], fld['Description'], fld['BegIdx'], fld['Dimension']], size = decode_bin(['ASCIIZ', 'ASCIIZ', 'ASCIIZ', 'UInt4', 'UInt4'], raw, offset = offset)
             offset += size
 
             # Extract sub dimension (if any)
             fld['SubDim'] = []
             while True:
-                [subdim], size = decode_bin(['UInt4'], raw[offset:])
+                [subdim], size = decode_bin(['UInt4'], raw, offset = offset)
                 offset += size
                 if subdim == 0: break # sub-dimension list terminator reached
                 fld['SubDim'].append(subdim)
@@ -823,7 +1050,7 @@ def parse_tabledef(raw):
 #
 # Create Collect Data Command packet
 #
-def pkt_collectdata_cmd(DstNodeId, SrcNodeId, TableNbr, TableDefSig, FieldNbr = [], CollectMode = 0x05, P1 = 0, P2 = 0, SecurityCode = 0x0000):
+def pkt_collectdata_cmd(DstNodeId, SrcNodeId, TableNbr, TableDefSig, FieldNbr = [], CollectMode = 0x05, P1 = 0, P2 = 0, SecurityCode = 0x0000, TranNbr = None):
     # DstNodeId:    Destination node ID (12-bit int)
     # SrcNodeId:    Source node ID (12-bit int)
     # TableNbr:     Table number
@@ -833,12 +1060,15 @@ def pkt_collectdata_cmd(DstNodeId, SrcNodeId, TableNbr, TableDefSig, FieldNbr =
     # P1:           1st parameter used to specify what to collect (optional)
     # P2:           2nd parameter used to specify what to collect (optional)
     # SecurityCode: security code of the data logger
+    # TranNbr:      Transaction number (optional, generated if not supplied)
     #
     # Note: theoretically, several requests with different TableNbr, Fieldnbr etc. could be
     #       requested in a single collect data command packet. This was not implemented
     #       on purpose, as the decoding of the retrieved packet is not trivial
 
-    TranNbr = newTranNbr()  # Generate new transaction number
+    span = tracer is not None and tracer.begin('encode')
+    if TranNbr is None:
+        TranNbr = newTranNbr()  # Generate new transaction number
     hdr = PakBus_hdr(DstNodeId, SrcNodeId, 0x1) # BMP5 Application Packet
     msg = encode_bin(['Byte', 'Byte', 'UInt2', 'Byte'], [0x09, TranNbr, SecurityCode, CollectMode])
 
@@ -858,6 +1088,8 @@ def pkt_collectdata_cmd(DstNodeId, SrcNodeId, TableNbr, TableDefSig, FieldNbr =
     msg += encode_bin(len(fieldlist) * ['UInt2'], fieldlist)
 
     pkt = hdr + msg
+    if span:
+        span.end(bytes = len(pkt))
     return pkt, TranNbr
 
 #
@@ -867,7 +1099,7 @@ def msg_collectdata_response(msg):
     # msg: decoded default message - must contain msg['raw']
 
     offset = 2
-    [msg['RespCode']], size = decode_bin(['Byte'], msg['raw'][offset:])
+    [msg['RespCode']], size = decode_bin(['Byte'], msg['raw'], offset = offset)
     offset += size
 
     msg['RecData'] = msg['raw'][offset:] # return raw record data for later parsing
@@ -877,30 +1109,32 @@ def msg_collectdata_response(msg):
 #
 # Parse data returned by msg_collectdata_response(msg)
 #
-def parse_collectdata(raw, tabledef, FieldNbr = []):
+def parse_collectdata(raw, tabledef, FieldNbr = [], compact = False):
     # raw:      Raw coded data string containing record data
     # tabledef: Table definition structure (as returned by parse_tabledef())
     # FieldNbr:     list of field numbers (empty to collect all)
+    # compact:  return records as tuple rows (see record_type()) instead of dictionaries
 
+    span = tracer is not None and tracer.begin('parse_collectdata')
     offset = 0
     recdata = [] # output structure
 
     while offset < len(raw) - 1:
         frag = {} # record fragment
 
-        [frag['TableNbr'], frag['BegRecNbr']], size = decode_bin(['UInt2', 'UInt4'], raw[offset:])
+        [frag['TableNbr'], frag['BegRecNbr']], size = decode_bin(['UInt2', 'UInt4'], raw, offset = offset)
         offset += size
 
         # Provide table name
         frag['TableName'] = tabledef[frag['TableNbr'] - 1]['Header']['TableName']
 
         # Decode number of records (16 bits) or ByteOffset (32 Bits)
-        [isoffset], size = decode_bin(['Byte'], raw[offset:])
+        [isoffset], size = decode_bin(['Byte'], raw, offset = offset)
         frag['IsOffset'] = isoffset >> 7
 
-        # Handle fragmented records (must be put together by external function)
+        # Handle fragmented records (put together by complete_fragments())
         if frag['IsOffset']:
-            [byteoffset], size = decode_bin(['UInt4'], raw[offset:])
+            [byteoffset], size = decode_bin(['UInt4'], raw, offset = offset)
             offset += size
             frag['ByteOffset'] = byteoffset & 0x7FFFFFFF
             frag['NbrOfRecs'] = None
@@ -910,7 +1144,7 @@ def parse_collectdata(raw, tabledef, FieldNbr = []):
 
         # Handle complete records (standard case)
         else:
-            [nbrofrecs], size = decode_bin(['UInt2'], raw[offset:])
+            [nbrofrecs], size = decode_bin(['UInt2'], raw, offset = offset)
             offset += size
             frag['NbrOfRecs'] = nbrofrecs & 0x7FFF
             frag['ByteOffset'] = None
@@ -920,49 +1154,373 @@ def parse_collectdata(raw, tabledef, FieldNbr = []):
             if interval == (0, 0):  # event-driven table
                 timeofrec = None
             else:                   # interval data, read time of first record
-                [timeofrec], size = decode_bin(['NSec'], raw[offset:])
+                [timeofrec], size = decode_bin(['NSec'], raw, offset = offset)
                 offset += size
 
-            # Loop over all records
+            # Get codec and field positions for one record
+            codec, slices = record_layout(tabledef[frag['TableNbr'] - 1], FieldNbr, timeofrec is None)
+
+            # Compact records: build tuple rows
             frag['RecFrag'] = []
+            if compact:
+                cls, make = record_type(tabledef[frag['TableNbr'] - 1], FieldNbr, timeofrec is None)
+                decode = codec.decode
+                for n in range(frag['NbrOfRecs']):
+                    values, size = decode(raw, offset)
+                    offset += size
+                    if timeofrec:   # interval data
+                        frag['RecFrag'].append(make(frag['BegRecNbr'] + n, (timeofrec[0] + n * interval[0], timeofrec[1] + n * interval[1]), values))
+                    else:           # event-driven, time data precedes each record
+                        frag['RecFrag'].append(make(frag['BegRecNbr'] + n, values[0], values))
+                recdata.append(frag)
+                continue
+
+            # Loop over all records
             for n in range(frag['NbrOfRecs']):
                 record = {}
 
                 # Calculate current record number
                 record['RecNbr'] = frag['BegRecNbr'] + n
 
+                # Decode complete record
+                values, size = codec.decode(raw, offset)
+                offset += size
+
                 # Get TimeOfRec for interval data or event-driven tables
                 if timeofrec:   # interval data
                     record['TimeOfRec'] = (timeofrec[0] + n * interval[0], timeofrec[1] + n * interval[1])
                 else:           # event-driven, time data precedes each record
-                    [record['TimeOfRec']], size = decode_bin(['NSec'], raw[offset:])
-                    offset += size
+                    record['TimeOfRec'] = values[0]
 
-                # Loop over all field indices
+                # Split values into fields
                 record['Fields'] = {}
-                if FieldNbr:    # explicit field numbers provided
-                    fields = FieldNbr
-                else:           # default: generate list of all fields in table
-                    fields = range(1, len(tabledef[frag['TableNbr'] - 1]['Fields']) + 1)
-
-                for field in fields:
-                    fieldname = tabledef[frag['TableNbr'] - 1]['Fields'][field - 1]['FieldName']
-                    fieldtype = tabledef[frag['TableNbr'] - 1]['Fields'][field - 1]['FieldType']
-                    dimension = tabledef[frag['TableNbr'] - 1]['Fields'][field - 1]['Dimension']
-                    if fieldtype == 'ASCII':
-                        record['Fields'][fieldname], size = decode_bin([fieldtype], raw[offset:], dimension)
-                    else:
-                        record['Fields'][fieldname], size = decode_bin(dimension * [fieldtype], raw[offset:])
-                    offset += size
+                for fieldname, beg, end in slices:
+                    record['Fields'][fieldname] = values[beg:end]
                 frag['RecFrag'].append(record)
 
         recdata.append(frag)
 
     # Get flag if more records exist
-    [MoreRecsExist], size = decode_bin(['Bool'], raw[offset:])
+    [MoreRecsExist], size = decode_bin(['Bool'], raw, offset = offset)
+
+    if span:
+        span.end(bytes = len(raw), records = sum([frag['NbrOfRecs'] or 0 for frag in recdata]))
+    return recdata, MoreRecsExist
+
+
+#
+# Parse data returned by msg_collectdata_response(msg) into NumPy columns
+#
+# Works like parse_collectdata(), but decodes all complete records of a
+# fragment with a single numpy.frombuffer() call. Instead of 'RecFrag', each
+# fragment with complete records has:
+#
+# - 'RecNbr':    array of record numbers
+# - 'TimeOfRec': array of (seconds, nanoseconds) time stamps, shape (n, 2)
+# - 'Columns':   dictionary of arrays (shape (n, Dimension) for array fields)
+#
+# Note: trailing nul characters are stripped from ASCII fields.
+#
+def parse_collectdata_columns(raw, tabledef, FieldNbr = []):
+    # raw:      Raw coded data string containing record data
+    # tabledef: Table definition structure (as returned by parse_tabledef())
+    # FieldNbr: list of field numbers (empty to collect all)
+
+    if numpy is None:
+        raise ImportError('parse_collectdata_columns() requires NumPy')
+
+    offset = 0
+    recdata = [] # output structure
+
+    while offset < len(raw) - 1:
+        frag = {} # record fragment
+
+        [frag['TableNbr'], frag['BegRecNbr']], size = decode_bin(['UInt2', 'UInt4'], raw, offset = offset)
+        offset += size
+        frag['TableName'] = tabledef[frag['TableNbr'] - 1]['Header']['TableName']
+
+        # Decode number of records (16 bits) or ByteOffset (32 Bits)
+        [isoffset], size = decode_bin(['Byte'], raw, offset = offset)
+        frag['IsOffset'] = isoffset >> 7
+
+        # Handle fragmented records (raw data only, as in parse_collectdata())
+        if frag['IsOffset']:
+            [byteoffset], size = decode_bin(['UInt4'], raw, offset = offset)
+            offset += size
+            frag['ByteOffset'] = byteoffset & 0x7FFFFFFF
+            frag['NbrOfRecs'] = None
+            frag['RecFrag'] = raw[offset:-1]
+            offset += len(frag['RecFrag'])
+            recdata.append(frag)
+            continue
+
+        [nbrofrecs], size = decode_bin(['UInt2'], raw, offset = offset)
+        offset += size
+        n = frag['NbrOfRecs'] = nbrofrecs & 0x7FFF
+        frag['ByteOffset'] = None
+
+        # Get time of first record for interval data
+        interval = tabledef[frag['TableNbr'] - 1]['Header']['TblInterval']
+        if interval == (0, 0):  # event-driven table
+            timeofrec = None
+        else:
+            [timeofrec], size = decode_bin(['NSec'], raw, offset = offset)
+            offset += size
+
+        # Decode all records at once
+        dtype, columns = record_dtype(tabledef[frag['TableNbr'] - 1], FieldNbr, timeofrec is None)
+        records = numpy.frombuffer(raw, dtype, n, offset)
+        offset += n * dtype.itemsize
+
+        frag['RecNbr'] = numpy.arange(frag['BegRecNbr'], frag['BegRecNbr'] + n, dtype = numpy.int64)
+        if timeofrec:   # interval data
+            frag['TimeOfRec'] = numpy.empty((n, 2), numpy.int64)
+            frag['TimeOfRec'][:, 0] = timeofrec[0] + numpy.arange(n) * interval[0]
+            frag['TimeOfRec'][:, 1] = timeofrec[1] + numpy.arange(n) * interval[1]
+        else:           # event-driven, time data precedes each record
+            frag['TimeOfRec'] = records['t'].astype(numpy.int64)
+
+        # Convert columns to native byte order and decode Campbell floating point values
+        frag['Columns'] = {}
+        for name, fieldname, fieldtype in columns:
+            column = records[name]
+            if fieldtype == 'FP2':
+                column = fp2_to_float_array(column)
+            elif fieldtype == 'FP3':
+                column = fp3_to_float_array(column)
+            elif fieldtype == 'FP4':
+                column = fp4_to_float_array(column)
+            elif column.dtype.kind != 'S':
+                column = column.astype(column.dtype.newbyteorder('='))
+            frag['Columns'][fieldname] = column
+
+        recdata.append(frag)
+
+    # Get flag if more records exist
+    [MoreRecsExist], size = decode_bin(['Bool'], raw, offset = offset)
 
     return recdata, MoreRecsExist
 
+#
+# NumPy data types for PakBus data types
+#
+numpy_types = {
+    'Byte':     'u1',
+    'UInt2':    '>u2',
+    'UInt4':    '>u4',
+    'Int1':     'i1',
+    'Int2':     '>i2',
+    'Int4':     '>i4',
+    'FP2':      '>u2',
+    'FP3':      ('u1', 3),
+    'FP4':      '>u4',
+    'IEEE4B':   '>f4',
+    'IEEE8B':   '>f8',
+    'Bool8':    'u1',
+    'Bool':     'u1',
+    'Bool2':    '>u2',
+    'Bool4':    '>u4',
+    'Sec':      '>i4',
+    'USec':     ('S1', 6),
+    'NSec':     ('>i4', 2),
+    'Short':    '<i2',
+    'Long':     '<i4',
+    'UShort':   '<u2',
+    'ULong':    '<u4',
+    'IEEE4L':   '<f4',
+    'IEEE8L':   '<f8',
+    'SecNano':  ('<i4', 2),
+}
+
+#
+# Get NumPy structured data type for records of a table (cached)
+#
+record_dtype_cache = {}
+
+def record_dtype(tabledef, FieldNbr = [], EventDriven = False):
+    # tabledef:     Definition of a single table (one element of parse_tabledef() output)
+    # FieldNbr:     list of field numbers (empty to collect all)
+    # EventDriven:  Flag if an NSec time stamp precedes each record
+    #
+    # Returns the record data type and a list of (column name, FieldName, FieldType)
+
+    if not FieldNbr:    # default: generate list of all fields in table
+        FieldNbr = range(1, len(tabledef['Fields']) + 1)
+
+    fields = []
+    for field in FieldNbr:
+        fld = tabledef['Fields'][field - 1]
+        fields.append((fld['FieldName'], fld['FieldType'], fld['Dimension']))
+    key = (tuple(fields), EventDriven)
+
+    try:
+        return record_dtype_cache[key]
+    except KeyError:
+        pass
+
+    names = []
+    formats = []
+    columns = []
+    if EventDriven:
+        names.append('t')
+        formats.append(numpy_types['NSec'])
+    for fieldname, fieldtype, dimension in fields:
+        name = 'f%d' % len(columns)
+        if fieldtype == 'ASCII':
+            fmt = 'S%d' % dimension
+        else:
+            fmt = numpy.dtype(numpy_types[fieldtype])
+            if dimension != 1:
+                fmt = numpy.dtype((fmt.base, (dimension, ) + fmt.shape))
+        names.append(name)
+        formats.append(fmt)
+        columns.append((name, fieldname, fieldtype))
+
+    record_dtype_cache[key] = numpy.dtype({'names': names, 'formats': formats}), columns
+    return record_dtype_cache[key]
+
+#
+# Get codec and field positions for records of a table
+#
+def record_layout(tabledef, FieldNbr = [], EventDriven = False):
+    # tabledef:     Definition of a single table (one element of parse_tabledef() output)
+    # FieldNbr:     list of field numbers (empty to collect all)
+    # EventDriven:  Flag if an NSec time stamp precedes each record
+    #
+    # Returns the codec for a complete record and a list of (FieldName, begin, end)
+    # giving the positions of each field's values in the decoded value list
+
+    if not FieldNbr:    # default: generate list of all fields in table
+        FieldNbr = range(1, len(tabledef['Fields']) + 1)
+
+    Types = []
+    slices = []
+    if EventDriven:
+        Types.append('NSec')
+    for field in FieldNbr:
+        fld = tabledef['Fields'][field - 1]
+        beg = len(Types)
+        if fld['FieldType'] == 'ASCII':
+            Types.append(('ASCII', fld['Dimension']))
+        else:
+            Types.extend(fld['Dimension'] * [fld['FieldType']])
+        slices.append((fld['FieldName'], beg, len(Types)))
+
+    return get_codec(Types), slices
+
+
+#
+# Compact records (tuple rows)
+#
+# A row is a tuple (RecNbr, TimeOfRec, value of 1st field, value of 2nd
+# field, ...) of a class created once per table by record_type(). Rows have
+# no per-record dictionaries: fields with a single value hold the value
+# itself, array fields a tuple of values and ASCII fields a string. Fields
+# can be read by index, by attribute (row.AirTC) or by name (row['AirTC']);
+# row['RecNbr'], row['TimeOfRec'] and row['Fields'] (a dictionary of value
+# lists as in parse_collectdata()) also work, so code written for dictionary
+# records can use rows unchanged.
+#
+class Row(tuple):
+    __slots__ = ()
+
+    _fields = ('RecNbr', 'TimeOfRec')   # names of all columns
+    _index = {'RecNbr': 0, 'TimeOfRec': 1}
+    _arrays = ()                        # names of array fields
+
+    def __getitem__(self, key):
+        if type(key) is str:
+            if key == 'Fields':
+                return self.Fields
+            return tuple.__getitem__(self, self._index[key])
+        return tuple.__getitem__(self, key)
+
+    def get(self, key, default = None):
+        try:
+            return self[key]
+        except (KeyError, IndexError):
+            return default
+
+    def keys(self):
+        return ['RecNbr', 'TimeOfRec', 'Fields']
+
+    def has_key(self, key):
+        return key in ('RecNbr', 'TimeOfRec', 'Fields')
+
+    #
+    # Dictionary of field values as lists (as in parse_collectdata())
+    #
+    def Fields(self):
+        fields = {}
+        for i in range(2, len(self._fields)):
+            name = self._fields[i]
+            if name in self._arrays:
+                fields[name] = list(tuple.__getitem__(self, i))
+            else:
+                fields[name] = [tuple.__getitem__(self, i)]
+        return fields
+    Fields = property(Fields)
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, ', '.join(['%s=%r' % (name, value) for name, value in zip(self._fields, self)]))
+
+
+#
+# Get row class and record builder for records of a table (cached)
+#
+record_type_cache = {}
+
+def record_type(tabledef, FieldNbr = [], EventDriven = False):
+    # tabledef:     Definition of a single table (one element of parse_tabledef() output)
+    # FieldNbr:     list of field numbers (empty to collect all)
+    # EventDriven:  Flag if an NSec time stamp precedes each record
+    #
+    # Returns the Row subclass and a function make(RecNbr, TimeOfRec, values)
+    # building a row from the values decoded with the record_layout() codec
+
+    codec, slices = record_layout(tabledef, FieldNbr, EventDriven)
+    key = (tabledef['Header']['TableName'], tuple(slices), EventDriven)
+    try:
+        return record_type_cache[key]
+    except KeyError:
+        pass
+
+    names = ['RecNbr', 'TimeOfRec']
+    arrays = []
+    attrs = {'__slots__': ()}
+    for fieldname, beg, end in slices:
+        if end - beg > 1:
+            arrays.append(fieldname)
+        names.append(fieldname)
+    for i in range(len(names)):
+        if not hasattr(Row, names[i]):
+            attrs[names[i]] = property(itemgetter(i))
+    attrs['_fields'] = tuple(names)
+    attrs['_index'] = dict(zip(names, range(len(names))))
+    attrs['_arrays'] = frozenset(arrays)
+    cls = type(tabledef['Header']['TableName'] + 'Row', (Row, ), attrs)
+
+    new = tuple.__new__
+    if not arrays:  # one value per field: values can be used as they are
+        if EventDriven: # values start with the time stamp
+            def make(RecNbr, TimeOfRec, values):
+                return new(cls, [RecNbr] + values)
+        else:
+            def make(RecNbr, TimeOfRec, values):
+                return new(cls, [RecNbr, TimeOfRec] + values)
+    else:
+        def make(RecNbr, TimeOfRec, values):
+            row = [RecNbr, TimeOfRec]
+            for fieldname, beg, end in slices:
+                if end - beg == 1:
+                    row.append(values[beg])
+                else:
+                    row.append(tuple(values[beg:end]))
+            return new(cls, row)
+
+    record_type_cache[key] = cls, make
+    return cls, make
+
 
 ################################################################################
 #
@@ -995,7 +1553,7 @@ def parse_collectdata(raw, tabledef, FieldNbr = []):
 #
 # Create Get Values Command packet
 #
-def pkt_getvalues_cmd(DstNodeId, SrcNodeId, TableName, Type, FieldName, Swath = 1, SecurityCode = 0x0000):
+def pkt_getvalues_cmd(DstNodeId, SrcNodeId, TableName, Type, FieldName, Swath = 1, SecurityCode = 0x0000, TranNbr = None):
     # DstNodeId:    Destination node ID (12-bit int)
     # SrcNodeId:    Source node ID (12-bit int)
     # TableName:    Table name as string
@@ -1003,8 +1561,10 @@ def pkt_getvalues_cmd(DstNodeId, SrcNodeId, TableName, Type, FieldName, Swath =
     # FieldName:    Field name (including index if applicable)
     # Swath:        Number of columns to retrieve from an indexed field
     # SecurityCode: 16-bit security code (optional)
+    # TranNbr:      Transaction number (optional, generated if not supplied)
 
-    TranNbr = newTranNbr()  # Generate new transaction number
+    if TranNbr is None:
+        TranNbr = newTranNbr()  # Generate new transaction number
     hdr = PakBus_hdr(DstNodeId, SrcNodeId, 0x1) # BMP5 Application Packet
     msg = encode_bin(['Byte', 'Byte', 'UInt2', 'ASCIIZ', 'Byte', 'ASCIIZ', 'UInt2'], [0x1a, TranNbr, SecurityCode, TableName, datatype[Type]['code'], FieldName, Swath])
     pkt = hdr + msg
@@ -1015,7 +1575,7 @@ def pkt_getvalues_cmd(DstNodeId, SrcNodeId, TableName, Type, FieldName, Swath =
 #
 def msg_getvalues_response(msg):
     # msg: decoded default message - must contain msg['raw']
-    [msg['RespCode']], size = decode_bin(['Byte'], msg['raw'][2])
+    [msg['RespCode']], size = decode_bin(['Byte'], msg['raw'], offset = 2)
     msg['Values'] = msg['raw'][3:] # return raw coded values for later parsing
     return msg
 
@@ -1050,6 +1610,8 @@ def parse_values(raw, Type, Swath = 1):
 def decode_pkt(pkt):
     # pkt: buffer containing unquoted packet, signature nullifier stripped
 
+    span = tracer is not None and tracer.begin('decode_pkt')
+
     # Initialize output variables
     hdr = {'LinkState': None, 'DstPhyAddr': None, 'ExpMoreCode': None, 'Priority': None, 'SrcPhyAddr': None, 'HiProtoCode': None, 'DstNodeId': None, 'HopCnt': None, 'SrcNodeId': None}
     msg = {'MsgType': None, 'TranNbr': None, 'raw': None}
@@ -1069,7 +1631,7 @@ def decode_pkt(pkt):
 
         # decode default message fields: raw message, message type and transaction number
         msg['raw'] = pkt[8:]
-        [msg['MsgType'], msg['TranNbr']], size = decode_bin(('Byte', 'Byte'), msg['raw'][:2])
+        [msg['MsgType'], msg['TranNbr']], size = decode_bin(('Byte', 'Byte'), msg['raw'])
     except:
         pass
 
@@ -1095,48 +1657,22 @@ def decode_pkt(pkt):
     except KeyError:
         pass # if not listed above
 
+    if span:
+        span.end(bytes = pkt and len(pkt) or 0)
     return hdr, msg
 
 #
 # Decode binary data according to data type
 #
-def decode_bin(Types, buff, length = 1):
+def decode_bin(Types, buff, length = 1, offset = 0):
     # Types:   List of strings containing data types for fields
-    # buff:    Buffer containing binary data
+    #          (use ('ASCII', n) for a fixed-length string of n bytes)
+    # buff:    Buffer containing binary data (string, bytearray, buffer or memoryview)
     # length:  length of ASCII string (optional)
+    # offset:  Offset of first value in buffer (the buffer is not copied)
 
-    offset = 0 # offset into buffer
-    values = [] # list of values to return
-    for Type in Types:
-        # get default format and size for Type
-        fmt = datatype[Type]['fmt']
-        size = datatype[Type]['size']
-
-        if Type == 'ASCIIZ': # special handling: nul-terminated string
-            nul = buff.find('\0', offset) # find first '\0' after offset
-            value = buff[offset:nul] # return string without trailing '\0'
-            size = len(value) + 1
-        elif Type == 'ASCII': # special handling: fixed-length string
-            size = length
-            value = buff[offset:offset + size] # return fixed-length string
-        elif Type == 'FP2': # special handling: FP2 floating point number
-            fp2 = struct.unpack(fmt, buff[offset:offset+size])
-            mant = fp2[0] & 0x1FFF    # mantissa is in bits 1-13
-            exp  = fp2[0] >> 13 & 0x3 # exponent is in bits 14-15
-            sign = fp2[0] >> 15       # sign is in bit 16
-            value = ((-1)**sign * float(mant) / 10**exp, )
-        else:                # default decoding scheme
-            value = struct.unpack(fmt, buff[offset:offset+size])
-
-        # un-tuple single values
-        if len(value) == 1:
-            value = value[0]
-
-        values.append(value)
-        offset += size
-
-    # Return decoded values and current offset into buffer (size)
-    return values, offset
+    # Return decoded values and number of bytes used (size)
+    return get_codec(Types, length).decode(buff, offset)
 
 
 #
@@ -1146,140 +1682,550 @@ def encode_bin(Types, Values):
     # Types:   List of strings containing data types for fields
     # Values:  List of values (must have same number of elements as Types)
 
-    buff = '' # buffer for binary data
-    for i in range(len(Types)):
-        Type = Types[i]
-        fmt = datatype[Type]['fmt'] # get default format for Type
-        value = Values[i]
-
-        if Type == 'ASCIIZ':   # special handling: nul-terminated string
-            value += '\0' # Add nul to end of string
-            enc = struct.pack('%d%s' % (len(value), fmt), value)
-        elif Type == 'ASCII':   # special handling: fixed-length string
-            enc = struct.pack('%d%s' % (len(value), fmt), value)
-        elif Type == 'NSec':   # special handling: NSec time
-            enc = struct.pack(fmt, value[0], value[1])
-        else:                  # default encoding scheme
-            enc = struct.pack(fmt, value)
-
-        buff += enc
-    return buff
+    return get_codec(Types).encode(Values)
 
 
-################################################################################
 #
-# Time and clock functions
+# Campbell Scientific floating point formats (check [1] Appendix A)
 #
-################################################################################
-
-# base of the epoch for NSec values (1990-01-01 00:00:00)
-import calendar
-nsec_base = calendar.timegm((1990, 1, 1, 0, 0, 0))
+# FP2: bit 15 sign, bits 14-13 negative decimal exponent, bits 12-0 mantissa
+# FP3: bit 23 sign, bits 22-20 negative decimal exponent, bits 19-0 mantissa
+# FP4: bit 31 sign, bits 30-24 binary exponent (excess 64), bits 23-0 mantissa
+#      as a binary fraction
+#
+# All-ones mantissas mark +Inf/-Inf, all-ones minus one with the sign bit set
+# NaN (e.g. 0x1FFF, 0x9FFF and 0x9FFE for FP2); FP4 also requires the highest
+# exponent for these.
+#
+inf = float('inf')
+nan = float('nan')
 
-# length in seconds of one NSec tick (second integer value of an NSec value)
-# Note: this should normally be 1E-9 (nanoseconds). However, for several OS versions < 17, this is
-# actually 1e-6 for reading (not setting!) the clock
-nsec_tick = 1E-9
+fp2_special = { 0x1FFF: inf, 0x9FFF: -inf, 0x9FFE: nan }
+fp3_special = { 0x0FFFFF: inf, 0x8FFFFF: -inf, 0x8FFFFE: nan }
+fp4_special = { 0x7FFFFFFF: inf, 0xFFFFFFFF: -inf, 0xFFFFFFFE: nan }
 
 #
-# Convert nsec value to timestamp
+# Lookup table with the float values of all 65536 FP2 codes
 #
-def nsec_to_time(nsec, epoch = nsec_base, tick = nsec_tick):
-    # nsec:  NSec value
-
-    # Calculate timestamp with fractional seconds
-    timestamp = epoch + nsec[0] + nsec[1] * tick
-    return timestamp
+def _fp2_table():
+    table = []
+    for fp2 in range(0x10000):
+        mant = fp2 & 0x1FFF    # mantissa is in bits 1-13
+        exp  = fp2 >> 13 & 0x3 # exponent is in bits 14-15
+        sign = fp2 >> 15       # sign is in bit 16
+        table.append((-1)**sign * float(mant) / 10**exp)
+    for fp2, value in fp2_special.items():
+        table[fp2] = value
+    return table
 
+fp2_table = _fp2_table()
 
 #
-# Convert timestamp to nsec value
+# Convert FP2 value to float
 #
-def time_to_nsec(timestamp, epoch = nsec_base, tick = nsec_tick):
-    # timestamp: timestamp with fractional seconds
-    # epoch: start of epoch for absolute time calculations (default: nsec_base)
-    #        set to zero for time differences
-
-    # separate fractional and integer part of timestamp
-    import math
-    [fp, ip] = math.modf(timestamp)
+def fp2_to_float(fp2):
+    # fp2: 16-bit integer containing FP2 value
+    return fp2_table[fp2]
 
-    # Calculate two integer values for NSec
-    nsec = (int(ip - epoch), int(fp / tick))
-    return nsec
+#
+# Convert FP3 value to float
+#
+def fp3_to_float(fp3):
+    # fp3: 3-byte string containing FP3 value
 
+    fp3 = ord(fp3[0]) << 16 | ord(fp3[1]) << 8 | ord(fp3[2])
+    if fp3 in fp3_special:
+        return fp3_special[fp3]
+    mant = fp3 & 0xFFFFF    # mantissa is in bits 1-20
+    exp  = fp3 >> 20 & 0x7  # exponent is in bits 21-23
+    sign = fp3 >> 23        # sign is in bit 24
+    return (-1)**sign * float(mant) / 10**exp
 
 #
-# Synchronize data logger clock with local clock
+# Convert FP4 value to float
 #
-def clock_sync(s, DstNodeId, SrcNodeId, SecurityCode = 0x0000, min_adjust = 0.1, max_adjust = 3, offset = 0):
-    # s:            Socket object
-    # DstNodeId:    Destination node ID (12-bit int)
-    # SrcNodeId:    Source node ID (12-bit int)
-    # SecurityCode: 16-bit security code (optional)
-    # min_adjust:   Minimum time difference to adjust clock [seconds]
-    # max_adjust    Maximum adjustment in one step [seconds]
-    # offset:       Offset of data loger clock from UTC [seconds]
+def fp4_to_float(fp4):
+    # fp4: 32-bit integer containing FP4 value
 
-    import time
-    td = []
+    if fp4 in fp4_special:
+        return fp4_special[fp4]
+    mant = fp4 & 0xFFFFFF   # mantissa is in bits 1-24
+    exp  = fp4 >> 24 & 0x7F # exponent is in bits 25-31
+    sign = fp4 >> 31        # sign is in bit 32
+    return (-1)**sign * math.ldexp(mant, exp - 64 - 24)
 
-    # Read clock 10 times
-    for j in range(10):
-        pkt, TranNbr = pkt_clock_cmd(DstNodeId, SrcNodeId)
-        t1 = time.time() # timestamp directly before sending clock command
-        send(s, pkt)
-        reftime = time.time() # reference time (UTC)
-        hdr, msg = wait_pkt(s, DstNodeId, SrcNodeId, TranNbr)
-        t2 = time.time() # timestamp directly after receiving clock response
+#
+# Convert float to FP2 value (with the highest precision the mantissa allows)
+#
+def float_to_fp2(value):
+    # value: float
 
-        # Calculate time difference
-        if msg.has_key('Time'):
-            logtime = nsec_to_time(msg['Time']) - offset # time reported from data logger (UTC)
-            delay = (t2 - t1) / 2 # time estimated delay from communication protocol
-            td.append(logtime - reftime + delay) # build delay-corrected list of time differences
-        else:
+    if value != value:
+        return 0x9FFE
+    if value in (inf, -inf):
+        return value > 0 and 0x1FFF or 0x9FFF
+    sign = value < 0 and 0x8000 or 0
+    for exp in (3, 2, 1, 0):
+        mant = int(round(abs(value) * 10**exp))
+        if mant <= 7999:
             break
+    else:
+        mant = 7999     # largest FP2 value
+    return sign | exp << 13 | mant
 
-    # Calculate mean time difference tdiff
-    if len(td) > 2:
-        # Drop shortest and longest time difference
-        td.sort()
-        del td[0]
-        del td[-1]
-
-        # Calculate average time difference
-        tdiff = 0
-        for t in td:
-            tdiff += t
-        tdiff /= len(td)
-
-        # Calculate adjustment
-        if abs(tdiff) > min_adjust:
-            # Adjust clock
-            adjust = max(min(-tdiff, max_adjust), -max_adjust)
-            pkt, TranNbr = pkt_clock_cmd(DstNodeId, SrcNodeId, time_to_nsec(adjust, epoch = 0))
-            send(s, pkt)
-            hdr, msg = wait_pkt(s, DstNodeId, SrcNodeId, TranNbr)
-        else:
-            adjust = 0
+#
+# Convert float to FP3 value (3-byte string)
+#
+def float_to_fp3(value):
+    # value: float
 
-    # could not calculate tdiff
+    if value != value:
+        fp3 = 0x8FFFFE
+    elif value in (inf, -inf):
+        fp3 = value > 0 and 0x0FFFFF or 0x8FFFFF
     else:
-        tdiff = None
-        adjust = 0
+        sign = value < 0 and 0x800000 or 0
+        for exp in (7, 6, 5, 4, 3, 2, 1, 0):
+            mant = int(round(abs(value) * 10**exp))
+            if mant < 0xFFFFE:
+                break
+        else:
+            mant = 0xFFFFD  # largest FP3 value
+        fp3 = sign | exp << 20 | mant
+    return struct.pack('>L', fp3)[1:]
 
-    # return time difference (delay- and offset-corrected) and last adjustment
-    return tdiff, adjust
+#
+# Convert float to FP4 value
+#
+def float_to_fp4(value):
+    # value: float
 
+    if value != value:
+        return 0xFFFFFFFE
+    if value in (inf, -inf):
+        return value > 0 and 0x7FFFFFFF or 0xFFFFFFFF
+    sign = value < 0 and 0x80000000 or 0
+    mant, exp = math.frexp(abs(value))
+    mant = int(round(mant * 0x1000000))
+    if mant > 0xFFFFFF:
+        mant >>= 1
+        exp += 1
+    exp = min(max(exp + 64, 0), 0x7F)
+    return sign | exp << 24 | mant
 
-################################################################################
 #
-# Utility functions for routine tasks
+# Convert arrays of FP2/FP3/FP4 values to floats (requires NumPy)
 #
-################################################################################
+fp2_array_table = None
 
-#
+def fp2_to_float_array(fp2):
+    # fp2: NumPy array of 16-bit integers containing FP2 values
+
+    global fp2_array_table
+    if fp2_array_table is None:
+        fp2_array_table = numpy.array(fp2_table)
+    return fp2_array_table[fp2.astype(numpy.intp)]
+
+def fp3_to_float_array(fp3):
+    # fp3: NumPy array of bytes with FP3 values in its last dimension (size 3)
+
+    fp3 = fp3.astype(numpy.int64)
+    fp3 = fp3[..., 0] << 16 | fp3[..., 1] << 8 | fp3[..., 2]
+    mant = fp3 & 0xFFFFF    # mantissa is in bits 1-20
+    exp  = fp3 >> 20 & 0x7  # exponent is in bits 21-23
+    sign = fp3 >> 23        # sign is in bit 24
+    value = numpy.where(sign, -1.0, 1.0) * mant / 10.0 ** exp
+    return _float_specials(value, fp3, fp3_special)
+
+def fp4_to_float_array(fp4):
+    # fp4: NumPy array of 32-bit integers containing FP4 values
+
+    fp4 = fp4.astype(numpy.int64)
+    mant = fp4 & 0xFFFFFF   # mantissa is in bits 1-24
+    exp  = fp4 >> 24 & 0x7F # exponent is in bits 25-31
+    sign = fp4 >> 31        # sign is in bit 32
+    value = numpy.where(sign, -1.0, 1.0) * numpy.ldexp(mant.astype(numpy.float64), (exp - 64 - 24).astype(numpy.int32))
+    return _float_specials(value, fp4, fp4_special)
+
+def _float_specials(value, raw, special):
+    for code, special_value in special.items():
+        value[raw == code] = special_value
+    return value
+
+#
+# Conversion functions applied by codecs after unpacking
+#
+codec_conversions = {
+    'FP2': fp2_table.__getitem__,
+    'FP3': fp3_to_float,
+    'FP4': fp4_to_float,
+}
+
+
+#
+# Compiled codec for a list of data types
+#
+# Consecutive fixed-size fields are merged into one precompiled struct.Struct
+# (as long as they share the same byte order); variable-length ASCII and
+# ASCIIZ fields are handled between these segments.
+#
+CODEC_FIXED = 0
+CODEC_ASCIIZ = 1
+CODEC_ASCII = 2
+
+class Codec(object):
+
+    def __init__(self, Types, length = 1):
+        # Types:   List of strings containing data types for fields
+        #          (use ('ASCII', n) for a fixed-length string of n bytes)
+        # length:  default length of ASCII strings
+
+        self.segments = [] # list of (kind, Struct or string length, field list, conversions)
+        order = None       # byte order of current fixed-size segment
+        codes = []         # struct format codes of current fixed-size segment
+        fields = []        # (number of values, conversion function) for each field
+
+        for Type in Types:
+            if type(Type) is tuple: # fixed-length string with explicit length
+                Type, size = Type
+            else:
+                size = length
+
+            if Type in ('ASCII', 'ASCIIZ'):
+                if codes:
+                    self.add_fixed(order, codes, fields)
+                    order, codes, fields = None, [], []
+                if Type == 'ASCIIZ':
+                    self.segments.append((CODEC_ASCIIZ, None, [None], None))
+                else:
+                    self.segments.append((CODEC_ASCII, size, [None], None))
+                continue
+
+            fmt = datatype[Type]['fmt']
+            if fmt[0] in '<>':
+                if order and order != fmt[0]: # byte order changes: start new segment
+                    self.add_fixed(order, codes, fields)
+                    codes, fields = [], []
+                order = fmt[0]
+                fmt = fmt[1:]
+            count = len(struct.unpack(fmt, '\0' * struct.calcsize(fmt)))
+            conv = codec_conversions.get(Type)
+            codes.append(fmt)
+            fields.append((count, conv))
+
+        if codes:
+            self.add_fixed(order, codes, fields)
+
+        # Size of encoded values in bytes (None if there are nul-terminated strings)
+        self.size = 0
+        for kind, arg, fields, conversions in self.segments:
+            if kind == CODEC_FIXED:
+                self.size += arg.size
+            elif kind == CODEC_ASCII:
+                self.size += arg
+            else:
+                self.size = None
+                break
+
+    #
+    # Add segment of fixed-size fields
+    #
+    def add_fixed(self, order, codes, fields):
+        # conversions: None if values can be used as they are, a list of
+        # (index, function) if all fields are single values, False otherwise
+        conversions = []
+        for i in range(len(fields)):
+            count, conv = fields[i]
+            if count != 1:
+                conversions = False
+                break
+            if conv:
+                conversions.append((i, conv))
+        if conversions == []:
+            conversions = None
+        self.segments.append((CODEC_FIXED, struct.Struct((order or '>') + ''.join(codes)), fields, conversions))
+
+    #
+    # Decode values from buffer
+    #
+    def decode(self, buff, offset = 0):
+        # buff:    Buffer containing binary data
+        # offset:  Offset of first value in buffer
+
+        pos = offset
+        values = []
+        for kind, arg, fields, conversions in self.segments:
+            if kind == CODEC_FIXED:
+                vals = arg.unpack_from(buff, pos)
+                pos += arg.size
+                if conversions is None:  # plain values
+                    values.extend(vals)
+                    continue
+                if conversions:          # single values, some to be converted
+                    vals = list(vals)
+                    for i, conv in conversions:
+                        vals[i] = conv(vals[i])
+                    values.extend(vals)
+                    continue
+                i = 0
+                for count, conv in fields:
+                    if count == 1:
+                        value = vals[i]
+                        if conv:
+                            value = conv(value)
+                    else:
+                        value = vals[i:i + count]
+                    values.append(value)
+                    i += count
+            elif kind == CODEC_ASCIIZ: # nul-terminated string
+                try:
+                    nul = buff.find('\0', pos) # find first '\0' after offset
+                except AttributeError:    # buffer or memoryview
+                    nul = find_nul(buff, pos)
+                value = buff[pos:nul] # return string without trailing '\0'
+                if type(value) is not str:
+                    value = to_str(value)
+                values.append(value)
+                pos += len(value) + 1
+            else:                      # fixed-length string
+                value = buff[pos:pos + arg]
+                if type(value) is not str:
+                    value = to_str(value)
+                values.append(value)
+                pos += arg
+
+        # Return decoded values and number of bytes used
+        return values, pos - offset
+
+    #
+    # Encode values into binary string
+    #
+    def encode(self, Values):
+        # Values:  List of values (must have same number of elements as Types)
+
+        buff = []
+        i = 0
+        for kind, arg, fields, conversions in self.segments:
+            n = len(fields)
+            if kind == CODEC_FIXED:
+                if conversions is not False:
+                    buff.append(arg.pack(*Values[i:i + n]))
+                else:
+                    args = []
+                    for (count, conv), value in zip(fields, Values[i:i + n]):
+                        if count == 1:
+                            args.append(value)
+                        else:
+                            args.extend(value)
+                    buff.append(arg.pack(*args))
+            elif kind == CODEC_ASCIIZ: # Add nul to end of string
+                buff.append(Values[i] + '\0')
+            else:
+                buff.append(Values[i])
+            i += n
+        return ''.join(buff)
+
+
+#
+# Find first nul character at or after pos in a buffer without find() method
+#
+# Searches in blocks of growing size, so only the bytes up to the nul
+# character are copied. Returns -1 if there is no nul character (like
+# str.find()).
+#
+def find_nul(buff, pos):
+    # buff: buffer or memoryview object
+    # pos:  offset to start searching at
+
+    block = 64
+    start = pos
+    while start < len(buff):
+        nul = to_str(buff[start:start + block]).find('\0')
+        if nul >= 0:
+            return start + nul
+        start += block
+        block *= 2
+    return -1
+
+#
+# Convert slice of a bytearray, buffer or memoryview to a string
+#
+def to_str(value):
+    try:
+        return value.tobytes()  # memoryview
+    except AttributeError:
+        return str(value)       # bytearray, buffer
+
+
+#
+# Get compiled codec for a list of data types (cached)
+#
+codec_cache = {}
+codec_cache_size = 1024 # maximum number of cached codecs
+
+def get_codec(Types, length = 1):
+    # Types:   List of strings containing data types for fields
+    # length:  default length of ASCII strings
+
+    key = (tuple(Types), length)
+    try:
+        return codec_cache[key]
+    except KeyError:
+        if len(codec_cache) >= codec_cache_size:
+            codec_cache.clear()
+        codec = codec_cache[key] = Codec(Types, length)
+        return codec
+
+
+################################################################################
+#
+# Time and clock functions
+#
+################################################################################
+
+# base of the epoch for NSec values (1990-01-01 00:00:00)
+import calendar
+nsec_base = calendar.timegm((1990, 1, 1, 0, 0, 0))
+
+# length in seconds of one NSec tick (second integer value of an NSec value)
+# Note: this should normally be 1E-9 (nanoseconds). However, for several OS versions < 17, this is
+# actually 1e-6 for reading (not setting!) the clock
+nsec_tick = 1E-9
+
+#
+# Convert nsec value to timestamp
+#
+def nsec_to_time(nsec, epoch = nsec_base, tick = nsec_tick):
+    # nsec:  NSec value
+
+    # Calculate timestamp with fractional seconds
+    timestamp = epoch + nsec[0] + nsec[1] * tick
+    return timestamp
+
+
+#
+# Convert timestamp to nsec value
+#
+def time_to_nsec(timestamp, epoch = nsec_base, tick = nsec_tick):
+    # timestamp: timestamp with fractional seconds
+    # epoch: start of epoch for absolute time calculations (default: nsec_base)
+    #        set to zero for time differences
+
+    # separate fractional and integer part of timestamp
+    import math
+    [fp, ip] = math.modf(timestamp)
+
+    # Calculate two integer values for NSec
+    nsec = (int(ip - epoch), int(fp / tick))
+    return nsec
+
+
+#
+# Synchronize data logger clock with local clock
+#
+def clock_sync(s, DstNodeId, SrcNodeId, SecurityCode = 0x0000, min_adjust = 0.1, max_adjust = 3, offset = 0):
+    # s:            Socket object
+    # DstNodeId:    Destination node ID (12-bit int)
+    # SrcNodeId:    Source node ID (12-bit int)
+    # SecurityCode: 16-bit security code (optional)
+    # min_adjust:   Minimum time difference to adjust clock [seconds]
+    # max_adjust    Maximum adjustment in one step [seconds]
+    # offset:       Offset of data loger clock from UTC [seconds]
+
+    import time
+    td = []
+
+    # Read clock 10 times
+    for j in range(10):
+        pkt, TranNbr = pkt_clock_cmd(DstNodeId, SrcNodeId, SecurityCode = SecurityCode)
+        t1 = time.time() # timestamp directly before sending clock command
+        send(s, pkt)
+        reftime = time.time() # reference time (UTC)
+        hdr, msg = wait_pkt(s, DstNodeId, SrcNodeId, TranNbr)
+        t2 = time.time() # timestamp directly after receiving clock response
+
+        # Calculate time difference
+        if msg.has_key('Time'):
+            logtime = nsec_to_time(msg['Time']) - offset # time reported from data logger (UTC)
+            delay = (t2 - t1) / 2 # time estimated delay from communication protocol
+            td.append(logtime - reftime + delay) # build delay-corrected list of time differences
+        else:
+            break
+
+    # Calculate mean time difference tdiff
+    tdiff = mean_tdiff(td)
+    adjust = clock_adjustment(tdiff, min_adjust, max_adjust)
+
+    # Adjust clock
+    if adjust:
+        pkt, TranNbr = pkt_clock_cmd(DstNodeId, SrcNodeId, time_to_nsec(adjust, epoch = 0), SecurityCode)
+        send(s, pkt)
+        hdr, msg = wait_pkt(s, DstNodeId, SrcNodeId, TranNbr)
+
+    # return time difference (delay- and offset-corrected) and last adjustment
+    return tdiff, adjust
+
+
+#
+# Calculate mean time difference from clock readings
+#
+def mean_tdiff(td):
+    # td: list of delay-corrected time differences between logger and local clock
+    #
+    # Returns None if there are less than 3 readings
+
+    if len(td) <= 2:
+        return None
+
+    # Drop shortest and longest time difference
+    td = sorted(td)[1:-1]
+
+    # Calculate average time difference
+    tdiff = 0
+    for t in td:
+        tdiff += t
+    tdiff /= len(td)
+    return tdiff
+
+
+#
+# Calculate clock adjustment for a time difference
+#
+def clock_adjustment(tdiff, min_adjust = 0.1, max_adjust = 3):
+    # tdiff:        mean time difference (as returned by mean_tdiff())
+    # min_adjust:   Minimum time difference to adjust clock [seconds]
+    # max_adjust    Maximum adjustment in one step [seconds]
+
+    if tdiff is None or abs(tdiff) <= min_adjust:
+        return 0
+    return max(min(-tdiff, max_adjust), -max_adjust)
+
+
+################################################################################
+#
+# Utility functions for routine tasks
+#
+################################################################################
+
+#
+# Set deadline of a socket (all transactions on the socket have to be finished by then)
+#
+# wait_pkt() waits at most until the deadline, even after "please wait"
+# messages, and raises socket.timeout when it has passed.
+#
+_deadlines = weakref.WeakKeyDictionary()
+
+def set_deadline(s, deadline):
+    # s:        socket object
+    # deadline: time.time() value (None to remove the deadline)
+
+    if deadline is None:
+        _deadlines.pop(s, None)
+    else:
+        _deadlines[s] = deadline
+
+
+#
 # Wait for an incoming packet
 #
 def wait_pkt(s, SrcNodeId, DstNodeId, TranNbr, timeout = 5):
@@ -1290,14 +2236,33 @@ def wait_pkt(s, SrcNodeId, DstNodeId, TranNbr, timeout = 5):
     # timeout:      timeout in seconds
 
     import time, socket
+    deadline = _deadlines.get(s)
+    if deadline is not None:
+        if time.time() >= deadline:
+            raise socket.timeout('deadline exceeded')
+        timeout = min(timeout, (deadline - time.time()) / 0.9)
+
+    # let the dispatcher wait for the packet if one is attached to the socket
+    dispatcher = dispatchers.get(s)
+    if dispatcher:
+        hdr, msg = dispatcher.wait(SrcNodeId, DstNodeId, TranNbr, timeout)
+        if not msg and deadline is not None and time.time() >= deadline:
+            raise socket.timeout('deadline exceeded')
+        return hdr, msg
+
     max_time = time.time() + 0.9 * timeout
+    span = tracer is not None and tracer.begin('wait', TranNbr = TranNbr)
+    holdoff = None
 
     # remember current timeout setting
     s_timeout = s.gettimeout()
 
     # Loop until timeout is reached
     while time.time() < max_time:
-        s.settimeout(timeout)
+        if deadline is not None:
+            s.settimeout(max(min(timeout, deadline - time.time()), 0.001))
+        else:
+            s.settimeout(timeout)
         try:
             rcv = recv(s)
         except socket.timeout:
@@ -1306,6 +2271,8 @@ def wait_pkt(s, SrcNodeId, DstNodeId, TranNbr, timeout = 5):
 
         # ignore packets that are not for us
         if hdr['DstNodeId'] != DstNodeId or hdr['SrcNodeId'] != SrcNodeId:
+            if metrics is not None and rcv:
+                metrics.inc('pakbus_dropped_packets_total', reason = 'address')
             continue
 
         # Respond to incoming hello command packets
@@ -1318,101 +2285,807 @@ def wait_pkt(s, SrcNodeId, DstNodeId, TranNbr, timeout = 5):
         if msg['TranNbr'] == TranNbr and msg['MsgType'] == 0xa1:
             timeout = msg['WaitSec']
             max_time += timeout
+            if deadline is not None:
+                max_time = min(max_time, deadline)
+            if metrics is not None:
+                metrics.pleasewait(msg)
+            if span:
+                if holdoff:
+                    holdoff.end()
+                holdoff = span.tracer.begin('holdoff', WaitSec = msg['WaitSec'])
             continue
 
         # this should be the packet we are waiting for
         if msg['TranNbr'] == TranNbr:
+            if metrics is not None:
+                metrics.response(hdr, msg)
             break
 
+        if metrics is not None:
+            metrics.inc('pakbus_dropped_packets_total', reason = 'transaction')
+
     else:
         hdr = {}
         msg = {}
+        if metrics is not None:
+            metrics.timeout(SrcNodeId, TranNbr)
 
     # restore previous timeout setting
     s.settimeout(s_timeout)
 
+    if span:
+        if holdoff:
+            holdoff.end()
+        span.end(timeout = not msg)
+
+    if not msg and deadline is not None and time.time() >= deadline:
+        raise socket.timeout('deadline exceeded')
     return hdr, msg
 
 
+#
+# Per-connection packet dispatcher
+#
+# A reader thread receives all packets from the socket and routes them into
+# mailboxes keyed by (SrcNodeId, TranNbr), so that several transactions can be
+# in flight on one connection at the same time. Hello commands are answered
+# automatically. Packets that arrive before anybody waits for them are kept
+# (up to max_unclaimed), so requests can be sent first and collected later:
+#
+#   d = pakbus.Dispatcher(s)
+#   replies = d.transact_many(NodeId, MyNodeId, [pakbus.pkt_getvalues_cmd(...), ...])
+#
+# While a dispatcher is attached, send() and wait_pkt() use it automatically.
+#
+class Dispatcher(object):
+
+    def __init__(self, s, max_unclaimed = 256, poll = 0.1):
+        # s:             socket object
+        # max_unclaimed: maximum number of packets kept for later wait() calls
+        # poll:          interval in seconds in which the reader checks for close()
+
+        self.s = s
+        self.max_unclaimed = max_unclaimed
+        self.poll = poll
+        self.send_lock = threading.Lock()
+        self.cond = threading.Condition()
+        self.mailboxes = {}     # (SrcNodeId, TranNbr) -> list of (hdr, msg)
+        self.arrivals = []      # keys of mailboxes in order of arrival
+        self.dropped = 0        # number of packets discarded unclaimed
+        self.closed = False
+
+        dispatchers[s] = self
+        self.thread = threading.Thread(target = self.run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    #
+    # Reader thread: route incoming packets into mailboxes
+    #
+    # The reader only reads from the socket when data is available (checked
+    # every poll seconds), so that it ends soon after close() and does not
+    # take packets meant for a later reader.
+    #
+    def run(self):
+        import select, socket
+        framer = get_framer(self.s)
+        while not self.closed:
+            if not framer.packets:
+                try:
+                    if select.select([self.s], [], [], self.poll)[0]:
+                        framer.read()
+                except socket.timeout:
+                    pass
+                except (socket.error, select.error):
+                    break   # connection closed
+                continue
+            rcv = framer.packets.pop(0)
+            if self.closed: # detached meanwhile: leave packet to the next reader
+                get_framer(self.s).packets.insert(0, rcv)
+                break
+            hdr, msg = decode_pkt(rcv)
+            if hdr['SrcNodeId'] is None or msg['TranNbr'] is None:
+                continue
+
+            # Respond to incoming hello command packets
+            if hdr['HiProtoCode'] == 0 and msg['MsgType'] == 0x09:
+                try:
+                    send(self.s, pkt_hello_response(hdr['SrcNodeId'], hdr['DstNodeId'], msg['TranNbr']))
+                except socket.error:
+                    break
+                continue
+
+            key = (hdr['SrcNodeId'], msg['TranNbr'])
+            self.cond.acquire()
+            try:
+                self.mailboxes.setdefault(key, []).append((hdr, msg))
+                self.arrivals.append(key)
+                # discard oldest unclaimed packets
+                while len(self.arrivals) > self.max_unclaimed:
+                    old = self.arrivals.pop(0)
+                    if self.mailboxes.get(old):
+                        del self.mailboxes[old][0]
+                        if not self.mailboxes[old]:
+                            del self.mailboxes[old]
+                        self.dropped += 1
+                        if metrics is not None:
+                            metrics.inc('pakbus_dropped_packets_total', reason = 'unclaimed')
+                self.cond.notifyAll()
+            finally:
+                self.cond.release()
+
+        self.cond.acquire()
+        self.closed = True
+        self.cond.notifyAll()
+        self.cond.release()
+
+    #
+    # Send a packet
+    #
+    def send(self, pkt):
+        # pkt: unquoted, unframed PakBus packet (just header + message)
+        send(self.s, pkt)
+
+    #
+    # Wait for an incoming packet
+    #
+    def wait(self, SrcNodeId, DstNodeId, TranNbr, timeout = 5):
+        # SrcNodeId:    source node ID (12-bit int)
+        # DstNodeId:    destination node ID (12-bit int)
+        # TranNbr:      expected transaction number
+        # timeout:      timeout in seconds (extended by "please wait" messages)
+
+        import time
+        key = (SrcNodeId, TranNbr)
+        max_time = time.time() + timeout
+        span = tracer is not None and tracer.begin('wait', TranNbr = TranNbr)
+        holdoff = None
+        self.cond.acquire()
+        try:
+            while True:
+                box = self.mailboxes.get(key)
+                if box:
+                    hdr, msg = box.pop(0)
+                    if not box:
+                        del self.mailboxes[key]
+                    self.arrivals.remove(key)
+
+                    # ignore packets that are not for us
+                    if hdr['DstNodeId'] != DstNodeId:
+                        if metrics is not None:
+                            metrics.inc('pakbus_dropped_packets_total', reason = 'address')
+                        continue
+
+                    # Handle "please wait" packets
+                    if msg['MsgType'] == 0xa1:
+                        max_time += msg['WaitSec']
+                        if metrics is not None:
+                            metrics.pleasewait(msg)
+                        if span:
+                            if holdoff:
+                                holdoff.end()
+                            holdoff = span.tracer.begin('holdoff', WaitSec = msg['WaitSec'])
+                        continue
+
+                    # this should be the packet we are waiting for
+                    if metrics is not None:
+                        metrics.response(hdr, msg)
+                    if span:
+                        if holdoff:
+                            holdoff.end()
+                        span.end()
+                    return hdr, msg
+
+                remaining = max_time - time.time()
+                if remaining <= 0 or self.closed:
+                    if metrics is not None:
+                        metrics.timeout(SrcNodeId, TranNbr)
+                    if span:
+                        if holdoff:
+                            holdoff.end()
+                        span.end(timeout = True)
+                    return {}, {}
+                self.cond.wait(remaining)
+        finally:
+            self.cond.release()
+
+    #
+    # Send a packet and wait for the response
+    #
+    def transact(self, SrcNodeId, DstNodeId, pkt, TranNbr, timeout = 5):
+        # SrcNodeId:    node ID of the remote node (12-bit int)
+        # DstNodeId:    our own node ID (12-bit int)
+        # pkt:          command packet
+        # TranNbr:      transaction number of the command packet
+        # timeout:      timeout in seconds
+        self.send(pkt)
+        return self.wait(SrcNodeId, DstNodeId, TranNbr, timeout)
+
+    #
+    # Send several command packets at once and wait for all responses
+    #
+    def transact_many(self, SrcNodeId, DstNodeId, requests, timeout = 5):
+        # SrcNodeId:    node ID of the remote node (12-bit int)
+        # DstNodeId:    our own node ID (12-bit int)
+        # requests:     list of (pkt, TranNbr) tuples as returned by the pkt_*_cmd() functions
+        # timeout:      timeout in seconds for each response
+        #
+        # Returns a list of (hdr, msg) tuples in the order of requests
+
+        for pkt, TranNbr in requests:
+            self.send(pkt)
+        return [self.wait(SrcNodeId, DstNodeId, TranNbr, timeout) for pkt, TranNbr in requests]
+
+    #
+    # Detach from the socket and wait for the reader thread to end
+    #
+    def close(self):
+        self.closed = True
+        if dispatchers.get(self.s) is self:
+            del dispatchers[self.s]
+        if self.thread is not threading.current_thread():
+            self.thread.join()
+
+
+# Dispatchers attached to sockets
+dispatchers = weakref.WeakKeyDictionary()
+
+
+#
+# Adaptive swath size for file transfers
+#
+# AIMD policy: the swath grows by increase bytes with every acknowledged
+# packet and is halved when a response is lost. The smoothed round-trip time
+# gives the timeout for the next response, so losses are detected quickly on
+# fast links. One controller is kept per link and transfer direction (see
+# get_swath_controller()), so the learned size is reused by later transfers.
+#
+# The swath never exceeds what fits into one packet of the data logger: the
+# packet size minus the fixed fields of the upload response or download
+# command (the file name of download commands is subtracted as well). The
+# limit is packet_size unless set with set_packet_size() (e.g. from the
+# device settings of the data logger); short upload responses lower it for
+# the upload direction.
+#
+packet_size = 1000  # largest PakBus message (without header) of a CR1000 [bytes]
+swath_overhead = {
+    'upload':   7,  # MsgType, TranNbr, RespCode, FileOffset of the response
+    'download': 11, # MsgType, TranNbr, SecurityCode, Attribute, CloseFlag, FileOffset and NUL of the file name
+}
+swath_min = 0x0040  # smallest swath
+swath_max = packet_size - swath_overhead['upload']  # largest swath
+
+class SwathController(object):
+
+    def __init__(self, swath = 0x0200, minimum = swath_min, maximum = swath_max, increase = 0x0100):
+        # swath:    initial swath in bytes
+        # minimum:  smallest swath
+        # maximum:  largest swath
+        # increase: additive increase per acknowledged packet
+
+        self.swath = swath
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.srtt = None        # smoothed round-trip time [seconds]
+        self.rttvar = None      # round-trip time variation [seconds]
+        self.packets = 0        # number of requests
+        self.failures = 0       # number of lost responses
+
+    #
+    # Response received after rtt seconds
+    #
+    def success(self, rtt):
+        if self.srtt is None:
+            self.srtt, self.rttvar = rtt, rtt / 2
+        else:
+            self.rttvar += (abs(self.srtt - rtt) - self.rttvar) / 4
+            self.srtt += (rtt - self.srtt) / 8
+        self.packets += 1
+        self.swath = min(self.maximum, self.swath + self.increase)
+
+    #
+    # Lower the largest swath (e.g. to the amount of data in a short response)
+    #
+    def limit(self, maximum):
+        self.maximum = max(self.minimum, min(self.maximum, maximum))
+        self.swath = min(self.swath, self.maximum)
+
+    #
+    # Response lost
+    #
+    def failure(self):
+        self.packets += 1
+        self.failures += 1
+        self.swath = max(self.minimum, self.swath // 2)
+
+    #
+    # Timeout for the next response (at most default)
+    #
+    def timeout(self, default):
+        if self.srtt is None:
+            return default
+        return min(default, max(0.5, self.srtt + 4 * self.rttvar))
+
+    def failure_rate(self):
+        return self.packets and float(self.failures) / self.packets or 0.0
+
+
+# Swath controllers by (remote address, node ID, direction)
+swath_controllers = {}
+
+def get_swath_controller(s, DstNodeId, direction):
+    # s:         socket object
+    # DstNodeId: node ID of the data logger
+    # direction: 'upload' or 'download'
+
+    import socket
+    try:
+        peer = s.getpeername()
+    except (socket.error, AttributeError):
+        peer = None
+    key = (peer, DstNodeId, direction)
+    try:
+        return swath_controllers[key]
+    except KeyError:
+        return swath_controllers.setdefault(key, SwathController(maximum = packet_size - swath_overhead[direction]))
+
+
+#
+# Set the packet size of a data logger for the swath controllers of a link
+#
+def set_packet_size(s, DstNodeId, size):
+    # s:         socket object
+    # DstNodeId: node ID of the data logger
+    # size:      largest PakBus message (without header) of the data logger [bytes]
+
+    for direction in ('upload', 'download'):
+        control = get_swath_controller(s, DstNodeId, direction)
+        control.maximum = max(control.minimum, size - swath_overhead[direction])
+        control.swath = min(control.swath, control.maximum)
+
+
 #
 # Download a complete file
 #
-def filedownload(s, DstNodeId, SrcNodeId, FileName, FileData, SecurityCode = 0x0000, Swath = 0x0200):
+def filedownload(s, DstNodeId, SrcNodeId, FileName, FileData, SecurityCode = 0x0000, Swath = None, window = 1):
     # s:            Socket object
     # DstNodeId:    Destination node ID (12-bit int)
     # SrcNodeId:    Source node ID (12-bit int)
     # FileName:     File name as string
-    # FileData:     File data as a binary string
+    # FileData:     File data as a binary string (or bytearray, mmap, memoryview)
     # SecurityCode: 16-bit security code (optional)
-    # Swath:        Number of bytes transferred in each packet
+    # Swath:        Number of bytes transferred in each packet (None: adaptive)
+    # window:       Number of packets sent ahead of the acknowledgements
 
-    # Initialize return values
-    RespCode = 0x0e
+    RespCode, FileOffset = filedownload_window(s, DstNodeId, SrcNodeId, FileName, FileData, SecurityCode, Swath = Swath, window = window)
 
-    # Send file download command packets until whole FileData has been transferred
-    FileOffset = 0x00000000
-    TranNbr = None
-    CloseFlag = 0x00
-    while not CloseFlag:
+    return RespCode
 
-        # Check if this is the last packet
-        if FileOffset + Swath >= len(FileData):
-            CloseFlag = 0x01
 
-        # Download Swath bytes after FileOffset from FileData
-        pkt, TranNbr = pkt_filedownload_cmd(DstNodeId, SrcNodeId, FileName, FileData[FileOffset:FileOffset+Swath], FileOffset = FileOffset, TranNbr = TranNbr, CloseFlag = CloseFlag)
-        send(s, pkt)
-        hdr, msg = wait_pkt(s, DstNodeId, SrcNodeId, TranNbr)
+#
+# Download a file from the local file system
+#
+# The file is mapped into memory, so only the chunks in flight are copied.
+#
+def filedownload_path(s, DstNodeId, SrcNodeId, FileName, path, SecurityCode = 0x0000, Swath = None, window = 1):
+    # path:         name of the local file
+    # other arguments as for filedownload()
 
+    import mmap, os
+    f = open(path, 'rb')
+    try:
+        if os.fstat(f.fileno()).st_size:
+            FileData = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        else:
+            FileData = ''   # empty files cannot be mapped
         try:
-            RespCode = msg['RespCode']
-            # End loop if response code <> 0
-            if RespCode <> 0:
-                break
-            # Append file data
-            FileOffset += Swath
-        except KeyError:
-            break
+            RespCode, FileOffset = filedownload_window(s, DstNodeId, SrcNodeId, FileName, FileData, SecurityCode, Swath = Swath, window = window)
+        finally:
+            if FileData:
+                FileData.close()
+    finally:
+        f.close()
 
     return RespCode
 
 
+#
+# Download file data with several packets in flight
+#
+# Up to window file download command packets are sent before the first
+# response has arrived. Each response is matched to its chunk by FileOffset
+# and acknowledges it together with all chunks before it (the data logger
+# only accepts data in sequence). If a response is missing, or the data
+# logger rejects an offset because an earlier command was lost (RespCode
+# 0x09), the transfer is restarted with a new transaction number from the
+# last acknowledged offset (after up to retries consecutive losses, the
+# transfer is given up). Chunks are cut from FileData with buffer() slices,
+# so the file data is never copied as a whole.
+#
+# Without a fixed Swath, the chunk size and response timeout are adapted to
+# the link with a SwathController.
+#
+def filedownload_window(s, DstNodeId, SrcNodeId, FileName, FileData, SecurityCode = 0x0000, FileOffset = 0x00000000, Swath = None, window = 1, retries = 2, timeout = 5):
+    # s:            Socket object
+    # DstNodeId:    Destination node ID (12-bit int)
+    # SrcNodeId:    Source node ID (12-bit int)
+    # FileName:     File name as string
+    # FileData:     File data as a binary string (or bytearray, mmap, memoryview)
+    # SecurityCode: 16-bit security code (optional)
+    # FileOffset:   Byte offset to start at (to resume an interrupted transfer)
+    # Swath:        Number of bytes transferred in each packet (None: adaptive)
+    # window:       Number of packets sent ahead of the acknowledgements
+    # retries:      Number of restarts from the acknowledged offset after a
+    #               missing response or rejected offset
+    # timeout:      timeout for each response in seconds
+    #
+    # Returns (RespCode, FileOffset): response code of the last response
+    # (0x0e if no response was received) and offset up to which the data
+    # logger has acknowledged the file data
+
+    import socket
+    if Swath is None:
+        control = get_swath_controller(s, DstNodeId, 'download')
+    else:
+        control = None
+    transfer = DownloadWindow(DstNodeId, SrcNodeId, FileName, FileData, SecurityCode, FileOffset, Swath, window, retries, timeout, control)
+    try:
+        while not transfer.done:
+            for pkt in transfer.packets():
+                send(s, pkt)
+            hdr, msg = wait_pkt(s, DstNodeId, SrcNodeId, transfer.TranNbr, transfer.timeout())
+            transfer.receive(msg)
+    except socket.error:
+        transfer.abort()
+    return transfer.RespCode, transfer.acked
+
+
+#
+# Windowed file download (without I/O, used by filedownload_window() and
+# pakbus_async)
+#
+# While done is not set, the packets from packets() are to be sent and the
+# next response with transaction number TranNbr (or {} after timeout()
+# seconds) passed to receive(); abort() ends the transfer after a connection
+# failure. RespCode and acked give the result.
+#
+class DownloadWindow(object):
+
+    def __init__(self, DstNodeId, SrcNodeId, FileName, FileData, SecurityCode = 0x0000, FileOffset = 0x00000000, Swath = 0x0200, window = 1, retries = 2, timeout = 5, control = None):
+        # control:      SwathController adapting Swath and the timeout (optional)
+        # other arguments as for filedownload_window()
+
+        self.DstNodeId = DstNodeId
+        self.SrcNodeId = SrcNodeId
+        self.FileName = FileName
+        self.SecurityCode = SecurityCode
+        self.Swath = Swath
+        self.window = window
+        self.retries = retries
+        self.default_timeout = timeout
+        self.control = control
+        if isinstance(FileData, memoryview):
+            self.chunk = lambda beg, end: FileData[beg:end].tobytes()
+        else:
+            view = buffer(FileData)
+            self.chunk = lambda beg, end: view[beg:end]
+        self.size = len(FileData)
+
+        self.RespCode = 0x0e
+        self.acked = FileOffset # data up to this offset has been acknowledged
+        self.TranNbr = None
+        self.failures = 0       # consecutive lost responses
+        self.done = False
+        self.restart()
+
+    #
+    # (Re)start sending from the acknowledged offset
+    #
+    def restart(self):
+        self.sent = self.acked
+        self.inflight = []      # (offset, end offset, send time) of unacknowledged chunks
+        self.closed = False     # last chunk (with CloseFlag) has been sent
+
+    #
+    # Get the packets filling the window
+    #
+    def packets(self):
+        import time
+        pkts = []
+        while len(self.inflight) < self.window and not self.closed:
+            if self.control:
+                self.Swath = max(self.control.minimum, min(self.control.swath, self.control.maximum - len(self.FileName)))
+            CloseFlag = self.sent + self.Swath >= self.size and 0x01 or 0x00
+            pkt, self.TranNbr = pkt_filedownload_cmd(self.DstNodeId, self.SrcNodeId, self.FileName, self.chunk(self.sent, self.sent + self.Swath), self.SecurityCode, FileOffset = self.sent, TranNbr = self.TranNbr, CloseFlag = CloseFlag)
+            pkts.append(pkt)
+            self.inflight.append((self.sent, min(self.sent + self.Swath, self.size), time.time()))
+            self.sent = min(self.sent + self.Swath, self.size)
+            self.closed = CloseFlag
+        return pkts
+
+    #
+    # Timeout for the next response
+    #
+    def timeout(self):
+        return self.control and self.control.timeout(self.default_timeout) or self.default_timeout
+
+    #
+    # Handle response message (or {} if no response has arrived)
+    #
+    def receive(self, msg):
+        import time
+        if msg.has_key('RespCode'):
+            self.RespCode = msg['RespCode']
+            offsets = [beg for beg, end, t_sent in self.inflight]
+            if msg['FileOffset'] not in offsets:
+                return          # late response to a chunk acknowledged meanwhile
+            if self.RespCode <> 0x09:
+                if self.RespCode <> 0:
+                    self.done = True
+                    return
+                i = offsets.index(msg['FileOffset'])
+                beg, self.acked, t_sent = self.inflight[i]
+                del self.inflight[:i + 1]
+                self.failures = 0
+                if self.control:
+                    self.control.success(time.time() - t_sent)
+                self.done = self.closed and not self.inflight
+                return
+            # offset rejected: an earlier command was lost
+        else:
+            self.RespCode = 0x0e
+
+        # Response missing or offset rejected: restart with a new transaction number
+        if self.control:
+            self.control.failure()
+        if metrics is not None:
+            metrics.inc('pakbus_retries_total', transfer = 'download')
+        self.failures += 1
+        if self.failures > self.retries:
+            self.done = True
+            return
+        self.TranNbr = None
+        self.restart()
+
+    #
+    # Connection failed
+    #
+    def abort(self):
+        self.RespCode = 0x0e
+        self.done = True
+
+
 #
 # Upload a complete file
 #
-def fileupload(s, DstNodeId, SrcNodeId, FileName, SecurityCode = 0x0000):
+def fileupload(s, DstNodeId, SrcNodeId, FileName, SecurityCode = 0x0000, Swath = None, window = 1):
     # s:            Socket object
     # DstNodeId:    Destination node ID (12-bit int)
     # SrcNodeId:    Source node ID (12-bit int)
     # FileName:     File name as string
     # SecurityCode: 16-bit security code (optional)
+    # Swath:        Number of bytes requested in each packet (None: adaptive)
+    # window:       Number of read requests kept in flight (see fileupload_stream())
 
-    # Initialize return values
-    RespCode = 0x0e
-    FileData = ''
+    chunks = []
+    RespCode, FileOffset, crc = fileupload_stream(s, DstNodeId, SrcNodeId, FileName, chunks.append, SecurityCode, Swath = Swath, window = window)
 
-    # Send file upload command packets until no more data is returned
-    FileOffset = 0x00000000
-    TranNbr = None
-    while True:
+    return ''.join(chunks), RespCode
 
-        # Upload chunk from file starting at FileOffset
-        pkt, TranNbr = pkt_fileupload_cmd(DstNodeId, SrcNodeId, FileName, FileOffset = FileOffset, TranNbr = TranNbr, CloseFlag = 0x00)
-        send(s, pkt)
-        hdr, msg = wait_pkt(s, DstNodeId, SrcNodeId, TranNbr)
 
-        try:
-            RespCode = msg['RespCode']
-            # End loop if no more data is returned
-            if not msg['FileData']:
+#
+# Upload a file chunk by chunk into a file object or callback
+#
+# Each chunk is passed on as soon as it has arrived, so the file never has to
+# be held in memory. With window > 1, several read requests for consecutive
+# swaths are kept in flight (sequential read with the same transaction
+# number), which keeps the link busy on connections with long round-trip
+# times. Lost responses are requested again (up to retries consecutive
+# losses). An interrupted transfer can be resumed by calling the function
+# again with the returned FileOffset and crc.
+#
+# Without a fixed Swath, the request size and response timeout are adapted to
+# the link with a SwathController.
+#
+def fileupload_stream(s, DstNodeId, SrcNodeId, FileName, sink, SecurityCode = 0x0000, FileOffset = 0x00000000, crc = 0, Swath = None, window = 1, retries = 2, timeout = 5):
+    # s:            Socket object
+    # DstNodeId:    Destination node ID (12-bit int)
+    # SrcNodeId:    Source node ID (12-bit int)
+    # FileName:     File name as string
+    # sink:         file object (data is passed to its write() method) or
+    #               function called with each chunk of data
+    # SecurityCode: 16-bit security code (optional)
+    # FileOffset:   Byte offset to start at (to resume an interrupted transfer)
+    # crc:          CRC-32 of the data before FileOffset (to resume an interrupted transfer)
+    # Swath:        Number of bytes requested in each packet (None: adaptive)
+    # window:       Number of read requests kept in flight
+    # retries:      Number of repeated requests after a missing response
+    # timeout:      timeout for each response in seconds
+    #
+    # Returns (RespCode, FileOffset, crc): response code of the last response
+    # (0x0e if the transfer was interrupted), offset after the last byte passed
+    # to sink and running CRC-32 of all data up to this offset
+
+    import socket
+    if Swath is None:
+        control = get_swath_controller(s, DstNodeId, 'upload')
+    else:
+        control = None
+    transfer = UploadWindow(DstNodeId, SrcNodeId, FileName, sink, SecurityCode, FileOffset, crc, Swath, window, retries, timeout, control)
+    try:
+        while not transfer.done:
+            for pkt in transfer.packets():
+                send(s, pkt)
+            hdr, msg = wait_pkt(s, DstNodeId, SrcNodeId, transfer.TranNbr, transfer.timeout())
+            transfer.receive(msg)
+    except socket.error:
+        transfer.abort()
+    return transfer.result()
+
+
+#
+# Windowed file upload (without I/O, used by fileupload_stream() and
+# pakbus_async)
+#
+# While done is not set, the packets from packets() are to be sent and the
+# next response with transaction number TranNbr (or {} after timeout()
+# seconds) passed to receive(); abort() ends the transfer after a connection
+# failure. Once the transfer has ended, responses to requests still in flight
+# are collected before done is set. result() gives the result.
+#
+class UploadWindow(object):
+
+    def __init__(self, DstNodeId, SrcNodeId, FileName, sink, SecurityCode = 0x0000, FileOffset = 0x00000000, crc = 0, Swath = 0x0200, window = 1, retries = 2, timeout = 5, control = None):
+        # control:      SwathController adapting Swath and the timeout (optional)
+        # other arguments as for fileupload_stream()
+
+        self.DstNodeId = DstNodeId
+        self.SrcNodeId = SrcNodeId
+        self.FileName = FileName
+        self.write = getattr(sink, 'write', sink)
+        self.SecurityCode = SecurityCode
+        self.crc = crc
+        self.Swath = Swath
+        self.window = window
+        self.retries = retries
+        self.default_timeout = timeout
+        self.control = control
+        self.limit = None           # largest amount of data returned by the data logger
+
+        self.RespCode = 0x0e
+        self.TranNbr = newTranNbr()
+        self.written = FileOffset   # data up to this offset has been passed to sink
+        self.requested = FileOffset # next offset to request
+        self.eof = None             # end of file (once known)
+        self.pending = {}           # data received ahead of written, by offset
+        self.inflight = {}          # offset -> (swath, send time) of requests in flight
+        self.failures = 0           # consecutive lost responses
+        self.ended = False          # transfer ended, collecting late responses
+        self.done = False
+
+    #
+    # Get the read requests keeping window requests in flight
+    #
+    def packets(self):
+        import time
+        pkts = []
+        while not self.ended and len(self.inflight) < self.window and (self.eof is None or self.requested < self.eof):
+            if self.control:
+                self.Swath = self.control.swath
+            if self.limit:
+                self.Swath = min(self.Swath, self.limit)
+            pkt, self.TranNbr = pkt_fileupload_cmd(self.DstNodeId, self.SrcNodeId, self.FileName, self.SecurityCode, FileOffset = self.requested, TranNbr = self.TranNbr, CloseFlag = 0x00, Swath = self.Swath)
+            pkts.append(pkt)
+            self.inflight[self.requested] = (self.Swath, time.time())
+            self.requested += self.Swath
+        return pkts
+
+    #
+    # Timeout for the next response
+    #
+    def timeout(self):
+        if self.control and not self.ended:
+            return self.control.timeout(self.default_timeout)
+        return self.default_timeout
+
+    #
+    # Handle response message (or {} if no response has arrived)
+    #
+    def receive(self, msg):
+        import time
+        if self.ended:
+            # collect responses to requests still in flight after a complete transfer
+            if msg:
+                self.inflight.pop(msg.get('FileOffset'), None)
+            self.done = not msg or not self.inflight
+            return
+
+        if not msg.has_key('RespCode'):
+            # response lost: request everything after written again
+            self.RespCode = 0x0e
+            if self.control:
+                self.control.failure()
+            if metrics is not None:
+                metrics.inc('pakbus_retries_total', transfer = 'upload')
+            self.failures += 1
+            if self.failures > self.retries:
+                return self.end()
+            self.inflight = {}
+            self.requested = self.written
+        else:
+            self.RespCode = msg['RespCode']
+            if self.RespCode <> 0:
+                return self.end()
+            self.add(msg)
+
+        if not self.inflight and self.eof is not None and self.requested >= self.eof:
+            self.end()
+
+    #
+    # Handle response with RespCode 0
+    #
+    def add(self, msg):
+        import time, zlib
+        data = msg['FileData']
+        offset = msg['FileOffset']
+        request = self.inflight.pop(offset, None)
+        if request is None:
+            return      # late response to a request made again meanwhile
+        self.failures = 0
+        if self.control:
+            self.control.success(time.time() - request[1])
+        if not data:
+            # empty response: end of file
+            if self.eof is None or offset < self.eof:
+                self.eof = offset
+            return
+        if len(data) < request[0] and offset + len(data) < self.requested:
+            # short response (data logger limits the packet size): continue
+            # with swaths of this size directly after it
+            self.limit = len(data)
+            self.requested = offset + len(data)
+        elif self.control and len(data) == self.limit:
+            # short size confirmed (not just the end of the file): keep it
+            self.control.limit(self.limit)
+        self.pending[offset] = data
+
+        # Pass on data in sequence (overlapping parts are skipped)
+        while self.pending:
+            for offset in self.pending.keys():
+                if offset <= self.written:
+                    break
+            else:
                 break
-            # Append file data
-            FileData += msg['FileData']
-            FileOffset += len(msg['FileData'])
-        except KeyError:
-            break
+            data = self.pending.pop(offset)[self.written - offset:]
+            if data:
+                self.write(data)
+                self.crc = zlib.crc32(data, self.crc)
+                self.written += len(data)
 
-    return FileData, RespCode
+    #
+    # Connection failed
+    #
+    def abort(self):
+        self.RespCode = 0x0e
+        self.inflight = {}
+        self.end()
+
+    #
+    # End transfer
+    #
+    def end(self):
+        # Complete even if the last response was lost after the end of file was known
+        if self.eof is not None and self.written >= self.eof:
+            self.RespCode = 0
+        self.ended = True
+        self.done = self.RespCode == 0x0e or not self.inflight
+
+    #
+    # Get (RespCode, FileOffset, crc) (see fileupload_stream())
+    #
+    def result(self):
+        return self.RespCode, self.written, self.crc & 0xFFFFFFFF
 
 
 #
@@ -1445,7 +3118,7 @@ def getvalues(s, DstNodeId, SrcNodeId, TableName, Type, FieldName, Swath = 1, Se
 #
 # Collect data
 #
-def collect_data(s, DstNodeId, SrcNodeId, TableDef, TableName, FieldNames = [], CollectMode = 0x05, P1 = 1, P2 = 0, SecurityCode = 0x0000):
+def collect_data(s, DstNodeId, SrcNodeId, TableDef, TableName, FieldNames = [], CollectMode = 0x05, P1 = 1, P2 = 0, SecurityCode = 0x0000, compact = False):
     # s:            Socket object
     # DstNodeId:    Destination node ID (12-bit int)
     # SrcNodeId:    Source node ID (12-bit int)
@@ -1456,6 +3129,7 @@ def collect_data(s, DstNodeId, SrcNodeId, TableDef, TableName, FieldNames = [],
     # P1:           1st parameter used to specify what to collect (optional)
     # P2:           2nd parameter used to specify what to collect (optional)
     # SecurityCode: security code of the data logger
+    # compact:      return records as tuple rows (see record_type()) instead of dictionaries
 
     # Get table number
     tablenbr = get_TableNbr(TableDef, TableName)
@@ -1466,10 +3140,285 @@ def collect_data(s, DstNodeId, SrcNodeId, TableDef, TableName, FieldNames = [],
     tabledefsig = TableDef[tablenbr - 1]['Signature']
 
     # Convert field names to list of field numbers
-    fieldnames = FieldNames
+    fieldnbr = get_FieldNbr(TableDef, tablenbr, FieldNames)
+
+    # Send collect data request
+    pkt, TranNbr = pkt_collectdata_cmd(DstNodeId, SrcNodeId, tablenbr, tabledefsig, FieldNbr = fieldnbr, CollectMode = CollectMode, P1 = P1, P2 = P2, SecurityCode = SecurityCode)
+    send(s, pkt)
+    hdr, msg = wait_pkt(s, DstNodeId, SrcNodeId, TranNbr)
+    if msg.get('RespCode') == 0x07:
+        raise TableDefMismatch('table definition of %s does not match data logger' % TableName)
+    RecData, MoreRecsExist = parse_collectdata(msg['RecData'], TableDef, FieldNbr = fieldnbr, compact = compact)
+    complete_fragments(s, DstNodeId, SrcNodeId, TableDef, RecData, fieldnbr, SecurityCode, compact = compact)
+
+    # Return parsed record data and flag if more records exist
+    return RecData, MoreRecsExist
+
+
+#
+# Collect records as a stream
+#
+# Generator yielding the records of a table (dictionaries as in the 'RecFrag'
+# lists of parse_collectdata()) or lists of up to batch records. While the
+# data logger sets MoreRecsExist, the request for the following records is
+# sent before the records of the current response are handed out, so the
+# transfer continues while the caller processes them. Only one response is
+# held in memory at a time.
+#
+# The first request uses CollectMode, P1 and P2 as given; follow-up requests
+# continue after the last record received:
+#
+# - 0x03 (all), 0x04 (from P1) and 0x05 (most recent P1): 0x04 from the next record
+# - 0x06 (from P1 up to P2): 0x06 from the next record up to P2
+# - 0x07 (time range P1 to P2): 0x07 from the time after the last record up to P2
+#
+def iter_records(s, DstNodeId, SrcNodeId, TableDef, TableName, FieldNames = [], CollectMode = 0x03, P1 = 0, P2 = 0, SecurityCode = 0x0000, batch = None, timeout = 5, compact = False):
+    # s:            Socket object
+    # DstNodeId:    Destination node ID (12-bit int)
+    # SrcNodeId:    Source node ID (12-bit int)
+    # TableDef:     Table definition structure (as returned by parse_tabledef())
+    # TableName:    Table name as string
+    # FieldNames:   List of field names (empty to collect all), order does not matter
+    # CollectMode:  Collection mode code (0x03 ... 0x07)
+    # P1:           1st parameter used to specify what to collect (optional)
+    # P2:           2nd parameter used to specify what to collect (optional)
+    # SecurityCode: security code of the data logger
+    # batch:        yield lists of up to batch records instead of single records
+    # timeout:      timeout for each response in seconds
+    # compact:      yield records as tuple rows (see record_type()) instead of dictionaries
+
+    if CollectMode not in (0x03, 0x04, 0x05, 0x06, 0x07):
+        raise StandardError('collect mode 0x%.2x not supported for streaming' % CollectMode)
+
+    tablenbr = get_TableNbr(TableDef, TableName)
+    if tablenbr is None:
+        raise StandardError('table %s not found in table definition' % TableName)
+    tabledefsig = TableDef[tablenbr - 1]['Signature']
+    fieldnbr = get_FieldNbr(TableDef, tablenbr, FieldNames)
+
+    pkt, TranNbr = pkt_collectdata_cmd(DstNodeId, SrcNodeId, tablenbr, tabledefsig, FieldNbr = fieldnbr, CollectMode = CollectMode, P1 = P1, P2 = P2, SecurityCode = SecurityCode)
+    send(s, pkt)
+
+    pending = []
+    while TranNbr is not None:
+        hdr, msg = wait_pkt(s, DstNodeId, SrcNodeId, TranNbr, timeout)
+        if not msg.has_key('RespCode'):
+            raise StandardError('no response to collect data request for table %s' % TableName)
+        if msg['RespCode'] == 0x07:
+            raise TableDefMismatch('table definition of %s does not match data logger' % TableName)
+        RecData, MoreRecsExist = parse_collectdata(msg['RecData'], TableDef, FieldNbr = fieldnbr, compact = compact)
+        complete_fragments(s, DstNodeId, SrcNodeId, TableDef, RecData, fieldnbr, SecurityCode, timeout, compact)
+
+        records = []
+        for frag in RecData:
+            if frag['NbrOfRecs']:
+                records.extend(frag['RecFrag'])
+
+        # Request following records before handing out the current ones
+        TranNbr = None
+        if MoreRecsExist and records:
+            last = records[-1]
+            if CollectMode == 0x06:
+                P1 = last['RecNbr'] + 1
+            elif CollectMode == 0x07:
+                P1 = divmod(last['TimeOfRec'][0] * 1000000000 + last['TimeOfRec'][1] + 1, 1000000000)
+            else:
+                CollectMode = 0x04
+                P1 = last['RecNbr'] + 1
+            pkt, TranNbr = pkt_collectdata_cmd(DstNodeId, SrcNodeId, tablenbr, tabledefsig, FieldNbr = fieldnbr, CollectMode = CollectMode, P1 = P1, P2 = P2, SecurityCode = SecurityCode)
+            send(s, pkt)
+
+        if batch is None:
+            for record in records:
+                yield record
+        else:
+            pending.extend(records)
+            while len(pending) >= batch:
+                yield pending[:batch]
+                del pending[:batch]
+
+    if pending:
+        yield pending
+
+
+#
+# Replace record fragments in RecData by complete records
+#
+# Records that do not fit into one packet are sent as fragments (IsOffset
+# set). Each fragmented record in RecData is completed with collect_fragments()
+# and replaced by a fragment dictionary holding this single record.
+#
+def complete_fragments(s, DstNodeId, SrcNodeId, TableDef, RecData, FieldNbr = [], SecurityCode = 0x0000, timeout = 5, compact = False):
+    # s:            Socket object
+    # DstNodeId:    Destination node ID (12-bit int)
+    # SrcNodeId:    Source node ID (12-bit int)
+    # TableDef:     Table definition structure (as returned by parse_tabledef())
+    # RecData:      record data as returned by parse_collectdata() (modified in place)
+    # FieldNbr:     list of field numbers used for the request
+    # SecurityCode: security code of the data logger
+    # timeout:      timeout for each response in seconds
+    # compact:      build tuple rows (see record_type()) instead of dictionaries
+
+    for i in range(len(RecData)):
+        frag = RecData[i]
+        if frag['IsOffset']:
+            record = collect_fragments(s, DstNodeId, SrcNodeId, TableDef, frag, FieldNbr, SecurityCode, timeout, compact)
+            RecData[i] = complete_frag(frag, record)
+    return RecData
+
+
+#
+# Fragment dictionary holding the complete record of a fragmented record
+#
+def complete_frag(frag, record):
+    return {'TableNbr': frag['TableNbr'], 'TableName': frag['TableName'], 'BegRecNbr': frag['BegRecNbr'], 'IsOffset': 0, 'NbrOfRecs': 1, 'ByteOffset': None, 'RecFrag': [record]}
+
+
+#
+# Collect all fragments of a record and decode it (see RecordAssembler)
+#
+def collect_fragments(s, DstNodeId, SrcNodeId, TableDef, frag, FieldNbr = [], SecurityCode = 0x0000, timeout = 5, compact = False):
+    # s:            Socket object
+    # DstNodeId:    Destination node ID (12-bit int)
+    # SrcNodeId:    Source node ID (12-bit int)
+    # TableDef:     Table definition structure (as returned by parse_tabledef())
+    # frag:         first fragment (element of parse_collectdata() output with IsOffset set)
+    # FieldNbr:     list of field numbers used for the request
+    # SecurityCode: security code of the data logger
+    # timeout:      timeout for each response in seconds
+    # compact:      return a tuple row (see record_type()) instead of a dictionary
+    #
+    # Returns the record as a dictionary like the records in 'RecFrag'
+
+    assembler = RecordAssembler(TableDef, frag, FieldNbr, compact)
+    while not assembler.complete:
+        pkt, TranNbr = assembler.request(DstNodeId, SrcNodeId, SecurityCode)
+        send(s, pkt)
+        hdr, msg = wait_pkt(s, DstNodeId, SrcNodeId, TranNbr, timeout)
+        assembler.receive(msg)
+    return assembler.record()
+
+
+#
+# Reassemble a fragmented record (without I/O, used by collect_fragments()
+# and pakbus_async)
+#
+# The fragments are copied into a buffer of the full record size; the missing
+# byte ranges are requested with CollectMode 0x08 (P1: record number, P2: byte
+# offset). The record image consists of the NSec time stamp followed by the
+# field values. While complete is not set, the packet from request() is to be
+# sent and its response (or {} on timeout) passed to receive().
+#
+class RecordAssembler(object):
+
+    def __init__(self, TableDef, frag, FieldNbr = [], compact = False):
+        # TableDef:     Table definition structure (as returned by parse_tabledef())
+        # frag:         first fragment (element of parse_collectdata() output with IsOffset set)
+        # FieldNbr:     list of field numbers used for the request
+        # compact:      return a tuple row (see record_type()) instead of a dictionary
+
+        self.TableDef = TableDef
+        self.TableNbr = frag['TableNbr']
+        self.TableName = frag['TableName']
+        self.RecNbr = frag['BegRecNbr']
+        self.FieldNbr = FieldNbr
+        self.compact = compact
+        self.codec, self.slices = record_layout(TableDef[self.TableNbr - 1], FieldNbr, True)
+        if self.codec.size is None:
+            raise StandardError('cannot reassemble records of table %s with variable-length fields' % self.TableName)
+
+        self.image = bytearray(self.codec.size)
+        self.received = 0       # number of bytes received in sequence
+        self.unusable = 0       # number of consecutive responses without new data
+        self.complete = False
+        self.add(frag)
+
+    #
+    # Copy fragment into the record image if it continues the received bytes
+    #
+    def add(self, frag):
+        if frag is not None and frag['IsOffset'] and frag['BegRecNbr'] == self.RecNbr and frag['ByteOffset'] == self.received and frag['RecFrag']:
+            data = frag['RecFrag'][:self.codec.size - self.received]
+            self.image[self.received:self.received + len(data)] = data
+            self.received += len(data)
+            self.unusable = 0
+            self.complete = self.received == self.codec.size
+        else:
+            self.unusable += 1
+            if self.unusable > 3:
+                raise StandardError('cannot collect record %d of table %s (%d of %d bytes received)' % (self.RecNbr, self.TableName, self.received, self.codec.size))
+
+    #
+    # Get (packet, TranNbr) requesting the next fragment
+    #
+    def request(self, DstNodeId, SrcNodeId, SecurityCode = 0x0000):
+        return pkt_collectdata_cmd(DstNodeId, SrcNodeId, self.TableNbr, self.TableDef[self.TableNbr - 1]['Signature'], FieldNbr = self.FieldNbr, CollectMode = 0x08, P1 = self.RecNbr, P2 = self.received, SecurityCode = SecurityCode)
+
+    #
+    # Handle response message to request()
+    #
+    def receive(self, msg):
+        if msg.get('RespCode') == 0x07:
+            raise TableDefMismatch('table definition of %s does not match data logger' % self.TableName)
+        frag = None
+        if msg.has_key('RecData'):
+            RecData, MoreRecsExist = parse_collectdata(msg['RecData'], self.TableDef, FieldNbr = self.FieldNbr)
+            if RecData:
+                frag = RecData[0]
+        self.add(frag)
+
+    #
+    # Decode complete record (buffer() slices are strings, no copy of the image)
+    #
+    def record(self):
+        values, size = self.codec.decode(buffer(self.image))
+        if self.compact:
+            cls, make = record_type(self.TableDef[self.TableNbr - 1], self.FieldNbr, True)
+            return make(self.RecNbr, values[0], values)
+        record = {'RecNbr': self.RecNbr, 'TimeOfRec': values[0], 'Fields': {}}
+        for fieldname, beg, end in self.slices:
+            record['Fields'][fieldname] = values[beg:end]
+        return record
+
+
+#
+# Raised by collect_data() if the data logger rejects the table definition signature
+#
+class TableDefMismatch(StandardError):
+    pass
+
+
+#
+# Get programming statistics
+#
+def getprogstat(s, DstNodeId, SrcNodeId, SecurityCode = 0x0000):
+    # s:            Socket object
+    # DstNodeId:    Destination node ID (12-bit int)
+    # SrcNodeId:    Source node ID (12-bit int)
+    # SecurityCode: 16-bit security code (optional)
+
+    pkt, TranNbr = pkt_getprogstat_cmd(DstNodeId, SrcNodeId, SecurityCode)
+    send(s, pkt)
+    hdr, msg = wait_pkt(s, DstNodeId, SrcNodeId, TranNbr)
+
+    return msg
+
+
+#
+# Get list of field numbers from field names
+#
+def get_FieldNbr(tabledef, TableNbr, FieldNames):
+    # tabledef:   table definition structure (as returned by parse_tabledef)
+    # TableNbr:   table number
+    # FieldNames: list of field names (empty for all fields), order does not matter
+
+    fieldnames = list(FieldNames)
     fieldnbr = []
-    for fn in range(1, len(TableDef[tablenbr-1]['Fields']) + 1):
-        fieldname = TableDef[tablenbr - 1]['Fields'][fn - 1]['FieldName']
+    for fn in range(1, len(tabledef[TableNbr - 1]['Fields']) + 1):
+        # End loop if field name list is empty
+        if not fieldnames:
+            break
+        fieldname = tabledef[TableNbr - 1]['Fields'][fn - 1]['FieldName']
         try:
             idx = fieldnames.index(fieldname)
         except ValueError:
@@ -1478,21 +3427,12 @@ def collect_data(s, DstNodeId, SrcNodeId, TableDef, TableName, FieldNames = [],
             # Add field number to list and remove field name from search list
             fieldnbr.append(fn)
             del fieldnames[idx]
-        # End loop if field name list is empty
-        if not fieldnames:
-            break
+
     # Issue warning if field names could not be resolved
     if fieldnames:
-        raise Warning('field names not resolved for table %s: %s' % (TableName, fieldnames))
-
-    # Send collect data request
-    pkt, TranNbr = pkt_collectdata_cmd(DstNodeId, SrcNodeId, tablenbr, tabledefsig, FieldNbr = fieldnbr, CollectMode = CollectMode, P1 = P1, P2 = P2, SecurityCode = SecurityCode)
-    send(s, pkt)
-    hdr, msg = wait_pkt(s, DstNodeId, SrcNodeId, TranNbr)
-    RecData, MoreRecsExist = parse_collectdata(msg['RecData'], TableDef, FieldNbr = fieldnbr)
+        raise Warning('field names not resolved for table %s: %s' % (tabledef[TableNbr - 1]['Header']['TableName'], fieldnames))
 
-    # Return parsed record data and flag if more records exist
-    return RecData, MoreRecsExist
+    return fieldnbr
 
 
 #
@@ -1563,4 +3503,1107 @@ def ping_node(s, DstNodeId, SrcNodeId):
     send(s, pkt)
     hdr, msg = wait_pkt(s, DstNodeId, SrcNodeId, TranNbr)
 
-    return msg
\ No newline at end of file
+    return msg
+
+################################################################################
+#
+# Table definition cache
+#
+################################################################################
+
+#
+# On-disk cache of parsed table definitions
+#
+# Table definitions are stored per data logger serial number and program
+# signature (ProgSig), so a single get programming statistics transaction is
+# enough to find out whether a cached definition is still valid; the .TDF file
+# is only uploaded after a program change:
+#
+#   cache = pakbus.TableDefCache('/var/cache/pakbus')
+#   tabledef = cache.get(s, NodeId, MyNodeId)
+#   RecData, MoreRecsExist = cache.collect_data(s, NodeId, MyNodeId, 'Meteo')
+#
+# Both methods take the same leading arguments as the helper functions, so they
+# can also be used with Session.call().
+#
+class TableDefCache(object):
+
+    magic = 'PBTDF1'
+
+    def __init__(self, directory):
+        # directory: cache directory (created if it does not exist)
+
+        import os
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.memory = {}    # (SerialNbr, ProgSig) -> table definition
+        self.current = {}   # (DstNodeId, SrcNodeId) -> key of last validated entry
+        self.hits = 0
+        self.misses = 0
+
+    def filename(self, key):
+        import os
+        SerialNbr, ProgSig = key
+        serial = ''.join([c for c in SerialNbr if c.isalnum()]) or 'unknown'
+        return os.path.join(self.directory, 'tdf_%s_%.4x.bin' % (serial, ProgSig))
+
+    #
+    # Load table definition from disk (None if missing or unreadable)
+    #
+    def load(self, key):
+        import marshal, zlib
+        try:
+            f = open(self.filename(key), 'rb')
+            try:
+                data = f.read()
+            finally:
+                f.close()
+            if data[:len(self.magic)] != self.magic:
+                return None
+            return marshal.loads(zlib.decompress(data[len(self.magic):]))
+        except (IOError, EOFError, ValueError, TypeError, zlib.error):
+            return None
+
+    #
+    # Store table definition on disk (written to a temporary file and renamed)
+    #
+    def store(self, key, tabledef):
+        import marshal, os, zlib
+        filename = self.filename(key)
+        tmpname = '%s.%d-%x.tmp' % (filename, os.getpid(), id(tabledef))
+        f = open(tmpname, 'wb')
+        try:
+            f.write(self.magic + zlib.compress(marshal.dumps(tabledef, 2), 9))
+        finally:
+            f.close()
+        try:
+            os.rename(tmpname, filename)
+        except OSError:
+            os.remove(filename) # rename does not replace files on Windows
+            os.rename(tmpname, filename)
+
+    #
+    # Forget table definition (e.g. after a signature mismatch)
+    #
+    def invalidate(self, key):
+        import os
+        self.memory.pop(key, None)
+        for k, v in self.current.items():
+            if v == key:
+                del self.current[k]
+        try:
+            os.remove(self.filename(key))
+        except OSError:
+            pass
+
+    #
+    # Get table definition of the running program
+    #
+    def get(self, s, DstNodeId, SrcNodeId, SecurityCode = 0x0000):
+        # s:            Socket object
+        # DstNodeId:    Destination node ID (12-bit int)
+        # SrcNodeId:    Source node ID (12-bit int)
+        # SecurityCode: 16-bit security code (optional)
+
+        msg = getprogstat(s, DstNodeId, SrcNodeId, SecurityCode)
+        if msg.get('RespCode') != 0:
+            raise StandardError('cannot get programming statistics from node 0x%.3x' % DstNodeId)
+        key = (msg['SerialNbr'], msg['ProgSig'])
+        self.current[(DstNodeId, SrcNodeId)] = key
+
+        tabledef = self.memory.get(key)
+        if tabledef is None:
+            tabledef = self.load(key)
+        if tabledef is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            FileData, RespCode = fileupload(s, DstNodeId, SrcNodeId, '.TDF', SecurityCode)
+            if RespCode != 0 or not FileData:   # failed or interrupted: never cache partial files
+                raise StandardError('cannot upload table definitions from node 0x%.3x (RespCode 0x%.2x)' % (DstNodeId, RespCode))
+            tabledef = parse_tabledef(FileData)
+            self.store(key, tabledef)
+        self.memory[key] = tabledef
+        return tabledef
+
+    #
+    # Collect data with a cached table definition
+    #
+    # The table definition is re-fetched once if the data logger reports a
+    # table definition signature mismatch.
+    #
+    def collect_data(self, s, DstNodeId, SrcNodeId, TableName, FieldNames = [], CollectMode = 0x05, P1 = 1, P2 = 0, SecurityCode = 0x0000, compact = False):
+        # arguments as for collect_data(), but without TableDef
+
+        key = self.current.get((DstNodeId, SrcNodeId))
+        tabledef = key and self.memory.get(key)
+        if tabledef is None:
+            tabledef = self.get(s, DstNodeId, SrcNodeId, SecurityCode)
+        try:
+            return collect_data(s, DstNodeId, SrcNodeId, tabledef, TableName, FieldNames, CollectMode, P1, P2, SecurityCode, compact)
+        except TableDefMismatch:
+            self.invalidate(self.current[(DstNodeId, SrcNodeId)])
+            tabledef = self.get(s, DstNodeId, SrcNodeId, SecurityCode)
+            return collect_data(s, DstNodeId, SrcNodeId, tabledef, TableName, FieldNames, CollectMode, P1, P2, SecurityCode, compact)
+
+
+################################################################################
+#
+# Persistent sessions
+#
+################################################################################
+
+#
+# PakBus session with one data logger
+#
+# A session owns the socket, the node IDs, the security code and its own
+# transaction counter. The connection is opened on first use and kept open
+# between calls; a background thread refreshes the link with hello (or
+# DevConfig control "refresh session timer") packets while the session is idle.
+# If a call fails with a socket error, the connection is re-established and the
+# call is repeated:
+#
+#   session = pakbus.Session('10.0.0.10', DstNodeId = 0x001)
+#   print session.getvalues('Public', 'IEEE4B', 'Batt_Volt')
+#   ...
+#   session.close()
+#
+# All helper functions are available as methods without the socket and node ID
+# arguments.
+#
+class Session(object):
+
+    def __init__(self, Host, Port = 6785, DstNodeId = 0x001, SrcNodeId = 0x802, SecurityCode = 0x0000, Timeout = 30, keepalive = 60, devconfig = False, retries = 1):
+        # Host:         Remote host IP address or name
+        # Port:         TCP/IP port
+        # DstNodeId:    Node ID of the data logger (12-bit int)
+        # SrcNodeId:    Our own node ID (12-bit int)
+        # SecurityCode: 16-bit security code
+        # Timeout:      Socket timeout [seconds]
+        # keepalive:    Refresh link after this many idle seconds (0 to disable)
+        # devconfig:    Refresh with DevConfig control Action 0x04 instead of hello
+        # retries:      Number of reconnects after a failed call
+
+        self.Host = Host
+        self.Port = Port
+        self.DstNodeId = DstNodeId
+        self.SrcNodeId = SrcNodeId
+        self.SecurityCode = SecurityCode
+        self.Timeout = Timeout
+        self.keepalive = keepalive
+        self.devconfig = devconfig
+        self.retries = retries
+
+        self.s = None
+        self.transact = 0           # Running 8-bit transaction counter
+        self.lock = threading.RLock()
+        self.last_used = 0
+        self.reconnects = 0
+        self.stopped = threading.Event()
+        self.keepalive_thread = None
+
+    #
+    # Generate new 8-bit transaction number (never 0)
+    #
+    def newTranNbr(self):
+        self.transact = self.transact % 0xFF + 1
+        return self.transact
+
+    #
+    # Run function with the session socket, node IDs and transaction counter
+    #
+    def run(self, func, *args, **kwargs):
+        import time
+        previous = getattr(tran_local, 'session', None)
+        tran_local.session = self
+        try:
+            return func(self.s, self.DstNodeId, self.SrcNodeId, *args, **kwargs)
+        finally:
+            tran_local.session = previous
+            self.last_used = time.time()
+
+    #
+    # Open connection and say hello
+    #
+    def connect(self):
+        import socket
+        self.lock.acquire()
+        try:
+            if self.s is not None:
+                return
+            self.s = open_socket(self.Host, self.Port, self.Timeout)
+            if self.s is None:
+                raise socket.error('cannot connect to %s:%d' % (self.Host, self.Port))
+            if not self.run(ping_node):
+                self.drop()
+                raise socket.timeout('no reply from PakBus node 0x%.3x' % self.DstNodeId)
+            if self.keepalive and self.keepalive_thread is None:
+                self.keepalive_thread = threading.Thread(target = self.keepalive_loop)
+                self.keepalive_thread.setDaemon(True)
+                self.keepalive_thread.start()
+        finally:
+            self.lock.release()
+
+    #
+    # Close socket without saying goodbye
+    #
+    def drop(self):
+        if self.s is not None:
+            try:
+                self.s.close()
+            except:
+                pass
+            self.s = None
+
+    #
+    # Say goodbye and close connection (the session can still be used again)
+    #
+    def disconnect(self):
+        import socket
+        self.lock.acquire()
+        try:
+            if self.s is not None:
+                try:
+                    send(self.s, pkt_bye_cmd(self.DstNodeId, self.SrcNodeId))
+                except socket.error:
+                    pass
+            self.drop()
+        finally:
+            self.lock.release()
+
+    #
+    # Close session for good
+    #
+    def close(self):
+        self.stopped.set()
+        self.disconnect()
+
+    #
+    # Call helper function, reconnecting on socket errors
+    #
+    def call(self, func, *args, **kwargs):
+        # func: helper function taking (s, DstNodeId, SrcNodeId, ...) arguments
+        import socket
+        self.lock.acquire()
+        try:
+            attempt = 0
+            while True:
+                try:
+                    if self.s is None:
+                        self.connect()
+                    return self.run(func, *args, **kwargs)
+                except socket.error:
+                    self.drop()
+                    if attempt >= self.retries:
+                        raise
+                    attempt += 1
+                    self.reconnects += 1
+                    if metrics is not None:
+                        metrics.inc('pakbus_reconnects_total')
+        finally:
+            self.lock.release()
+
+    #
+    # Transaction function for call()/run(): send command packet created by
+    # pkt_func and wait for the response
+    #
+    def transaction(self, pkt_func, *args, **kwargs):
+        # pkt_func: packet function taking (DstNodeId, SrcNodeId, ...) arguments
+        #           and returning (pkt, TranNbr)
+        def transact(s, DstNodeId, SrcNodeId):
+            pkt, TranNbr = pkt_func(DstNodeId, SrcNodeId, *args, **kwargs)
+            send(s, pkt)
+            return wait_pkt(s, DstNodeId, SrcNodeId, TranNbr)
+        return transact
+
+    def transact_pkt(self, pkt_func, *args, **kwargs):
+        return self.call(self.transaction(pkt_func, *args, **kwargs))
+
+    #
+    # Refresh link if the session has been idle for the keepalive interval
+    #
+    def refresh(self):
+        import time, socket
+        if not self.lock.acquire(False):
+            return  # session is busy anyway
+        try:
+            if self.s is None or time.time() - self.last_used < self.keepalive:
+                return
+            try:
+                if self.devconfig:
+                    hdr, msg = self.run(self.transaction(pkt_devconfig_control_cmd, 0x04, self.SecurityCode))
+                else:
+                    msg = self.run(ping_node)
+            except socket.error:
+                msg = None
+            if not msg:
+                self.drop() # reconnect on next call
+        finally:
+            self.lock.release()
+
+    def keepalive_loop(self):
+        while not self.stopped.isSet():
+            self.stopped.wait(self.keepalive / 4.0)
+            if not self.stopped.isSet():
+                self.refresh()
+
+    #
+    # Helper functions as methods
+    #
+    def ping_node(self):
+        return self.call(ping_node)
+
+    def clock_sync(self, min_adjust = 0.1, max_adjust = 3, offset = 0):
+        return self.call(clock_sync, self.SecurityCode, min_adjust, max_adjust, offset)
+
+    def getvalues(self, TableName, Type, FieldName, Swath = 1):
+        # unlike getvalues(), socket errors are passed on to call() for a reconnect
+        hdr, msg = self.transact_pkt(pkt_getvalues_cmd, TableName, Type, FieldName, Swath, self.SecurityCode)
+        try:
+            return parse_values(msg_getvalues_response(msg)['Values'], Type)
+        except:
+            return [ None ]
+
+    def fileupload(self, FileName, Swath = None, window = 1):
+        return self.call(fileupload, FileName, self.SecurityCode, Swath, window)
+
+    def fileupload_stream(self, FileName, sink, FileOffset = 0x00000000, crc = 0, Swath = None, window = 1):
+        return self.call(fileupload_stream, FileName, sink, self.SecurityCode, FileOffset, crc, Swath, window)
+
+    def filedownload(self, FileName, FileData, Swath = None, window = 1):
+        return self.call(filedownload, FileName, FileData, self.SecurityCode, Swath, window)
+
+    def filedownload_path(self, FileName, path, Swath = None, window = 1):
+        return self.call(filedownload_path, FileName, path, self.SecurityCode, Swath, window)
+
+    def collect_data(self, TableDef, TableName, FieldNames = [], CollectMode = 0x05, P1 = 1, P2 = 0, compact = False):
+        return self.call(collect_data, TableDef, TableName, FieldNames, CollectMode, P1, P2, self.SecurityCode, compact)
+
+    def getprogstat(self):
+        return self.call(getprogstat, self.SecurityCode)
+
+    def filecontrol(self, FileName, FileCmd):
+        hdr, msg = self.transact_pkt(pkt_filecontrol_cmd, FileName, FileCmd, self.SecurityCode)
+        return msg
+
+    def devconfig_get_settings(self, BeginSettingId = None, EndSettingId = None):
+        hdr, msg = self.transact_pkt(pkt_devconfig_get_settings_cmd, BeginSettingId, EndSettingId, self.SecurityCode)
+        return msg
+
+    def devconfig_set_settings(self, Settings):
+        hdr, msg = self.transact_pkt(pkt_devconfig_set_settings_cmd, Settings, self.SecurityCode)
+        return msg
+
+    def devconfig_control(self, Action = 0x04):
+        hdr, msg = self.transact_pkt(pkt_devconfig_control_cmd, Action, self.SecurityCode)
+        return msg
+
+
+#
+# Pool of sessions with a limit on concurrent connections per host
+#
+# Several data loggers behind one NL115 share a single host address; the pool
+# hands out at most max_per_host sessions for each host at a time and keeps
+# returned sessions connected for reuse:
+#
+#   pool = pakbus.SessionPool(max_per_host = 1, keepalive = 60)
+#   session = pool.get('10.0.0.10', DstNodeId = 0x001)
+#   try:
+#       session.collect_data(...)
+#   finally:
+#       pool.put(session)
+#
+class SessionPool(object):
+
+    def __init__(self, max_per_host = 1, **options):
+        # max_per_host: maximum number of sessions per host
+        # options:      further arguments for new Session objects
+
+        self.max_per_host = max_per_host
+        self.options = options
+        self.cond = threading.Condition()
+        self.idle = {}      # (Host, Port, DstNodeId, SrcNodeId) -> list of idle sessions
+        self.count = {}     # Host -> number of existing sessions
+
+    #
+    # Get session (waits until the host has a free slot)
+    #
+    def get(self, Host, Port = 6785, DstNodeId = 0x001, SrcNodeId = 0x802, SecurityCode = None, timeout = None):
+        # Host, Port, DstNodeId, SrcNodeId: as for Session
+        # SecurityCode: 16-bit security code (default: pool option)
+        # timeout:      maximum time to wait for a free slot [seconds]
+
+        import time
+        key = (Host, Port, DstNodeId, SrcNodeId)
+        if timeout is not None:
+            max_time = time.time() + timeout
+        self.cond.acquire()
+        try:
+            while True:
+                if self.idle.get(key):
+                    session = self.idle[key].pop()
+                    break
+                if self.count.get(Host, 0) < self.max_per_host:
+                    self.count[Host] = self.count.get(Host, 0) + 1
+                    session = Session(Host, Port, DstNodeId, SrcNodeId, **self.options)
+                    break
+                # free a slot held by an idle session to another node on this host
+                for other in self.idle.keys():
+                    if other[0] == Host and self.idle[other]:
+                        self.idle[other].pop().close()
+                        self.count[Host] -= 1
+                        break
+                else:
+                    if timeout is None:
+                        self.cond.wait()
+                    elif time.time() < max_time:
+                        self.cond.wait(max_time - time.time())
+                    else:
+                        raise StandardError('no free session for host %s' % Host)
+        finally:
+            self.cond.release()
+
+        if SecurityCode is not None:
+            session.SecurityCode = SecurityCode
+        return session
+
+    #
+    # Return session to the pool
+    #
+    def put(self, session, discard = False):
+        # session: session obtained with get()
+        # discard: close session instead of keeping it for reuse
+
+        self.cond.acquire()
+        try:
+            if discard:
+                session.close()
+                self.count[session.Host] -= 1
+            else:
+                key = (session.Host, session.Port, session.DstNodeId, session.SrcNodeId)
+                self.idle.setdefault(key, []).append(session)
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+    #
+    # Close all idle sessions
+    #
+    def close(self):
+        self.cond.acquire()
+        try:
+            for sessions in self.idle.values():
+                for session in sessions:
+                    session.close()
+                    self.count[session.Host] -= 1
+            self.idle = {}
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+
+################################################################################
+#
+# Metrics
+#
+################################################################################
+
+#
+# Registry of counters and histograms for PakBus traffic
+#
+# While a registry is enabled, send(), recv(), wait_pkt(), the dispatchers and
+# the helper functions record:
+#
+# - pakbus_packets_sent_total, pakbus_packets_received_total: packets by message
+# - pakbus_bytes_sent_total, pakbus_bytes_received_total: packet bytes before
+#   quoting (header, message and signature nullifier)
+# - pakbus_wire_bytes_sent_total, pakbus_wire_bytes_received_total: bytes on
+#   the link (quoted and framed)
+# - pakbus_response_seconds: histogram of the time from sending a command to
+#   its response (including "please wait" holdoffs), by response message
+# - pakbus_pleasewait_total, pakbus_pleasewait_seconds_total: "please wait"
+#   messages and announced holdoff, by delayed command
+# - pakbus_timeouts_total: transactions without response
+# - pakbus_signature_failures_total: frames with bad signature
+# - pakbus_dropped_packets_total: packets nobody waited for, by reason
+# - pakbus_retries_total: repeated file transfer requests after lost responses
+# - pakbus_reconnects_total: Session reconnects
+# - pakbus_calls_total, pakbus_call_errors_total, pakbus_call_seconds: calls,
+#   exceptions and duration of the helper functions (open_socket, ping_node,
+#   clock_sync, collect_data, ...)
+#
+#   m = pakbus.enable_metrics()
+#   ...
+#   print m.to_prometheus()
+#   pakbus.disable_metrics()
+#
+# Without an enabled registry, every instrumentation point costs a single test
+# of the global metrics variable.
+#
+latency_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Message names used as metric labels by (HiProtoCode, MsgType)
+msg_names = {
+    (0, 0x09): 'hello',
+    (0, 0x89): 'hello_response',
+    (0, 0x0d): 'bye',
+    (0, 0x0f): 'devconfig_get_settings',
+    (0, 0x8f): 'devconfig_get_settings_response',
+    (0, 0x10): 'devconfig_set_settings',
+    (0, 0x90): 'devconfig_set_settings_response',
+    (0, 0x13): 'devconfig_control',
+    (0, 0x93): 'devconfig_control_response',
+    (1, 0x09): 'collectdata',
+    (1, 0x89): 'collectdata_response',
+    (1, 0x17): 'clock',
+    (1, 0x97): 'clock_response',
+    (1, 0x18): 'getprogstat',
+    (1, 0x98): 'getprogstat_response',
+    (1, 0x1a): 'getvalues',
+    (1, 0x9a): 'getvalues_response',
+    (1, 0x1c): 'filedownload',
+    (1, 0x9c): 'filedownload_response',
+    (1, 0x1d): 'fileupload',
+    (1, 0x9d): 'fileupload_response',
+    (1, 0x1e): 'filecontrol',
+    (1, 0x9e): 'filecontrol_response',
+    (1, 0xa1): 'pleasewait',
+}
+
+def msg_name(HiProtoCode, MsgType):
+    try:
+        return msg_names[(HiProtoCode, MsgType)]
+    except KeyError:
+        return '%d/0x%.2x' % (HiProtoCode, MsgType)
+
+# Help texts for the Prometheus output
+metric_help = {
+    'pakbus_packets_sent_total': 'PakBus packets sent',
+    'pakbus_packets_received_total': 'PakBus packets received with valid signature',
+    'pakbus_bytes_sent_total': 'Packet bytes sent before quoting',
+    'pakbus_bytes_received_total': 'Packet bytes received after unquoting',
+    'pakbus_wire_bytes_sent_total': 'Bytes sent on the link (quoted and framed)',
+    'pakbus_wire_bytes_received_total': 'Bytes received from the link (quoted and framed)',
+    'pakbus_response_seconds': 'Time from command to response',
+    'pakbus_pleasewait_total': 'Please wait messages received',
+    'pakbus_pleasewait_seconds_total': 'Holdoff announced by please wait messages',
+    'pakbus_timeouts_total': 'Transactions without response',
+    'pakbus_signature_failures_total': 'Frames with bad signature',
+    'pakbus_dropped_packets_total': 'Received packets not matching any transaction',
+    'pakbus_retries_total': 'File transfer requests repeated after a lost response',
+    'pakbus_reconnects_total': 'Session reconnects after socket errors',
+    'pakbus_calls_total': 'Helper function calls',
+    'pakbus_call_errors_total': 'Helper function calls ending with an exception',
+    'pakbus_call_seconds': 'Duration of helper function calls',
+}
+
+class Metrics(object):
+
+    def __init__(self, buckets = latency_buckets):
+        # buckets: upper bounds of the histogram buckets [seconds]
+
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.reset()
+
+    #
+    # Clear all values
+    #
+    def reset(self):
+        self.lock.acquire()
+        try:
+            self.counters = {}      # (name, labels) -> value
+            self.histograms = {}    # (name, labels) -> [bucket counts, sum, count]
+            self.sent_times = {}    # (DstNodeId, TranNbr) -> send times of unanswered commands
+        finally:
+            self.lock.release()
+
+    #
+    # Generic registry API
+    #
+    def inc(self, name, value = 1, **labels):
+        # name:   counter name
+        # value:  increment
+        # labels: label values
+        key = (name, tuple(sorted(labels.items())))
+        self.lock.acquire()
+        try:
+            self.counters[key] = self.counters.get(key, 0) + value
+        finally:
+            self.lock.release()
+
+    def observe(self, name, value, **labels):
+        # name:   histogram name
+        # value:  observed value
+        # labels: label values
+        import bisect
+        key = (name, tuple(sorted(labels.items())))
+        self.lock.acquire()
+        try:
+            try:
+                h = self.histograms[key]
+            except KeyError:
+                h = self.histograms[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            h[0][bisect.bisect_left(self.buckets, value)] += 1
+            h[1] += value
+            h[2] += 1
+        finally:
+            self.lock.release()
+
+    def value(self, name, **labels):
+        # Returns the value of a counter (0 if never incremented)
+        return self.counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def histogram(self, name, **labels):
+        # Returns dictionary with 'buckets' ((upper bound, count) pairs, not
+        # cumulative, last bound None for +Inf), 'sum' and 'count', or None
+        try:
+            counts, total, count = self.histograms[(name, tuple(sorted(labels.items())))]
+        except KeyError:
+            return None
+        return {'buckets': zip(self.buckets + (None, ), counts), 'sum': total, 'count': count}
+
+    #
+    # Instrumentation points
+    #
+    def packet_sent(self, pkt, frame):
+        # pkt:   unquoted packet without signature nullifier
+        # frame: quoted and framed packet
+        import time
+        if len(pkt) < 10:
+            return
+        HiProtoCode = ord(pkt[4]) >> 4
+        MsgType = ord(pkt[8])
+        message = msg_name(HiProtoCode, MsgType)
+        self.lock.acquire()
+        try:
+            for name, value in (('pakbus_packets_sent_total', 1), ('pakbus_bytes_sent_total', len(pkt) + 2), ('pakbus_wire_bytes_sent_total', len(frame))):
+                key = (name, (('message', message), ))
+                self.counters[key] = self.counters.get(key, 0) + value
+            # remember send time of commands that expect a response
+            if not MsgType & 0x80 and (HiProtoCode, MsgType) != (0, 0x0d):
+                if len(self.sent_times) > 4096:
+                    self.sent_times.clear()     # responses lost without timeout
+                key = ((ord(pkt[4]) & 0xF) << 8 | ord(pkt[5]), ord(pkt[9]))
+                self.sent_times.setdefault(key, []).append(time.time())
+        finally:
+            self.lock.release()
+
+    def packet_received(self, pkt):
+        # pkt: unquoted packet including signature nullifier
+        if len(pkt) < 10:
+            return
+        message = msg_name(ord(pkt[4]) >> 4, ord(pkt[8]))
+        self.lock.acquire()
+        try:
+            for name, value in (('pakbus_packets_received_total', 1), ('pakbus_bytes_received_total', len(pkt))):
+                key = (name, (('message', message), ))
+                self.counters[key] = self.counters.get(key, 0) + value
+        finally:
+            self.lock.release()
+
+    def response(self, hdr, msg):
+        # hdr, msg: decoded response packet
+        import time
+        self.lock.acquire()
+        try:
+            times = self.sent_times.get((hdr['SrcNodeId'], msg['TranNbr']))
+            if not times:
+                return
+            t_sent = times.pop(0)
+            if not times:
+                del self.sent_times[(hdr['SrcNodeId'], msg['TranNbr'])]
+        finally:
+            self.lock.release()
+        self.observe('pakbus_response_seconds', time.time() - t_sent, message = msg_name(hdr['HiProtoCode'], msg['MsgType']))
+
+    def pleasewait(self, msg):
+        # msg: decoded please wait message
+        command = msg_name(1, msg['CmdMsgType'])
+        self.inc('pakbus_pleasewait_total', command = command)
+        self.inc('pakbus_pleasewait_seconds_total', msg['WaitSec'], command = command)
+
+    def timeout(self, SrcNodeId, TranNbr):
+        # SrcNodeId: node ID of the remote node
+        # TranNbr:   transaction number of the unanswered command
+        self.lock.acquire()
+        try:
+            self.sent_times.pop((SrcNodeId, TranNbr), None)
+        finally:
+            self.lock.release()
+        self.inc('pakbus_timeouts_total')
+
+    def call(self, name, seconds, error):
+        # name:    helper function name
+        # seconds: duration of the call
+        # error:   call ended with an exception
+        self.inc('pakbus_calls_total', helper = name)
+        if error:
+            self.inc('pakbus_call_errors_total', helper = name)
+        self.observe('pakbus_call_seconds', seconds, helper = name)
+
+    #
+    # Dumps
+    #
+    def snapshot(self):
+        # Returns dictionary with lists of counters and histograms (as for JSON)
+        self.lock.acquire()
+        try:
+            counters = [{'name': name, 'labels': dict(labels), 'value': value} for (name, labels), value in sorted(self.counters.items())]
+            histograms = [{'name': name, 'labels': dict(labels), 'buckets': zip(self.buckets + (None, ), counts), 'sum': total, 'count': count}
+                for (name, labels), (counts, total, count) in sorted(self.histograms.items())]
+        finally:
+            self.lock.release()
+        return {'counters': counters, 'histograms': histograms}
+
+    def to_json(self):
+        import json
+        return json.dumps(self.snapshot(), sort_keys = True)
+
+    def to_prometheus(self):
+        # Returns the values in the Prometheus text exposition format
+
+        def labelstr(labels, extra = ()):
+            labels = list(labels) + list(extra)
+            if not labels:
+                return ''
+            return '{%s}' % ','.join(['%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in labels])
+
+        def number(value):
+            if isinstance(value, float):
+                return repr(value)
+            return str(value)
+
+        lines = []
+        snap = self.snapshot()
+        typed = {}
+        for c in snap['counters']:
+            if not typed.has_key(c['name']):
+                typed[c['name']] = True
+                lines.append('# HELP %s %s' % (c['name'], metric_help.get(c['name'], c['name'])))
+                lines.append('# TYPE %s counter' % c['name'])
+            lines.append('%s%s %s' % (c['name'], labelstr(sorted(c['labels'].items())), number(c['value'])))
+        for h in snap['histograms']:
+            if not typed.has_key(h['name']):
+                typed[h['name']] = True
+                lines.append('# HELP %s %s' % (h['name'], metric_help.get(h['name'], h['name'])))
+                lines.append('# TYPE %s histogram' % h['name'])
+            labels = sorted(h['labels'].items())
+            cumulative = 0
+            for bound, count in h['buckets']:
+                cumulative += count
+                le = bound is None and '+Inf' or number(float(bound))
+                lines.append('%s_bucket%s %d' % (h['name'], labelstr(labels, [('le', le)]), cumulative))
+            lines.append('%s_sum%s %s' % (h['name'], labelstr(labels), repr(h['sum'])))
+            lines.append('%s_count%s %d' % (h['name'], labelstr(labels), h['count']))
+        return '\n'.join(lines) + '\n'
+
+
+#
+# Enable recording of metrics, return the registry
+#
+def enable_metrics(registry = None):
+    # registry: Metrics object to record into (default: new registry)
+    global metrics
+    if registry is None:
+        registry = Metrics()
+    metrics = registry
+    return registry
+
+
+#
+# Stop recording metrics, return the registry used so far
+#
+def disable_metrics():
+    global metrics
+    registry, metrics = metrics, None
+    return registry
+
+
+################################################################################
+#
+# Tracing
+#
+################################################################################
+
+#
+# Recorder of nested trace spans
+#
+# While a tracer is enabled, the stages of a transaction are recorded as spans
+# with start time, duration and byte counts:
+#
+# - the helper functions (open_socket, ping_node, collect_data, ...); for
+#   iter_records, one span per resumption of the generator (argument part),
+#   so the time the consumer spends between the records is not included
+# - encode:       pkt_collectdata_cmd()
+# - quote_sign:   signature nullifier, quoting and framing (frame_pkt())
+# - send:         socket send
+# - wait:         wait_pkt() or Dispatcher.wait(), with a holdoff span for
+#                 the time after each "please wait" message
+# - read:         socket read
+# - unquote_sign: unquoting and signature check of the data read (Framer.feed())
+# - decode_pkt:   decode_pkt()
+# - parse_collectdata: parse_collectdata()
+#
+# Spans are nested per thread: ending a span also ends its children that are
+# still open (e.g. after an exception). The result can be written as Chrome
+# trace-event JSON and opened in chrome://tracing or Perfetto:
+#
+#   t = pakbus.enable_tracing()
+#   RecData, MoreRecsExist = pakbus.collect_data(s, NodeId, MyNodeId, tabledef, 'Meteo')
+#   t.write('collect.json')
+#
+class Span(object):
+
+    def __init__(self, tracer, name, args, start):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+        self.start = start
+        self.tid = threading.current_thread().ident
+        self.done = False
+
+    #
+    # End span, adding further arguments (e.g. byte counts)
+    #
+    def end(self, **args):
+        self.tracer.end(self, args)
+
+
+class Tracer(object):
+
+    def __init__(self, max_events = 1000000):
+        # max_events: maximum number of recorded spans (later ones are counted in dropped)
+
+        import time
+        self.max_events = max_events
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.time = getattr(time, 'monotonic', time.time)
+        self.reset()
+
+    #
+    # Discard all recorded spans
+    #
+    def reset(self):
+        self.lock.acquire()
+        try:
+            self.events = []
+            self.threads = {}   # thread ID -> thread name
+            self.dropped = 0
+            self.origin = self.time()
+            self.last = 0.0
+        finally:
+            self.lock.release()
+
+    #
+    # Microseconds since reset() (never decreasing, even if the system clock is set back)
+    #
+    def clock(self):
+        t = (self.time() - self.origin) * 1e6
+        self.lock.acquire()
+        if t < self.last:
+            t = self.last
+        else:
+            self.last = t
+        self.lock.release()
+        return t
+
+    def stack(self):
+        try:
+            return self.local.stack
+        except AttributeError:
+            self.local.stack = []
+            return self.local.stack
+
+    #
+    # Start a span in the current thread
+    #
+    def begin(self, name, **args):
+        # name: span name
+        # args: arguments shown with the span
+        span = Span(self, name, args, self.clock())
+        self.stack().append(span)
+        return span
+
+    #
+    # End a span (and its open children)
+    #
+    def end(self, span, args = {}):
+        t = self.clock()
+        stack = self.stack()
+        if span in stack:
+            while stack[-1] is not span:
+                child = stack.pop()
+                self.record(child, t, {'unfinished': True})
+            stack.pop()
+        self.record(span, t, args)
+
+    #
+    # Drop a span without recording it
+    #
+    def discard(self, span):
+        stack = self.stack()
+        if span in stack:
+            stack.remove(span)
+        span.done = True
+
+    #
+    # Record a point in time (e.g. a timeout)
+    #
+    def instant(self, name, **args):
+        self.add({'name': name, 'cat': 'pakbus', 'ph': 'i', 's': 't', 'ts': self.clock(), 'tid': threading.current_thread().ident, 'args': args})
+
+    def record(self, span, t, args):
+        if span.done:
+            return
+        span.done = True
+        span.args.update(args)
+        self.add({'name': span.name, 'cat': 'pakbus', 'ph': 'X', 'ts': span.start, 'dur': t - span.start, 'tid': span.tid, 'args': span.args})
+
+    def add(self, event):
+        self.lock.acquire()
+        try:
+            if len(self.events) >= self.max_events:
+                self.dropped += 1
+                return
+            self.events.append(event)
+            if not self.threads.has_key(event['tid']):
+                self.threads[event['tid']] = threading.current_thread().getName()
+        finally:
+            self.lock.release()
+
+    #
+    # Recorded spans as Chrome trace-event structure
+    #
+    def to_chrome(self):
+        import os
+        pid = os.getpid()
+        self.lock.acquire()
+        try:
+            events = [dict(event, pid = pid) for event in self.events]
+            for tid, name in self.threads.items():
+                events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': name}})
+        finally:
+            self.lock.release()
+        return {'traceEvents': events, 'displayTimeUnit': 'ms', 'otherData': {'dropped': self.dropped}}
+
+    #
+    # Write recorded spans as Chrome trace-event JSON file
+    #
+    def write(self, filename):
+        import json
+        f = open(filename, 'w')
+        try:
+            json.dump(self.to_chrome(), f)
+        finally:
+            f.close()
+
+
+#
+# Enable tracing, return the tracer
+#
+def enable_tracing(recorder = None):
+    # recorder: Tracer object to record into (default: new tracer)
+    global tracer
+    if recorder is None:
+        recorder = Tracer()
+    tracer = recorder
+    return recorder
+
+
+#
+# Stop tracing, return the tracer used so far
+#
+def disable_tracing():
+    global tracer
+    recorder, tracer = tracer, None
+    return recorder
+
+
+#
+# Instrumented helper functions
+#
+# The helpers are replaced by wrappers that record calls, errors and duration
+# while metrics are enabled and a span for each call while tracing.
+#
+def instrument(name, func):
+    # name: helper name used as label
+    # func: helper function
+    def wrapper(*args, **kwargs):
+        if metrics is None and tracer is None:
+            return func(*args, **kwargs)
+        return instrumented_call(name, func, args, kwargs)
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    wrapper.func = func
+    return wrapper
+
+#
+# Call helper function, record its duration (generators: until exhausted)
+#
+def instrumented_call(name, func, args, kwargs):
+    import time, types
+    registry = metrics
+    span = tracer is not None and tracer.begin(name)
+    t0 = time.time()
+    try:
+        result = func(*args, **kwargs)
+    except:
+        instrumented_end(name, registry, span, t0, True)
+        raise
+    if isinstance(result, types.GeneratorType):
+        if span:
+            span.tracer.discard(span)
+        return instrumented_generator(name, result, registry, span and span.tracer, t0)
+    instrumented_end(name, registry, span, t0, False)
+    return result
+
+#
+# Generator spans only cover the resumptions (pushed and popped around each
+# next()), so they stay nested even if generators are interleaved
+#
+def instrumented_generator(name, gen, registry, recorder, t0):
+    error = True
+    try:
+        try:
+            part = 0
+            while True:
+                span = recorder and recorder.begin(name, part = part)
+                try:
+                    item = gen.next()
+                except StopIteration:
+                    if span:
+                        span.end()
+                    break
+                except:
+                    if span:
+                        span.end(error = True)
+                    raise
+                if span:
+                    span.end()
+                part += 1
+                yield item
+            error = False
+        except GeneratorExit:   # closed by the consumer
+            error = False
+            gen.close()
+            raise
+    finally:
+        instrumented_end(name, registry, None, t0, error)
+
+def instrumented_end(name, registry, span, t0, error):
+    import time
+    if registry is not None:
+        registry.call(name, time.time() - t0, error)
+    if span:
+        if error:
+            span.end(error = True)
+        else:
+            span.end()
+
+for _name in ('open_socket', 'ping_node', 'clock_sync', 'getvalues', 'getprogstat', 'collect_data', 'iter_records',
+              'fileupload', 'fileupload_stream', 'filedownload', 'filedownload_path'):
+    globals()[_name] = instrument(_name, globals()[_name])
+del _name
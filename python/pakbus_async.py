@@ -0,0 +1,739 @@
+#
+# Event-driven PakBus client for many concurrent logger connections
+#
+# Licensed under the GNU General Public License
+#
+# A single select() loop drives any number of non-blocking PakBus connections.
+# Transactions are written as generator coroutines that yield futures, e.g.
+#
+#   def poll(client):
+#       yield client.connect()
+#       msg = yield client.ping_node()
+#       RecData, MoreRecsExist = yield client.collect_data(TableDef, 'Public')
+#       raise pakbus_async.Return(RecData)
+#
+#   loop = pakbus_async.Loop()
+#   tasks = [loop.spawn(poll(pakbus_async.Client(loop, host, 6785, NodeId, MyNodeId))) for host in hosts]
+#   results = loop.run_until_complete(loop.gather(tasks))
+#
+# Coroutines may yield other coroutines (to call them), futures (to wait for
+# them) and return values with "raise Return(value)". Every transaction has its
+# own timeout; tasks can be cancelled with Task.cancel().
+#
+
+
+#
+# Global imports
+#
+import errno
+import heapq
+import select
+import socket
+import time
+import types
+
+import pakbus
+
+
+#
+# Exceptions
+#
+class Return(Exception):
+    # Return a value from a coroutine
+    def __init__(self, value = None):
+        Exception.__init__(self)
+        self.value = value
+
+class Cancelled(Exception):
+    # Raised inside a coroutine when its task is cancelled
+    pass
+
+
+################################################################################
+#
+# Futures and tasks
+#
+################################################################################
+
+#
+# Result of an operation that completes later
+#
+class Future(object):
+
+    def __init__(self):
+        self.done = False
+        self.result = None
+        self.exception = None
+        self.callbacks = []
+        self.on_cancel = []     # functions called when the future is cancelled
+
+    def set_result(self, result):
+        if not self.done:
+            self.done = True
+            self.result = result
+            self.run_callbacks()
+
+    def set_exception(self, exception):
+        if not self.done:
+            self.done = True
+            self.exception = exception
+            self.run_callbacks()
+
+    def add_callback(self, func):
+        # func: function called with the future as its only argument when done
+        if self.done:
+            func(self)
+        else:
+            self.callbacks.append(func)
+
+    def cancel(self):
+        if not self.done:
+            for func in self.on_cancel:
+                func()
+            self.set_exception(Cancelled())
+
+    def run_callbacks(self):
+        callbacks, self.callbacks = self.callbacks, []
+        for func in callbacks:
+            func(self)
+
+    #
+    # Get result (raise exception if the operation failed)
+    #
+    def get(self):
+        if self.exception is not None:
+            raise self.exception
+        return self.result
+
+
+#
+# Coroutine running on an event loop
+#
+class Task(Future):
+
+    def __init__(self, loop, coro):
+        # loop: event loop
+        # coro: generator object
+
+        Future.__init__(self)
+        self.loop = loop
+        self.stack = [coro]     # stack of nested coroutines
+        self.waiting = None     # future the task is waiting for
+        loop.call_soon(self.step, None, None)
+
+    #
+    # Run coroutine until it waits for a future or ends
+    #
+    def step(self, value, exception):
+        while self.stack:
+            coro = self.stack[-1]
+            try:
+                if exception is not None:
+                    exc, exception = exception, None
+                    yielded = coro.throw(exc)
+                else:
+                    yielded = coro.send(value)
+            except StopIteration:
+                self.stack.pop()
+                value = None
+                continue
+            except Return, ret:
+                self.stack.pop()
+                value = ret.value
+                continue
+            except Exception, exc:
+                self.stack.pop()
+                value, exception = None, exc
+                continue
+
+            if isinstance(yielded, types.GeneratorType): # call nested coroutine
+                self.stack.append(yielded)
+                value = None
+            elif isinstance(yielded, Future):           # wait for future
+                self.waiting = yielded
+                yielded.add_callback(self.wakeup)
+                return
+            elif isinstance(yielded, list):             # wait for several futures
+                self.waiting = self.loop.gather(yielded)
+                self.waiting.add_callback(self.wakeup)
+                return
+            else:
+                value, exception = None, TypeError('coroutine yielded %r' % (yielded, ))
+
+        # Coroutine finished
+        if exception is not None:
+            self.set_exception(exception)
+        else:
+            self.set_result(value)
+
+    def wakeup(self, future):
+        if future is self.waiting:
+            self.waiting = None
+            self.step(future.result, future.exception)
+
+    #
+    # Cancel task: raises Cancelled inside the coroutine
+    #
+    def cancel(self):
+        if self.done:
+            return
+        if self.waiting is not None:
+            self.waiting.cancel()
+        else:
+            self.loop.call_soon(self.step, None, Cancelled())
+
+
+################################################################################
+#
+# Event loop
+#
+################################################################################
+
+#
+# Timer handle
+#
+class Timer(object):
+
+    def __init__(self, when, func, args):
+        self.when = when
+        self.func = func
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+#
+# select() based event loop
+#
+class Loop(object):
+
+    def __init__(self):
+        self.ready = []         # list of (function, arguments) to call next
+        self.timers = []        # heap of (time, sequence number, Timer)
+        self.sequence = 0
+        self.connections = {}   # file descriptor -> Connection
+
+    def call_soon(self, func, *args):
+        self.ready.append((func, args))
+
+    def call_later(self, delay, func, *args):
+        # Returns a Timer that can be cancelled
+        timer = Timer(time.time() + delay, func, args)
+        self.sequence += 1
+        heapq.heappush(self.timers, (timer.when, self.sequence, timer))
+        return timer
+
+    #
+    # Future that completes after delay seconds
+    #
+    def sleep(self, delay):
+        future = Future()
+        timer = self.call_later(delay, future.set_result, None)
+        future.on_cancel.append(timer.cancel)
+        return future
+
+    #
+    # Start coroutine as a new task
+    #
+    def spawn(self, coro):
+        return Task(self, coro)
+
+    #
+    # Future that completes when all futures are done (result: list of results)
+    #
+    # Failed futures contribute their exception object to the result list.
+    #
+    def gather(self, futures):
+        gathered = Future()
+        futures = list(futures)
+        results = [None] * len(futures)
+        remaining = [len(futures)]
+
+        def done(future, i):
+            if future.exception is not None:
+                results[i] = future.exception
+            else:
+                results[i] = future.result
+            remaining[0] -= 1
+            if not remaining[0]:
+                gathered.set_result(results)
+
+        def cancel():
+            for future in futures:
+                future.cancel()
+
+        gathered.on_cancel.append(cancel)
+        if not futures:
+            gathered.set_result(results)
+        for i in range(len(futures)):
+            futures[i].add_callback(lambda future, i = i: done(future, i))
+        return gathered
+
+    #
+    # Run loop until future (or coroutine) is done and return its result
+    #
+    def run_until_complete(self, future):
+        if isinstance(future, types.GeneratorType):
+            future = self.spawn(future)
+        while not future.done:
+            self.run_once()
+        return future.get()
+
+    #
+    # Run one iteration of the loop
+    #
+    def run_once(self):
+
+        # Run ready callbacks
+        ready, self.ready = self.ready, []
+        for func, args in ready:
+            func(*args)
+
+        # Wait for I/O until the next timer is due
+        if self.ready:
+            timeout = 0
+        elif self.timers:
+            timeout = max(0, self.timers[0][0] - time.time())
+        else:
+            timeout = None
+        if self.connections:
+            rlist = self.connections.values()
+            wlist = [conn for conn in rlist if conn.wants_write()]
+            try:
+                r, w, x = select.select(rlist, wlist, [], timeout)
+            except select.error, e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                r, w = [], []
+            for conn in w:
+                if conn.sock is not None:
+                    conn.handle_write()
+            for conn in r:
+                if conn.sock is not None:
+                    conn.handle_read()
+        elif timeout:
+            time.sleep(timeout)
+
+        # Run due timers
+        now = time.time()
+        while self.timers and self.timers[0][0] <= now:
+            when, seq, timer = heapq.heappop(self.timers)
+            if not timer.cancelled:
+                timer.func(*timer.args)
+
+
+################################################################################
+#
+# PakBus connection
+#
+################################################################################
+
+#
+# Non-blocking connection to a PakBus port
+#
+class Connection(object):
+
+    def __init__(self, loop, Host, Port = 6785, Timeout = 30):
+        # loop:     event loop
+        # Host:     Remote host IP address or name
+        # Port:     TCP/IP port (defaults to 6785)
+        # Timeout:  Connect timeout in seconds
+
+        self.loop = loop
+        self.framer = pakbus.Framer(None)
+        self.outbuf = ''
+        self.pending = {}       # (SrcNodeId, TranNbr) -> (future, DstNodeId, timer)
+        self.held = {}          # (SrcNodeId, TranNbr) -> (DstNodeId, responses nobody waited for)
+        self.closing = False    # close once the output buffer has been sent
+        self.dropped = 0        # number of unmatched packets
+        self.connected = Future()
+        self.sock = None
+
+        af, socktype, proto, canonname, sa = socket.getaddrinfo(Host, Port, socket.AF_UNSPEC, socket.SOCK_STREAM)[0]
+        self.sock = socket.socket(af, socktype, proto)
+        self.sock.setblocking(0)
+        err = self.sock.connect_ex(sa)
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            self.close(socket.error(err, errno.errorcode.get(err, 'connect failed')))
+            return
+        self.connecting = True
+        self.loop.connections[self.sock.fileno()] = self
+        self.connect_timer = loop.call_later(Timeout, self.close, socket.timeout('connect timed out'))
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def wants_write(self):
+        return self.connecting or self.outbuf
+
+    #
+    # Queue packet for sending
+    #
+    def send(self, pkt):
+        # pkt: unquoted, unframed PakBus packet (just header + message)
+        if self.sock is None:
+            raise socket.error('connection closed')
+        self.outbuf += pakbus.frame_pkt(pkt)
+
+    #
+    # Send packet and return future for the response (hdr, msg)
+    #
+    # On timeout, the future's result is ({}, {}) as for pakbus.wait_pkt()
+    #
+    def transact(self, SrcNodeId, DstNodeId, pkt, TranNbr, timeout = 5):
+        # SrcNodeId:    node ID of the remote node (12-bit int)
+        # DstNodeId:    our own node ID (12-bit int)
+        # pkt:          command packet
+        # TranNbr:      transaction number of the command packet
+        # timeout:      timeout in seconds
+
+        try:
+            self.send(pkt)
+        except socket.error, e:
+            future = Future()
+            future.set_exception(e)
+            return future
+        return self.wait(SrcNodeId, DstNodeId, TranNbr, timeout)
+
+    #
+    # Return future for the next response (hdr, msg) to a transaction
+    #
+    # Responses to held transactions (see hold()) that arrived before are
+    # returned first. On timeout, the future's result is ({}, {}).
+    #
+    def wait(self, SrcNodeId, DstNodeId, TranNbr, timeout = 5):
+        # arguments as for transact()
+
+        future = Future()
+        key = (SrcNodeId, TranNbr)
+        if self.sock is None:
+            future.set_exception(socket.error('connection closed'))
+            return future
+        if self.held.get(key, (None, []))[1]:
+            future.set_result(self.held[key][1].pop(0))
+            return future
+        timer = self.loop.call_later(timeout, self.expire, key, future)
+        self.pending[key] = (future, DstNodeId, timer)
+
+        def cancel():
+            if self.pending.get(key, (None, ))[0] is future:
+                self.pending[key][2].cancel()
+                del self.pending[key]
+        future.on_cancel.append(cancel)
+        return future
+
+    #
+    # Keep responses to a transaction that arrive while nobody waits for them
+    # (several packets in flight with the same transaction number)
+    #
+    def hold(self, SrcNodeId, DstNodeId, TranNbr):
+        self.held.setdefault((SrcNodeId, TranNbr), (DstNodeId, []))
+
+    def release(self, SrcNodeId, TranNbr):
+        self.held.pop((SrcNodeId, TranNbr), None)
+
+    def expire(self, key, future):
+        if self.pending.get(key, (None, ))[0] is future:
+            del self.pending[key]
+            if pakbus.metrics is not None:
+                pakbus.metrics.timeout(*key)
+            future.set_result(({}, {}))
+
+    def handle_write(self):
+        if self.connecting:
+            err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                self.close(socket.error(err, errno.errorcode.get(err, 'connect failed')))
+                return
+            self.connecting = False
+            self.connect_timer.cancel()
+            self.connected.set_result(self)
+        if self.outbuf:
+            try:
+                sent = self.sock.send(self.outbuf)
+            except socket.error, e:
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    self.close(e)
+                return
+            self.outbuf = self.outbuf[sent:]
+        if self.closing and not self.outbuf:
+            self.close()
+
+    def handle_read(self):
+        try:
+            data = self.sock.recv(65536)
+        except socket.error, e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self.close(e)
+            return
+        if not data:
+            self.close(socket.error('connection closed by remote host'))
+            return
+        self.framer.feed(data)
+        packets, self.framer.packets = self.framer.packets, []
+        for rcv in packets:
+            self.dispatch(rcv)
+
+    #
+    # Route received packet to the waiting transaction
+    #
+    def dispatch(self, rcv):
+        hdr, msg = pakbus.decode_pkt(rcv)
+        if hdr['SrcNodeId'] is None or msg['TranNbr'] is None:
+            return
+
+        # Respond to incoming hello command packets
+        if hdr['HiProtoCode'] == 0 and msg['MsgType'] == 0x09:
+            self.send(pakbus.pkt_hello_response(hdr['SrcNodeId'], hdr['DstNodeId'], msg['TranNbr']))
+            return
+
+        key = (hdr['SrcNodeId'], msg['TranNbr'])
+        if key not in self.pending and self.held.get(key, (None, ))[0] == hdr['DstNodeId']:
+            if msg['MsgType'] != 0xa1:
+                if pakbus.metrics is not None:
+                    pakbus.metrics.response(hdr, msg)
+                self.held[key][1].append((hdr, msg))
+            return
+        if key not in self.pending or self.pending[key][1] != hdr['DstNodeId']:
+            self.dropped += 1
+            if pakbus.metrics is not None:
+                pakbus.metrics.inc('pakbus_dropped_packets_total', reason = 'transaction')
+            return
+        future, DstNodeId, timer = self.pending[key]
+
+        # Handle "please wait" packets
+        if msg['MsgType'] == 0xa1:
+            timer.cancel()
+            timer = self.loop.call_later(timer.when - time.time() + msg['WaitSec'], self.expire, key, future)
+            self.pending[key] = (future, DstNodeId, timer)
+            if pakbus.metrics is not None:
+                pakbus.metrics.pleasewait(msg)
+            return
+
+        timer.cancel()
+        del self.pending[key]
+        if pakbus.metrics is not None:
+            pakbus.metrics.response(hdr, msg)
+        future.set_result((hdr, msg))
+
+    #
+    # Close connection once all queued packets have been sent (at the latest
+    # after timeout seconds)
+    #
+    def shutdown(self, timeout = 5):
+        if self.sock is None:
+            return
+        self.closing = True
+        if not self.connecting:
+            self.handle_write()
+        if self.sock is not None:
+            if self.outbuf or self.connecting:
+                self.loop.call_later(timeout, self.close)
+            else:
+                self.close()
+
+    #
+    # Close connection, failing all pending transactions
+    #
+    def close(self, exception = None):
+        if exception is None:
+            exception = socket.error('connection closed')
+        if self.sock is not None:
+            self.loop.connections.pop(self.sock.fileno(), None)
+            self.sock.close()
+            self.sock = None
+        self.connecting = False
+        self.connected.set_exception(exception)
+        self.held = {}
+        pending, self.pending = self.pending, {}
+        for future, DstNodeId, timer in pending.values():
+            timer.cancel()
+            future.set_exception(exception)
+
+
+################################################################################
+#
+# PakBus client: coroutine versions of the pakbus utility functions
+#
+################################################################################
+
+class Client(object):
+
+    def __init__(self, loop, Host, Port = 6785, DstNodeId = 0x001, SrcNodeId = 0x802, SecurityCode = 0x0000, Timeout = 30):
+        # loop:         event loop
+        # Host:         Remote host IP address or name
+        # Port:         TCP/IP port (defaults to 6785)
+        # DstNodeId:    Node ID of the data logger (12-bit int)
+        # SrcNodeId:    Our own node ID (12-bit int)
+        # SecurityCode: 16-bit security code
+        # Timeout:      Connect timeout in seconds
+
+        self.loop = loop
+        self.Host = Host
+        self.Port = Port
+        self.DstNodeId = DstNodeId
+        self.SrcNodeId = SrcNodeId
+        self.SecurityCode = SecurityCode
+        self.Timeout = Timeout
+        self.conn = None
+
+    #
+    # Open connection
+    #
+    def connect(self):
+        self.conn = Connection(self.loop, self.Host, self.Port, self.Timeout)
+        yield self.conn.connected
+
+    #
+    # Send command packet and wait for response
+    #
+    def transact(self, pkt, TranNbr, timeout = 5):
+        return self.conn.transact(self.DstNodeId, self.SrcNodeId, pkt, TranNbr, timeout)
+
+    #
+    # Check if remote host is available (see pakbus.ping_node)
+    #
+    def ping_node(self):
+        pkt, TranNbr = pakbus.pkt_hello_cmd(self.DstNodeId, self.SrcNodeId)
+        hdr, msg = yield self.transact(pkt, TranNbr)
+        raise Return(msg)
+
+    #
+    # Synchronize data logger clock with local clock (see pakbus.clock_sync)
+    #
+    def clock_sync(self, min_adjust = 0.1, max_adjust = 3, offset = 0):
+        td = []
+        for j in range(10):
+            pkt, TranNbr = pakbus.pkt_clock_cmd(self.DstNodeId, self.SrcNodeId, SecurityCode = self.SecurityCode)
+            t1 = time.time()
+            hdr, msg = yield self.transact(pkt, TranNbr)
+            t2 = time.time()
+            if not msg.has_key('Time'):
+                break
+            logtime = pakbus.nsec_to_time(msg['Time']) - offset
+            td.append(logtime - t1 + (t2 - t1) / 2)
+
+        tdiff = pakbus.mean_tdiff(td)
+        adjust = pakbus.clock_adjustment(tdiff, min_adjust, max_adjust)
+        if adjust:
+            pkt, TranNbr = pakbus.pkt_clock_cmd(self.DstNodeId, self.SrcNodeId, pakbus.time_to_nsec(adjust, epoch = 0), self.SecurityCode)
+            yield self.transact(pkt, TranNbr)
+        raise Return((tdiff, adjust))
+
+    #
+    # Get field value from table (see pakbus.getvalues)
+    #
+    def getvalues(self, TableName, Type, FieldName, Swath = 1):
+        pkt, TranNbr = pakbus.pkt_getvalues_cmd(self.DstNodeId, self.SrcNodeId, TableName, Type, FieldName, Swath, self.SecurityCode)
+        hdr, msg = yield self.transact(pkt, TranNbr)
+        try:
+            values = pakbus.parse_values(msg['Values'], Type, Swath)
+        except KeyError:
+            values = [ None ]
+        raise Return(values)
+
+    #
+    # Upload a complete file (see pakbus.fileupload)
+    #
+    def fileupload(self, FileName, Swath = None, window = 1):
+        chunks = []
+        RespCode, FileOffset, crc = yield self.fileupload_stream(FileName, chunks.append, Swath = Swath, window = window)
+        raise Return((''.join(chunks), RespCode))
+
+    #
+    # Upload a file chunk by chunk into a file object or callback (see pakbus.fileupload_stream)
+    #
+    def fileupload_stream(self, FileName, sink, FileOffset = 0x00000000, crc = 0, Swath = None, window = 1, retries = 2, timeout = 5):
+        transfer = pakbus.UploadWindow(self.DstNodeId, self.SrcNodeId, FileName, sink, self.SecurityCode, FileOffset, crc, Swath, window, retries, timeout, self.swath_controller(Swath, 'upload'))
+        yield self.run_transfer(transfer)
+        raise Return(transfer.result())
+
+    #
+    # Download a complete file (see pakbus.filedownload)
+    #
+    def filedownload(self, FileName, FileData, Swath = None, window = 1):
+        RespCode, FileOffset = yield self.filedownload_window(FileName, FileData, Swath = Swath, window = window)
+        raise Return(RespCode)
+
+    #
+    # Download file data with several packets in flight (see pakbus.filedownload_window)
+    #
+    def filedownload_window(self, FileName, FileData, FileOffset = 0x00000000, Swath = None, window = 1, retries = 2, timeout = 5):
+        transfer = pakbus.DownloadWindow(self.DstNodeId, self.SrcNodeId, FileName, FileData, self.SecurityCode, FileOffset, Swath, window, retries, timeout, self.swath_controller(Swath, 'download'))
+        yield self.run_transfer(transfer)
+        raise Return((transfer.RespCode, transfer.acked))
+
+    #
+    # Swath controller of the connection (None for a fixed Swath, see pakbus.get_swath_controller)
+    #
+    def swath_controller(self, Swath, direction):
+        if Swath is not None:
+            return None
+        return pakbus.get_swath_controller(self.conn.sock, self.DstNodeId, direction)
+
+    #
+    # Drive a pakbus.UploadWindow or pakbus.DownloadWindow transfer
+    #
+    def run_transfer(self, transfer):
+        TranNbr = None  # held transaction (a restarted download uses a new one)
+        try:
+            try:
+                while not transfer.done:
+                    for pkt in transfer.packets():
+                        self.conn.send(pkt)
+                    if transfer.TranNbr != TranNbr:
+                        self.conn.release(self.DstNodeId, TranNbr)
+                        TranNbr = transfer.TranNbr
+                        self.conn.hold(self.DstNodeId, self.SrcNodeId, TranNbr)
+                    hdr, msg = yield self.conn.wait(self.DstNodeId, self.SrcNodeId, transfer.TranNbr, transfer.timeout())
+                    transfer.receive(msg)
+            except socket.error:
+                transfer.abort()
+        finally:
+            self.conn.release(self.DstNodeId, TranNbr)
+
+    #
+    # Collect data (see pakbus.collect_data)
+    #
+    def collect_data(self, TableDef, TableName, FieldNames = [], CollectMode = 0x05, P1 = 1, P2 = 0, compact = False):
+        tablenbr = pakbus.get_TableNbr(TableDef, TableName)
+        if tablenbr is None:
+            raise StandardError('table %s not found in table definition' % TableName)
+        fieldnbr = pakbus.get_FieldNbr(TableDef, tablenbr, FieldNames)
+        pkt, TranNbr = pakbus.pkt_collectdata_cmd(self.DstNodeId, self.SrcNodeId, tablenbr, TableDef[tablenbr - 1]['Signature'], FieldNbr = fieldnbr, CollectMode = CollectMode, P1 = P1, P2 = P2, SecurityCode = self.SecurityCode)
+        hdr, msg = yield self.transact(pkt, TranNbr)
+        if not msg.has_key('RespCode'):
+            raise StandardError('no response to collect data request for table %s' % TableName)
+        if msg['RespCode'] == 0x07:
+            raise pakbus.TableDefMismatch('table definition of %s does not match data logger' % TableName)
+        RecData, MoreRecsExist = pakbus.parse_collectdata(msg['RecData'], TableDef, FieldNbr = fieldnbr, compact = compact)
+        yield self.complete_fragments(TableDef, RecData, fieldnbr, compact)
+        raise Return((RecData, MoreRecsExist))
+
+    #
+    # Replace record fragments in RecData by complete records (see pakbus.complete_fragments)
+    #
+    def complete_fragments(self, TableDef, RecData, FieldNbr = [], compact = False):
+        for i in range(len(RecData)):
+            frag = RecData[i]
+            if frag['IsOffset']:
+                assembler = pakbus.RecordAssembler(TableDef, frag, FieldNbr, compact)
+                while not assembler.complete:
+                    pkt, TranNbr = assembler.request(self.DstNodeId, self.SrcNodeId, self.SecurityCode)
+                    hdr, msg = yield self.transact(pkt, TranNbr)
+                    assembler.receive(msg)
+                RecData[i] = pakbus.complete_frag(frag, assembler.record())
+        raise Return(RecData)
+
+    #
+    # Say good bye and close connection
+    #
+    # The bye packet is sent right away if the socket is writable, otherwise
+    # by the loop before the connection is closed.
+    #
+    def close(self):
+        if self.conn is not None and self.conn.sock is not None:
+            self.conn.send(pakbus.pkt_bye_cmd(self.DstNodeId, self.SrcNodeId))
+            self.conn.shutdown()
@@ -0,0 +1,247 @@
+#
+# Incremental data collection for PakBus data loggers
+#
+# Licensed under the GNU General Public License
+#
+# Keeps a watermark (number and time of the last collected record) for each
+# data logger and table in a small SQLite database and collects only the
+# records that were stored since the last run.
+#
+# With a transactional sink (an object with a store() method, e.g.
+# pakbus_export.SQLiteSink), the records and the watermark are written in one
+# transaction of the sink's database, so a crash never leaves records stored
+# without the watermark and records are not collected twice:
+#
+#   sink = pakbus_export.SQLiteSink('/var/lib/pakbus/data.db', tabledef)
+#   collector = pakbus_collect.IncrementalCollector(sink.watermarks(), sink)
+#   stats = collector.collect(s, NodeId, MyNodeId, 'CR1000-1234', tabledef, 'Meteo')
+#
+# sink.store(logger, TableName, records, update) stores a batch of records (as
+# in the 'RecFrag' lists of parse_collectdata()), calls update() to write the
+# watermark into the same transaction and commits.
+#
+# Any other sink is a function sink(logger, TableName, records); the
+# watermark is advanced after the sink has returned, so after a crash the
+# batch that was being stored is collected again:
+#
+#   store = pakbus_collect.WatermarkStore('/var/lib/pakbus/state.db')
+#   collector = pakbus_collect.IncrementalCollector(store, sink)
+#
+
+
+#
+# Global imports
+#
+import threading
+import time
+
+import pakbus
+
+
+#
+# Watermark store (SQLite database)
+#
+class WatermarkStore(object):
+
+    def __init__(self, filename, lock = None):
+        # filename: SQLite database file (':memory:' for a temporary store) or
+        #           open sqlite3 connection (shared with a transactional sink)
+        # lock:     lock guarding a shared connection
+
+        import sqlite3
+        self.lock = lock or threading.RLock()
+        self.shared = isinstance(filename, sqlite3.Connection)
+        if self.shared:
+            self.db = filename
+        else:
+            self.db = sqlite3.connect(filename, check_same_thread = False)
+        self.lock.acquire()
+        try:
+            self.db.execute('CREATE TABLE IF NOT EXISTS watermarks (logger TEXT, table_name TEXT, rec_nbr INTEGER, signature INTEGER, updated REAL, PRIMARY KEY (logger, table_name))')
+            columns = [row[1] for row in self.db.execute('PRAGMA table_info(watermarks)')]
+            for column in ('seconds', 'nanoseconds'):   # time of the record (added later)
+                if column not in columns:
+                    self.db.execute('ALTER TABLE watermarks ADD COLUMN %s INTEGER' % column)
+            self.db.commit()
+        finally:
+            self.lock.release()
+
+    #
+    # Get (RecNbr, Signature, TimeOfRec) of the last collected record or None
+    # (TimeOfRec is None for watermarks stored without time)
+    #
+    def get(self, logger, TableName):
+        self.lock.acquire()
+        try:
+            row = self.db.execute('SELECT rec_nbr, signature, seconds, nanoseconds FROM watermarks WHERE logger = ? AND table_name = ?', (logger, TableName)).fetchone()
+        finally:
+            self.lock.release()
+        if row is None:
+            return None
+        return row[0], row[1], row[2] is not None and (row[2], row[3]) or None
+
+    #
+    # Store watermark (committed immediately unless commit is False)
+    #
+    def set(self, logger, TableName, RecNbr, Signature, TimeOfRec = None, commit = True):
+        self.lock.acquire()
+        try:
+            seconds, nanoseconds = TimeOfRec or (None, None)
+            self.db.execute('INSERT OR REPLACE INTO watermarks (logger, table_name, rec_nbr, signature, updated, seconds, nanoseconds) VALUES (?, ?, ?, ?, ?, ?, ?)', (logger, TableName, RecNbr, Signature, time.time(), seconds, nanoseconds))
+            if commit:
+                self.db.commit()
+        finally:
+            self.lock.release()
+
+    def delete(self, logger, TableName):
+        self.lock.acquire()
+        try:
+            self.db.execute('DELETE FROM watermarks WHERE logger = ? AND table_name = ?', (logger, TableName))
+            self.db.commit()
+        finally:
+            self.lock.release()
+
+    def close(self):
+        if not self.shared:
+            self.db.close()
+
+
+#
+# Incremental collector
+#
+class IncrementalCollector(object):
+
+    def __init__(self, store, sink, backfill = True, batch = 1000, compact = False):
+        # store:    WatermarkStore object (for a transactional sink: on the
+        #           sink's database, e.g. SQLiteSink.watermarks())
+        # sink:     transactional sink or function(logger, TableName, records)
+        #           storing a batch of records
+        # backfill: collect all stored records for tables without a watermark
+        #           (otherwise start with the newest record)
+        # batch:    maximum number of records passed to the sink at once
+        # compact:  pass records as tuple rows (see pakbus.record_type())
+
+        self.store = store
+        self.sink = sink
+        self.transactional = hasattr(sink, 'store')
+        if self.transactional and getattr(sink, 'db', None) is not store.db:
+            raise StandardError('the watermark store of a transactional sink must use its database')
+        self.backfill = backfill
+        self.batch = batch
+        self.compact = compact
+
+    #
+    # Collect all new records of a table
+    #
+    # A single record (CollectMode 0x05) is requested first to learn the newest
+    # record number. Then records from the watermark up to the newest record
+    # are streamed with pakbus.iter_records() (CollectMode 0x06, following
+    # MoreRecsExist), so collection ends even while the data logger keeps
+    # storing records.
+    #
+    # - Ring-buffer wraparound: if records after the watermark have already
+    #   been overwritten, collection continues with the oldest record still
+    #   available and the number of lost records is reported.
+    # - Table reset: if the newest record number is below the watermark, the
+    #   table signature has changed or the record at the watermark has a
+    #   different time (table reset and refilled past the watermark), the whole
+    #   table is collected again.
+    #
+    def collect(self, s, DstNodeId, SrcNodeId, logger, TableDef, TableName, FieldNames = [], SecurityCode = 0x0000):
+        # s:            Socket object
+        # DstNodeId:    Destination node ID (12-bit int)
+        # SrcNodeId:    Source node ID (12-bit int)
+        # logger:       Data logger identification (e.g. serial number)
+        # TableDef:     Table definition structure (as returned by parse_tabledef())
+        # TableName:    Table name as string
+        # FieldNames:   List of field names (empty to collect all)
+        # SecurityCode: 16-bit security code (optional)
+        #
+        # Returns dictionary with statistics: 'Records' (number of records
+        # collected), 'Lost' (records overwritten before collection), 'Reset'
+        # (table reset detected) and 'RecNbr' (new watermark)
+
+        stats = {'Records': 0, 'Lost': 0, 'Reset': False, 'RecNbr': None}
+
+        TableNbr = pakbus.get_TableNbr(TableDef, TableName)
+        if TableNbr is None:
+            raise StandardError('table %s not found in table definition' % TableName)
+        Signature = TableDef[TableNbr - 1]['Signature']
+
+        # Get newest record number
+        RecData, MoreRecsExist = pakbus.collect_data(s, DstNodeId, SrcNodeId, TableDef, TableName, FieldNames, 0x05, 1, 0, SecurityCode)
+        newest = last_recnbr(RecData)
+        if newest is None:
+            return stats    # table is empty
+
+        # Check if the record at the watermark has been replaced (other time after a table reset)
+        def replaced(RecNbr, TimeOfRec):
+            if TimeOfRec is None:
+                return False    # watermark stored without time
+            if RecNbr == newest:
+                record = last_record(RecData)
+            else:
+                record = last_record(pakbus.collect_data(s, DstNodeId, SrcNodeId, TableDef, TableName, FieldNames, 0x06, RecNbr, RecNbr + 1, SecurityCode)[0])
+            if record is None or record['RecNbr'] != RecNbr:
+                return False    # overwritten in the ring buffer
+            return tuple(record['TimeOfRec']) != tuple(TimeOfRec)
+
+        # Find first record to collect
+        watermark = self.store.get(logger, TableName)
+        if watermark is None:
+            if self.backfill:
+                start = 0
+            else:
+                start = newest
+        elif watermark[1] != Signature or newest < watermark[0] or replaced(watermark[0], watermark[2]):
+            stats['Reset'] = True
+            start = 0
+        else:
+            start = watermark[0] + 1
+        if watermark is not None and not stats['Reset']:
+            stats['RecNbr'] = watermark[0]
+
+        # Collect records until the newest record has been stored
+        if start > newest:
+            return stats
+        for records in pakbus.iter_records(s, DstNodeId, SrcNodeId, TableDef, TableName, FieldNames, 0x06, start, newest + 1, SecurityCode, batch = self.batch, compact = self.compact):
+
+            # Records that have been overwritten in the ring buffer
+            if start and records[0]['RecNbr'] > start:
+                stats['Lost'] += records[0]['RecNbr'] - start
+
+            # Store records and advance watermark (in one transaction of a transactional sink)
+            RecNbr = records[-1]['RecNbr']
+            TimeOfRec = tuple(records[-1]['TimeOfRec'])
+            if self.transactional:
+                self.sink.store(logger, TableName, records, lambda: self.store.set(logger, TableName, RecNbr, Signature, TimeOfRec, commit = False))
+            else:
+                self.sink(logger, TableName, records)
+                self.store.set(logger, TableName, RecNbr, Signature, TimeOfRec)
+            start = RecNbr + 1
+            stats['Records'] += len(records)
+            stats['RecNbr'] = RecNbr
+
+        return stats
+
+
+#
+# Get number of the last complete record in RecData (None if there is none)
+#
+def last_recnbr(RecData):
+    RecNbr = None
+    for frag in RecData:
+        if frag['NbrOfRecs']:
+            RecNbr = frag['BegRecNbr'] + frag['NbrOfRecs'] - 1
+    return RecNbr
+
+
+#
+# Get the last complete record in RecData (None if there is none)
+#
+def last_record(RecData):
+    record = None
+    for frag in RecData:
+        if frag['NbrOfRecs']:
+            record = frag['RecFrag'][-1]
+    return record
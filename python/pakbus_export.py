@@ -0,0 +1,723 @@
+#
+# Export of collected records to TOA5 and TOB1 files and SQLite databases
+#
+# Licensed under the GNU General Public License
+#
+# Writes records as returned by collect_data() or iter_records() (dictionaries
+# or compact rows) to the file formats used by LoggerNet and CardConvert:
+#
+# - TOA5: comma-separated text with a 4-line header (environment, field
+#   names, units, processing)
+# - TOB1: 5-line ASCII header (environment, field names, units, processing,
+#   data types) followed by binary records (little-endian, seconds and
+#   nanoseconds since 1990 and the record number before the field values)
+#
+#   writer = pakbus_export.TOA5Writer('data/Meteo_%Y%m%d.dat', tabledef, 'Meteo', interval = 86400)
+#   for records in pakbus.iter_records(s, NodeId, MyNodeId, tabledef, 'Meteo', batch = 1000):
+#       writer.write(records)
+#   writer.close()
+#
+# Existing files with the same header are appended to (the last of the
+# numbered files, after removing a partially written last record and skipping
+# records that are already in the file). A new file with the next numbered
+# name is started if the header differs or if the record numbers go back after
+# a table reset. Files can be rotated by size and by record time.
+#
+# Throughput for records with 14 values (benchmarks/bench_export.py, CPython
+# 2.7): TOB1 about 270k records/s for dictionaries and 430k records/s for
+# compact rows. TOA5 reaches only about 100k and 125k records/s, below the
+# target of 200k records/s: formatting the floats with %.7g alone takes about
+# 5 us per line.
+#
+# SQLiteSink stores records in SQLite tables created from the table
+# definitions; it can be used as the transactional sink of
+# pakbus_collect.IncrementalCollector, with the watermarks kept in the same
+# database:
+#
+#   sink = pakbus_export.SQLiteSink('data.db', tabledef)
+#   collector = pakbus_collect.IncrementalCollector(sink.watermarks(), sink)
+#
+
+
+#
+# Global imports
+#
+import calendar
+import math
+import os
+import struct
+import threading
+import time
+from itertools import chain
+from operator import itemgetter
+
+import pakbus
+
+
+#
+# Column formats of field types in TOA5 files
+#
+toa5_formats = {
+    'Byte': '%d', 'UInt2': '%d', 'UInt4': '%d', 'Int1': '%d', 'Int2': '%d', 'Int4': '%d',
+    'Bool': '%d', 'Bool8': '%d', 'Bool2': '%d', 'Bool4': '%d', 'Sec': '%d',
+    'Short': '%d', 'Long': '%d', 'UShort': '%d', 'ULong': '%d',
+    'FP2': '%.7g', 'FP3': '%.7g', 'FP4': '%.7g', 'IEEE4B': '%.7g', 'IEEE4L': '%.7g',
+    'IEEE8B': '%.15g', 'IEEE8L': '%.15g',
+    'ASCII': '"%s"',
+}
+
+#
+# Data type names and binary formats of field types in TOB1 files
+# (Campbell floating point formats are stored as IEEE4)
+#
+tob1_types = {
+    'Byte': ('UINT1', 'B'), 'UInt2': ('UINT2', 'H'), 'UInt4': ('ULONG', 'L'),
+    'Int1': ('INT1', 'b'), 'Int2': ('INT2', 'h'), 'Int4': ('LONG', 'l'),
+    'Bool': ('BOOL', 'B'), 'Bool8': ('BOOL8', 'B'), 'Bool2': ('BOOL2', 'H'), 'Bool4': ('BOOL4', 'L'),
+    'Sec': ('LONG', 'l'), 'Short': ('INT2', 'h'), 'Long': ('LONG', 'l'), 'UShort': ('UINT2', 'H'), 'ULong': ('ULONG', 'L'),
+    'FP2': ('IEEE4', 'f'), 'FP3': ('IEEE4', 'f'), 'FP4': ('IEEE4', 'f'), 'IEEE4B': ('IEEE4', 'f'), 'IEEE4L': ('IEEE4', 'f'),
+    'IEEE8B': ('IEEE8', 'd'), 'IEEE8L': ('IEEE8', 'd'),
+}
+
+# Default environment (first header line)
+environment_defaults = {
+    'StationName':  '',
+    'Model':        'CR1000',
+    'SerialNbr':    '',
+    'OSVer':        '',
+    'ProgName':     '',
+    'ProgSig':      '',
+}
+
+
+#
+# Get column names of a field (array fields are expanded)
+#
+def field_columns(fld):
+    # fld: field definition (element of the 'Fields' list of parse_tabledef() output)
+
+    if fld['FieldType'] == 'ASCII' or fld['Dimension'] == 1:
+        return [fld['FieldName']]
+
+    # Multi-dimensional arrays: indices in row-major order
+    dims = fld['SubDim'] or [fld['Dimension']]
+    indices = [[]]
+    for dim in dims:
+        indices = [index + [i] for index in indices for i in range(1, dim + 1)]
+    if len(dims) == 1:  # first index given by BegIdx
+        indices = [[fld['BegIdx'] + index[0] - 1] for index in indices]
+    return ['%s(%s)' % (fld['FieldName'], ','.join([str(i) for i in index])) for index in indices[:fld['Dimension']]]
+
+
+#
+# Get field definitions of a table (all fields or the given ones, in table order)
+#
+def table_fields(tabledef, TableName, FieldNames = []):
+    # tabledef:   table definition structure (as returned by pakbus.parse_tabledef())
+    # TableName:  table name as string
+    # FieldNames: list of field names (empty for all fields)
+
+    TableNbr = pakbus.get_TableNbr(tabledef, TableName)
+    if TableNbr is None:
+        raise StandardError('table %s not found in table definition' % TableName)
+    fields = tabledef[TableNbr - 1]['Fields']
+    return [fields[FieldNbr - 1] for FieldNbr in pakbus.get_FieldNbr(tabledef, TableNbr, FieldNames) or range(1, len(fields) + 1)]
+
+
+#
+# Get (RecNbr, TimeOfRec, tuple of field values) for each record
+#
+# Compact rows are read with tuple.__getitem__ (Row.__getitem__ accepts names
+# and is slower); array values are flattened.
+#
+def record_items(records, names, arrays):
+    # records: list of records (dictionaries or compact rows of one table)
+    # names:   tuple of field names in the records
+    # arrays:  list of flags if the fields are arrays
+
+    if isinstance(records[0], pakbus.Row):
+        if type(records[0])._fields[2:] != names:
+            raise StandardError('record fields do not match %s' % ', '.join(names))
+        get = tuple.__getitem__
+        rest = slice(2, None)
+        if True not in arrays:
+            return [(get(r, 0), get(r, 1), get(r, rest)) for r in records]
+        positions = [i for i in range(len(arrays)) if arrays[i]]
+        positions.reverse()
+        items = []
+        for r in records:
+            values = list(get(r, rest))
+            for i in positions:
+                values[i:i + 1] = values[i]
+            items.append((get(r, 0), get(r, 1), tuple(values)))
+        return items
+
+    if len(names) == 1:
+        name = names[0]
+        return [(r['RecNbr'], r['TimeOfRec'], tuple(r['Fields'][name])) for r in records]
+    fields = itemgetter(*names)
+    flatten = chain.from_iterable
+    return [(r['RecNbr'], r['TimeOfRec'], tuple(flatten(fields(r['Fields'])))) for r in records]
+
+
+#
+# Get field names of records (dictionaries or compact rows) in table order
+#
+def record_names(record, tabledef, TableName):
+    if isinstance(record, pakbus.Row):
+        return type(record)._fields[2:]
+    names = record['Fields']
+    return tuple([fld['FieldName'] for fld in table_fields(tabledef, TableName) if names.has_key(fld['FieldName'])])
+
+
+#
+# Quote values for a CSV header line
+#
+def header_line(values):
+    return ','.join(['"%s"' % str(value).replace('"', '""') for value in values]) + '\r\n'
+
+
+#
+# Base class for table file writers
+#
+class TableWriter(object):
+
+    format = None   # 'TOA5' or 'TOB1'
+
+    def __init__(self, filename, tabledef, TableName, FieldNames = [], environment = {}, max_size = None, interval = None, buffering = 1 << 20):
+        # filename:    file name, may contain time.strftime() codes (expanded with
+        #              the time stamp of the first record written to the file)
+        # tabledef:    table definition structure (as returned by pakbus.parse_tabledef())
+        # TableName:   table name as string
+        # FieldNames:  list of field names (as used for collecting, empty for all fields)
+        # environment: dictionary with 'StationName', 'Model', 'SerialNbr', 'OSVer',
+        #              'ProgName' and 'ProgSig' (e.g. pakbus.getprogstat() output)
+        # max_size:    start a new file when the file reaches this size in bytes
+        #              (checked after each batch)
+        # interval:    start a new file when the record time enters a new interval
+        #              [seconds] (e.g. 86400 for daily files)
+        # buffering:   size of the output buffer in bytes
+
+        self.file = None        # set first: __del__() closes it even if the constructor fails
+        self.filename = filename
+        self.TableName = TableName
+        self.max_size = max_size
+        self.interval = interval
+        self.buffering = buffering
+
+        env = dict(environment_defaults)
+        env.update(environment)
+        self.environment = [self.format, env['StationName'], env['Model'], env['SerialNbr'], env['OSVer'], env['ProgName'], env['ProgSig'], TableName]
+
+        # Selected fields (in table order, as in collected records)
+        self.fields = table_fields(tabledef, TableName, FieldNames)
+        self.names = tuple([fld['FieldName'] for fld in self.fields])
+        self.arrays = [fld['FieldType'] != 'ASCII' and fld['Dimension'] != 1 for fld in self.fields]
+
+        self.header = self.make_header()
+        self.name = None        # name of the current file
+        self.size = 0           # size of the current file
+        self.period = None      # current rotation interval
+        self.rotated = False    # flag if the next file is started by rotation
+        self.last_record = None # last record number in the current file (None if empty)
+        self.last_time = None   # time of the last record in the current file
+
+    #
+    # Write list of records
+    #
+    def write(self, records):
+        # records: list of records (dictionaries or compact rows)
+
+        if not records:
+            return
+
+        # Split batch at rotation interval boundaries
+        if self.interval:
+            first = records[0]['TimeOfRec'][0] // self.interval
+            if first != self.period or records[-1]['TimeOfRec'][0] // self.interval != first:
+                start = 0
+                for i in range(len(records)):
+                    period = records[i]['TimeOfRec'][0] // self.interval
+                    if period != self.period:
+                        if i > start:
+                            self.write_records(records[start:i])
+                        if self.file is not None:
+                            self.close()
+                            self.rotated = True
+                        self.period = period
+                        start = i
+                records = records[start:]
+
+        self.write_records(records)
+
+    def write_records(self, records):
+        if self.file is None:
+            self.open(records[0]['TimeOfRec'])
+
+        # Skip records already in the file (overlapping collections); a record
+        # number going back with a newer time means a table reset, and the
+        # records after the reset are written to a new file
+        if self.last_record is not None and records[0]['RecNbr'] <= self.last_record:
+            i = 0
+            while i < len(records) and self.written(records[i]):
+                i += 1
+            records = records[i:]
+            if not records:
+                return
+            if records[0]['RecNbr'] <= self.last_record:
+                self.close()
+                self.rotated = True
+                self.open(records[0]['TimeOfRec'])
+
+        data = self.encode(records)
+        self.file.write(data)
+        self.size += len(data)
+        self.last_record = records[-1]['RecNbr']
+        self.last_time = tuple(records[-1]['TimeOfRec'])
+        if self.max_size and self.size >= self.max_size:
+            self.close()
+            self.rotated = True
+
+    #
+    # Check if a record (not newer than the last record) is already in the file
+    #
+    def written(self, record):
+        RecNbr = record['RecNbr']
+        TimeOfRec = tuple(record['TimeOfRec'])
+        if RecNbr == self.last_record:
+            return TimeOfRec == self.last_time
+        return RecNbr < self.last_record and TimeOfRec < self.last_time
+
+    #
+    # Open file for the first record with time stamp TimeOfRec
+    #
+    def open(self, TimeOfRec):
+        name = time.strftime(self.filename, time.gmtime(pakbus.nsec_base + TimeOfRec[0]))
+        root, ext = os.path.splitext(name)
+
+        # Find the last of the numbered files
+        n = 0
+        last = None
+        while os.path.exists(name):
+            last = name
+            n += 1
+            name = '%s_%d%s' % (root, n, ext)
+
+        if last is not None and not self.rotated and self.can_append(last):
+            name = last
+            f = open(name, 'r+b', self.buffering)
+            self.size, self.last_record, self.last_time = self.recover(f)
+            f.seek(self.size)
+            f.truncate()
+        else:
+            f = open(name, 'wb', self.buffering)
+            f.write(self.header)
+            self.size = len(self.header)
+            self.last_record = self.last_time = None
+        self.file = f
+        self.name = name
+        self.rotated = False
+
+    #
+    # Check if a file has the same header (and is not full)
+    #
+    def can_append(self, name):
+        if self.max_size and os.path.getsize(name) >= self.max_size:
+            return False
+        f = open(name, 'rb')
+        try:
+            return f.read(len(self.header)) == self.header
+        finally:
+            f.close()
+
+    def flush(self):
+        if self.file is not None:
+            self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def __del__(self):
+        self.close()
+
+
+#
+# TOA5 (text) file writer
+#
+class TOA5Writer(TableWriter):
+
+    format = 'TOA5'
+
+    def make_header(self):
+        names = ['TIMESTAMP', 'RECORD']
+        units = ['TS', 'RN']
+        processing = ['', '']
+        formats = self.formats = ['"%s"', '%d']
+        self.strings = []   # indices of string values
+        self.floats = []    # indices of float values
+        for fld in self.fields:
+            if not toa5_formats.has_key(fld['FieldType']):
+                raise StandardError('data type %s of field %s not supported in TOA5 files' % (fld['FieldType'], fld['FieldName']))
+            for column in field_columns(fld):
+                if fld['FieldType'] == 'ASCII':
+                    self.strings.append(len(formats) - 2)
+                elif toa5_formats[fld['FieldType']] != '%d':
+                    self.floats.append(len(formats) - 2)
+                names.append(column)
+                units.append(fld['Units'])
+                processing.append(fld['Processing'])
+                formats.append(toa5_formats[fld['FieldType']])
+
+        # Record template; non-finite floats are written by a slower template as "NAN", "INF" or "-INF"
+        self.template = ','.join(formats) + '\r\n'
+        self.special = ','.join([(i - 2 in self.floats) and '%s' or formats[i] for i in range(len(formats))]) + '\r\n'
+        self.day = None
+        self.times = {}     # formatted time of day by seconds
+        return header_line(self.environment) + header_line(names) + header_line(units) + header_line(processing)
+
+    #
+    # Format time stamp (the date is formatted once per day, the time of day
+    # once per distinct value)
+    #
+    def timestamp(self, TimeOfRec):
+        day, seconds = divmod(TimeOfRec[0], 86400)
+        if day != self.day:
+            self.date = time.strftime('%Y-%m-%d ', time.gmtime(pakbus.nsec_base + day * 86400))
+            self.day = day
+        if TimeOfRec[1]:
+            hours, seconds = divmod(seconds, 3600)
+            minutes, seconds = divmod(seconds, 60)
+            return '%s%02d:%02d:%s' % (self.date, hours, minutes, ('%012.9f' % (seconds + TimeOfRec[1] * 1e-9)).rstrip('0'))
+        try:
+            return self.date + self.times[seconds]
+        except KeyError:
+            self.times[seconds] = '%02d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+            return self.date + self.times[seconds]
+
+    def encode(self, records):
+        template = self.template
+        timestamp = self.timestamp
+        strings = self.strings
+        floats = self.floats
+        lines = []
+        append = lines.append
+        for RecNbr, TimeOfRec, vals in record_items(records, self.names, self.arrays):
+            if strings:
+                vals = list(vals)
+                for i in strings:
+                    vals[i] = vals[i].split('\0', 1)[0].replace('"', '""')
+                nonfinite = [i for i in floats if vals[i] - vals[i] != 0]
+                vals = tuple(vals)
+            else:
+                total = sum(vals)
+                nonfinite = total - total != 0
+            if nonfinite:
+                append(self.encode_special(RecNbr, TimeOfRec, vals))
+            else:
+                append(template % ((timestamp(TimeOfRec), RecNbr) + vals))
+        return ''.join(lines)
+
+    #
+    # Format record with non-finite values
+    #
+    def encode_special(self, RecNbr, TimeOfRec, vals):
+        vals = list(vals)
+        for i in self.floats:
+            value = vals[i]
+            if math.isnan(value):
+                vals[i] = '"NAN"'
+            elif math.isinf(value):
+                vals[i] = value > 0 and '"INF"' or '"-INF"'
+            else:
+                vals[i] = self.formats[i + 2] % value
+        return self.special % tuple([self.timestamp(TimeOfRec), RecNbr] + vals)
+
+    #
+    # Get size of complete lines, number and time of the last record of an existing file
+    #
+    def recover(self, f):
+        f.seek(0, 2)
+        end = f.tell()
+        start = max(len(self.header), end - 65536)
+        while True:
+            f.seek(start)
+            data = f.read(end - start)
+            last = data.rfind('\n')
+            if start == len(self.header) or data.rfind('\n', 0, last) >= 0:
+                break
+            start = len(self.header)    # very long lines: read all records
+        if last < 0:
+            return len(self.header), None, None
+        line = data[data.rfind('\n', 0, last) + 1:last]
+        timestamp, RecNbr = line.split(',')[:2]
+        return start + last + 1, int(RecNbr), self.parse_timestamp(timestamp.strip('"'))
+
+    #
+    # Get TimeOfRec of a formatted time stamp
+    #
+    def parse_timestamp(self, timestamp):
+        seconds, dot, fraction = timestamp.partition('.')
+        seconds = calendar.timegm(time.strptime(seconds, '%Y-%m-%d %H:%M:%S')) - pakbus.nsec_base
+        return (seconds, int((fraction + '000000000')[:9]))
+
+
+#
+# TOB1 (binary) file writer
+#
+class TOB1Writer(TableWriter):
+
+    format = 'TOB1'
+
+    def make_header(self):
+        names = ['SECONDS', 'NANOSECONDS', 'RECORD']
+        units = ['SECONDS', 'NANOSECONDS', 'RN']
+        processing = ['', '', '']
+        types = ['ULONG', 'ULONG', 'ULONG']
+        codes = ['<LLL']
+        self.strings = []   # indices of string values
+        for fld in self.fields:
+            if fld['FieldType'] == 'ASCII':
+                self.strings.append(len(types) - 3)
+                typename, code = 'ASCII(%d)' % fld['Dimension'], '%ds' % fld['Dimension']
+            elif tob1_types.has_key(fld['FieldType']):
+                typename, code = tob1_types[fld['FieldType']]
+            else:
+                raise StandardError('data type %s of field %s not supported in TOB1 files' % (fld['FieldType'], fld['FieldName']))
+            for column in field_columns(fld):
+                names.append(column)
+                units.append(fld['Units'])
+                processing.append(fld['Processing'])
+                types.append(typename)
+                codes.append(code)
+        self.record = struct.Struct(''.join(codes))
+        return header_line(self.environment) + header_line(names) + header_line(units) + header_line(processing) + header_line(types)
+
+    def encode(self, records):
+        pack = self.record.pack
+        return ''.join([pack(TimeOfRec[0], TimeOfRec[1], RecNbr, *vals) for RecNbr, TimeOfRec, vals in record_items(records, self.names, self.arrays)])
+
+    #
+    # Get size of complete records, number and time of the last record of an existing file
+    #
+    def recover(self, f):
+        f.seek(0, 2)
+        count = (f.tell() - len(self.header)) // self.record.size
+        size = len(self.header) + count * self.record.size
+        if not count:
+            return size, None, None
+        f.seek(size - self.record.size)
+        values = self.record.unpack(f.read(self.record.size))
+        return size, values[2], values[:2]
+
+
+################################################################################
+#
+# SQLite database
+#
+################################################################################
+
+#
+# Column types of field types in SQLite tables
+#
+sqlite_types = {
+    'FP2': 'REAL', 'FP3': 'REAL', 'FP4': 'REAL', 'IEEE4B': 'REAL', 'IEEE4L': 'REAL', 'IEEE8B': 'REAL', 'IEEE8L': 'REAL',
+    'ASCII': 'TEXT',
+}
+
+#
+# Quote SQL identifier
+#
+def sql_name(name):
+    return '"%s"' % name.replace('"', '""')
+
+
+#
+# SQLite sink
+#
+# Each data logger table is stored in a database table with the columns
+# Signature (table signature), RecNbr, Seconds and Nanoseconds (time of the
+# record since 1990, as in TOB1 files) and one column per value (arrays
+# expanded as in TOA5 files). Tables are created when records are first
+# stored; columns of fields that were added to a table later are added to the
+# database table.
+#
+# The primary key is (Signature, RecNbr, Seconds, Nanoseconds): records are
+# inserted with executemany() and INSERT OR REPLACE, so storing overlapping
+# collections again replaces the existing rows, while records collected after
+# a table reset (record numbers starting at 0 again, with a new signature or
+# new record times) are stored next to the old ones. Tables created with
+# RecNbr as the only primary key are converted (existing rows get the current
+# table signature). The database uses write-ahead logging. NaN values are
+# stored as NULL.
+#
+class SQLiteSink(object):
+
+    def __init__(self, filename, tabledef, table_name = '%(TableName)s', commit_size = 100000):
+        # filename:    SQLite database file
+        # tabledef:    table definition structure (as returned by pakbus.parse_tabledef())
+        # table_name:  name of the database table, may contain %(TableName)s and
+        #              %(logger)s (data logger identification passed to write())
+        # commit_size: number of records written by write() in one transaction
+
+        import sqlite3
+        self.db = sqlite3.connect(filename, check_same_thread = False)
+        self.db.execute('PRAGMA journal_mode = WAL')
+        self.db.execute('PRAGMA synchronous = NORMAL')
+        self.tabledef = tabledef
+        self.table_name = table_name
+        self.commit_size = commit_size
+        self.pending = 0        # number of records not committed yet
+        self.statements = {}    # (table, field names) -> (INSERT statement, arrays, string indices)
+        self.lock = threading.RLock()
+
+    #
+    # Create or extend database table, return INSERT statement for the fields
+    #
+    def prepare(self, table, TableName, names):
+        fields = table_fields(self.tabledef, TableName)
+        key = ['Signature', 'RecNbr', 'Seconds', 'Nanoseconds']
+        columns = [(column, 'INTEGER') for column in key]
+        for fld in fields:
+            if not toa5_formats.has_key(fld['FieldType']):
+                if fld['FieldName'] in names:
+                    raise StandardError('data type %s of field %s not supported in SQLite tables' % (fld['FieldType'], fld['FieldName']))
+                continue
+            for column in field_columns(fld):
+                columns.append((column, sqlite_types.get(fld['FieldType'], 'INTEGER')))
+
+        existing = [(row[1], row[2]) for row in self.db.execute('PRAGMA table_info(%s)' % sql_name(table))]
+        if existing and 'Signature' not in [column for column, Type in existing]:
+            # convert table with RecNbr as primary key (no table signature)
+            old = table + ' (old)'
+            self.db.execute('ALTER TABLE %s RENAME TO %s' % (sql_name(table), sql_name(old)))
+            self.create(table, key, [('Signature', 'INTEGER')] + existing)
+            names = ', '.join([sql_name(column) for column, Type in existing])
+            self.db.execute('INSERT INTO %s (%s, %s) SELECT ?, %s FROM %s' % (sql_name(table), sql_name('Signature'), names, names, sql_name(old)), (self.signature(TableName), ))
+            self.db.execute('DROP TABLE %s' % sql_name(old))
+            self.db.commit()
+        elif not existing:
+            self.create(table, key, columns)
+        existing = [row[1] for row in self.db.execute('PRAGMA table_info(%s)' % sql_name(table))]
+        for column, Type in columns:
+            if column not in existing:
+                self.db.execute('ALTER TABLE %s ADD COLUMN %s %s' % (sql_name(table), sql_name(column), Type))
+
+        inserted = list(key)
+        arrays = []
+        strings = []
+        for fld in fields:
+            if fld['FieldName'] in names:
+                if fld['FieldType'] == 'ASCII':
+                    strings.append(len(inserted))
+                inserted.extend(field_columns(fld))
+                arrays.append(fld['FieldType'] != 'ASCII' and fld['Dimension'] != 1)
+        statement = 'INSERT OR REPLACE INTO %s (%s) VALUES (%s)' % (sql_name(table), ', '.join([sql_name(column) for column in inserted]), ', '.join(len(inserted) * ['?']))
+        return statement, arrays, strings
+
+    #
+    # Create database table (without rowid, stored in primary key order)
+    #
+    def create(self, table, key, columns):
+        self.db.execute('CREATE TABLE %s (%s, PRIMARY KEY (%s)) WITHOUT ROWID' % (sql_name(table), ', '.join(['%s %s' % (sql_name(column), Type) for column, Type in columns]), ', '.join([sql_name(column) for column in key])))
+
+    #
+    # Get table signature
+    #
+    def signature(self, TableName):
+        return self.tabledef[pakbus.get_TableNbr(self.tabledef, TableName) - 1]['Signature']
+
+    #
+    # Store list of records (committed after commit_size records)
+    #
+    def write(self, TableName, records, logger = ''):
+        # TableName: table name as string
+        # records:   list of records (dictionaries or compact rows)
+        # logger:    data logger identification (for the table_name template)
+
+        if not records:
+            return
+        self.lock.acquire()
+        try:
+            self.insert(TableName, records, logger)
+            if self.pending >= self.commit_size:
+                self.db.commit()
+                self.pending = 0
+        finally:
+            self.lock.release()
+
+    #
+    # Insert records into a database table (not committed)
+    #
+    def insert(self, TableName, records, logger):
+        names = record_names(records[0], self.tabledef, TableName)
+        table = self.table_name % {'TableName': TableName, 'logger': logger}
+        try:
+            statement, arrays, strings = self.statements[(table, names)]
+        except KeyError:
+            statement, arrays, strings = self.statements[(table, names)] = self.prepare(table, TableName, names)
+
+        Signature = self.signature(TableName)
+        rows = [(Signature, RecNbr, TimeOfRec[0], TimeOfRec[1]) + values for RecNbr, TimeOfRec, values in record_items(records, names, arrays)]
+        if strings:     # strip trailing nul characters
+            for i in range(len(rows)):
+                row = list(rows[i])
+                for j in strings:
+                    row[j] = row[j].split('\0', 1)[0]
+                rows[i] = row
+        self.db.executemany(statement, rows)
+        self.pending += len(rows)
+
+    #
+    # Store records and commit
+    #
+    def __call__(self, logger, TableName, records):
+        self.write(TableName, records, logger)
+        self.commit()
+
+    #
+    # Store records, call update() and commit in one transaction (transactional
+    # sink of pakbus_collect.IncrementalCollector)
+    #
+    def store(self, logger, TableName, records, update):
+        # logger:    data logger identification (for the table_name template)
+        # TableName: table name as string
+        # records:   list of records (dictionaries or compact rows)
+        # update:    function writing further rows (e.g. a watermark) without commit
+
+        self.lock.acquire()
+        try:
+            if self.pending:    # start a transaction of its own
+                self.db.commit()
+                self.pending = 0
+            try:
+                if records:
+                    self.insert(TableName, records, logger)
+                update()
+            except:
+                self.db.rollback()
+                self.pending = 0
+                raise
+            self.commit()
+        finally:
+            self.lock.release()
+
+    #
+    # Watermark store in this database (for pakbus_collect.IncrementalCollector)
+    #
+    def watermarks(self):
+        import pakbus_collect
+        return pakbus_collect.WatermarkStore(self.db, self.lock)
+
+    def commit(self):
+        self.lock.acquire()
+        try:
+            self.db.commit()
+            self.pending = 0
+        finally:
+            self.lock.release()
+
+    def close(self):
+        self.commit()
+        self.db.close()
@@ -0,0 +1,332 @@
+#
+# Fleet collection scheduler for PakBus data loggers
+#
+# Licensed under the GNU General Public License
+#
+# Runs collections for a list of stations on a bounded pool of worker threads:
+#
+# - every station has a deadline for a complete collection run
+# - start times are jittered to spread the load
+# - the number of concurrent connections to one host (e.g. a NL115 shared by
+#   several loggers) is capped
+# - latency and failures are reported for every station
+#
+# Stations are dictionaries with the keys
+#
+#   name, host, port, node_id, my_node_id, security_code, tables, interval,
+#   deadline, timeout, tdf_cache
+#
+# and can be read from a configuration file with one section per station
+# (see load_stations()).
+#
+
+
+#
+# Global imports
+#
+import heapq
+import random
+import socket
+import threading
+import time
+
+import pakbus
+
+
+#
+# Default station settings
+#
+station_defaults = {
+    'port':             6785,
+    'node_id':          0x001,
+    'my_node_id':       0x802,
+    'security_code':    0x0000,
+    'tables':           [],
+    'interval':         3600,   # seconds between collections
+    'deadline':         120,    # maximum duration of one collection [seconds]
+    'timeout':          30,     # socket timeout [seconds]
+    'tdf_cache':        None,   # table definition cache directory (optional)
+}
+
+
+# Table definition caches by directory
+tdf_caches = {}
+tdf_caches_lock = threading.Lock()
+
+def get_tdf_cache(directory):
+    tdf_caches_lock.acquire()
+    try:
+        if not tdf_caches.has_key(directory):
+            tdf_caches[directory] = pakbus.TableDefCache(directory)
+        return tdf_caches[directory]
+    finally:
+        tdf_caches_lock.release()
+
+
+#
+# Read station list from configuration file
+#
+# Each section describes one station, e.g.
+#
+#   [tower1]
+#   host = 10.0.0.10
+#   node_id = 0x001
+#   tables = Meteo, Flux
+#   interval = 600
+#
+def load_stations(filename, defaults = station_defaults):
+    # filename: configuration file name
+    # defaults: settings used for keys missing in a section
+
+    import ConfigParser
+    cf = ConfigParser.SafeConfigParser()
+    if not cf.read(filename):
+        raise IOError('cannot read station list %s' % filename)
+
+    stations = []
+    for section in cf.sections():
+        station = dict(defaults)
+        station['name'] = section
+        for key, value in cf.items(section):
+            try:
+                if key == 'tables':
+                    station[key] = [t.strip() for t in value.split(',') if t.strip()]
+                elif key in ('interval', 'deadline', 'timeout'):
+                    station[key] = float(value)
+                elif key in ('port', 'node_id', 'my_node_id', 'security_code'):
+                    station[key] = int(value, 0) # decimal or hex number
+                else:
+                    station[key] = value    # host, tdf_cache and other keys as strings
+            except ValueError:
+                raise ValueError('invalid value %r of %s for station %s' % (value, key, section))
+        stations.append(station)
+    return stations
+
+
+#
+# Default collection job: collect the newest records of each table
+#
+# Every transaction (including "please wait" extensions) ends by the deadline
+# (see pakbus.set_deadline()).
+#
+def collect_station(station, deadline):
+    # station:  station dictionary
+    # deadline: time.time() value by which the collection has to be finished
+    #
+    # Returns a dictionary with the collected RecData for each table
+
+    def remaining():
+        left = deadline - time.time()
+        if left <= 0:
+            raise socket.timeout('deadline exceeded')
+        return left
+
+    NodeId, MyNodeId = station['node_id'], station['my_node_id']
+    s = pakbus.open_socket(station['host'], station['port'], min(station['timeout'], remaining()))
+    if s is None:
+        raise socket.error('cannot connect to %s:%d' % (station['host'], station['port']))
+    pakbus.set_deadline(s, deadline)
+    try:
+        if not pakbus.ping_node(s, NodeId, MyNodeId):
+            raise socket.timeout('no reply from PakBus node 0x%.3x' % NodeId)
+
+        data = {}
+        if station['tables'] and station.get('tdf_cache'):
+            cache = get_tdf_cache(station['tdf_cache'])
+            for table in station['tables']:
+                remaining()
+                data[table], MoreRecsExist = cache.collect_data(s, NodeId, MyNodeId, table, SecurityCode = station['security_code'])
+        elif station['tables']:
+            remaining()
+            FileData, RespCode = pakbus.fileupload(s, NodeId, MyNodeId, '.TDF', station['security_code'])
+            if not FileData:
+                remaining()     # report an interrupted upload as deadline timeout
+                raise StandardError('cannot read table definitions (RespCode 0x%.2x)' % RespCode)
+            tabledef = pakbus.parse_tabledef(FileData)
+            for table in station['tables']:
+                remaining()
+                data[table], MoreRecsExist = pakbus.collect_data(s, NodeId, MyNodeId, tabledef, table, SecurityCode = station['security_code'])
+
+        s.settimeout(min(station['timeout'], remaining()))
+        pakbus.send(s, pakbus.pkt_bye_cmd(NodeId, MyNodeId))
+    finally:
+        pakbus.set_deadline(s, None)
+        s.close()
+    return data
+
+
+#
+# Count records in collect_station() output
+#
+def count_records(data):
+    count = 0
+    for RecData in data.values():
+        for frag in RecData:
+            if frag['NbrOfRecs']:
+                count += frag['NbrOfRecs']
+    return count
+
+
+#
+# Collection scheduler
+#
+class Scheduler(object):
+
+    def __init__(self, stations, job = collect_station, workers = 16, per_host = 1, jitter = 10.0, on_result = None):
+        # stations:  list of station dictionaries
+        # job:       function(station, deadline) performing one collection
+        # workers:   number of worker threads
+        # per_host:  maximum number of concurrent connections to one host
+        # jitter:    maximum random delay of start times [seconds]
+        # on_result: function(result) called after each collection (optional)
+
+        self.stations = stations
+        self.job = job
+        self.workers = workers
+        self.per_host = per_host
+        self.jitter = jitter
+        self.on_result = on_result
+
+        self.cond = threading.Condition()
+        self.queue = []         # heap of (start time, sequence number, station)
+        self.sequence = 0
+        self.active = {}        # host -> number of running collections
+        self.running = 0        # number of running collections
+        self.results = []
+        self.stopped = False
+
+    #
+    # Schedule collection of a station
+    #
+    def schedule(self, station, start):
+        self.cond.acquire()
+        try:
+            self.sequence += 1
+            heapq.heappush(self.queue, (start, self.sequence, station))
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+    #
+    # Get next station that is due and whose host has a free slot
+    #
+    def next_station(self, wait = True):
+        self.cond.acquire()
+        try:
+            while not self.stopped:
+                now = time.time()
+                timeout = None
+                for i in range(len(self.queue)):
+                    start, seq, station = self.queue[i]
+                    if start > now:
+                        if timeout is None or start - now < timeout:
+                            timeout = start - now
+                        continue
+                    if self.active.get(station['host'], 0) < self.per_host:
+                        del self.queue[i]
+                        heapq.heapify(self.queue)
+                        self.active[station['host']] = self.active.get(station['host'], 0) + 1
+                        self.running += 1
+                        return station
+                if not wait or (not self.queue and not self.running):
+                    return None
+                self.cond.wait(timeout)
+            return None
+        finally:
+            self.cond.release()
+
+    #
+    # Run one collection and record the result
+    #
+    def collect(self, station):
+        result = {'name': station.get('name', station['host']), 'host': station['host'], 'node_id': station['node_id'], 'start': time.time(), 'error': None, 'data': None}
+        try:
+            result['data'] = self.job(station, result['start'] + station['deadline'])
+        except Exception, e:
+            result['error'] = '%s: %s' % (e.__class__.__name__, e)
+        result['latency'] = time.time() - result['start']
+
+        self.cond.acquire()
+        try:
+            self.active[station['host']] -= 1
+            self.running -= 1
+            self.results.append(result)
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+        if self.on_result:
+            self.on_result(result)
+        return result
+
+    def worker(self, repeat):
+        while True:
+            station = self.next_station()
+            if station is None:
+                return
+            self.collect(station)
+            if repeat and not self.stopped:
+                self.schedule(station, time.time() + station['interval'] + random.uniform(0, self.jitter))
+
+    def start_workers(self, repeat):
+        threads = []
+        for i in range(min(self.workers, max(len(self.stations), 1))):
+            t = threading.Thread(target = self.worker, args = (repeat, ))
+            t.setDaemon(True)
+            t.start()
+            threads.append(t)
+        return threads
+
+    #
+    # Collect all stations once and return the list of results
+    #
+    def run_once(self):
+        now = time.time()
+        self.results = []
+        for station in self.stations:
+            self.schedule(station, now + random.uniform(0, self.jitter))
+        for t in self.start_workers(False):
+            t.join()
+        return self.results
+
+    #
+    # Collect all stations repeatedly at their intervals until stop() is called
+    #
+    def run_forever(self):
+        now = time.time()
+        for station in self.stations:
+            self.schedule(station, now + random.uniform(0, self.jitter))
+        threads = self.start_workers(True)
+        while [t for t in threads if t.isAlive()]:
+            for t in threads:
+                t.join(1)
+
+    def stop(self):
+        self.cond.acquire()
+        self.stopped = True
+        self.cond.notifyAll()
+        self.cond.release()
+
+
+#
+# Format collection results as a text report
+#
+def report(results):
+    # results: list of result dictionaries as returned by Scheduler.run_once()
+
+    lines = ['%-20s %-20s %6s %10s %8s  %s' % ('station', 'host', 'node', 'latency', 'records', 'error')]
+    failed = 0
+    for r in sorted(results, key = lambda r: r['name']):
+        if r['error']:
+            failed += 1
+            records = '-'
+        elif isinstance(r['data'], dict):
+            records = '%d' % count_records(r['data'])
+        else:
+            records = '-'
+        lines.append('%-20s %-20s 0x%.3x %9.3fs %8s  %s' % (r['name'], r['host'], r['node_id'], r['latency'], records, r['error'] or ''))
+
+    latencies = sorted([r['latency'] for r in results])
+    if latencies:
+        lines.append('%d stations, %d failed, latency median %.3fs, max %.3fs' % (len(results), failed, latencies[len(latencies) // 2], latencies[-1]))
+    return '\n'.join(lines)
@@ -0,0 +1,737 @@
+#
+# Simulated PakBus data loggers
+#
+# Licensed under the GNU General Public License
+#
+# Simulates CR1000-type data loggers (BMP5 nodes) on a local TCP port, so
+# clients can be tested and benchmarked without tying up a real data logger:
+#
+#   sim = pakbus_sim.Simulator(latency = 0.05)
+#   sim.add_node(0x001, [pakbus_sim.Table('Meteo', [('Batt', 'FP2'), ('AirTC', 'IEEE4B'), ('Soil', 'FP2', 4)], interval = 60)])
+#   host, port = sim.start()
+#
+# Each node answers hello, clock, get programming statistics, file upload
+# (including the .TDF and .DIR files), file download, file control, get values
+# and collect data commands (CollectMode 0x03 to 0x08; records that do not fit
+# into one packet are sent as fragments). Tables are generated from a
+# declarative definition (see Table).
+#
+# Any number of nodes can share one port (packets are routed by DstNodeId, as
+# behind a PakBus router) and any number of simulators can run in one process.
+# The simulated link has a latency, a bandwidth and a byte error rate, and
+# responses can be delayed with "please wait" messages.
+#
+
+
+#
+# Global imports
+#
+import heapq
+import math
+import random
+import re
+import socket
+import SocketServer
+import threading
+import time
+
+import pakbus
+
+
+#
+# Convert values to the form expected by pakbus.encode_bin() for a field type
+#
+raw_conversions = {
+    'FP2': pakbus.float_to_fp2,
+    'FP3': pakbus.float_to_fp3,
+    'FP4': pakbus.float_to_fp4,
+    'IEEE4B': float, 'IEEE4L': float, 'IEEE8B': float, 'IEEE8L': float,
+    'NSec': tuple, 'SecNano': tuple,
+}
+
+def raw_value(Type, value):
+    # Type:  data type name as defined in pakbus.datatype
+    # value: value as returned when decoding the field type
+
+    return raw_conversions.get(Type, int)(value)
+
+
+#
+# Simulated table
+#
+# Records are numbered from 0. Interval tables store a record every interval
+# (aligned to the interval) while the simulation runs; the values of a record
+# are generated when it is first requested and kept until the record is
+# overwritten in the ring buffer. Event-driven tables store records with
+# store().
+#
+class Table(object):
+
+    def __init__(self, TableName, fields, interval = 60, size = 1000, records = None, live = True):
+        # TableName: table name
+        # fields:    list of (FieldName, FieldType, Dimension, value) tuples;
+        #            Dimension (default 1) and value are optional. value is a
+        #            constant or a function(RecNbr, TimeOfRec) returning the
+        #            field value (a list for arrays, a string for ASCII fields);
+        #            without value, values are derived from the record number.
+        # interval:  record interval in seconds (0 for an event-driven table)
+        # size:      number of records held by the table (ring buffer)
+        # records:   number of records stored when the simulation starts
+        #            (default: size)
+        # live:      store a new record every interval (interval tables only,
+        #            otherwise records are stored with store())
+
+        self.TableName = TableName
+        self.size = size
+        self.interval = int(round(interval * 1e9))    # nanoseconds
+        self.live = live and self.interval > 0
+        self.lock = threading.Lock()
+
+        self.fields = []
+        for field in fields:
+            FieldName, FieldType = field[:2]
+            Dimension = len(field) > 2 and field[2] or 1
+            if not pakbus.datatype.has_key(FieldType) or FieldType in ('ASCIIZ', 'USec'):
+                raise StandardError('field type %s not supported in simulated tables' % FieldType)
+            if FieldType == 'ASCII':
+                codec = pakbus.get_codec([('ASCII', Dimension)])
+            else:
+                codec = pakbus.get_codec(Dimension * [FieldType])
+            self.fields.append({'FieldName': FieldName, 'FieldType': FieldType, 'Dimension': Dimension, 'value': len(field) > 3 and field[3] or None, 'codec': codec})
+
+        self.ring = size * [None]   # (RecNbr, TimeOfRec, values, encoded values) by RecNbr % size
+        if records is None:
+            records = size
+        now = self.now()
+        if self.interval:
+            # newest record at the last interval boundary
+            self.base = now - now % self.interval - (records - 1) * self.interval
+            self.count = records
+        else:
+            self.count = 0
+            for i in range(records):
+                self.store(now - (records - 1 - i) * 1000000000)
+
+    #
+    # Current time in nanoseconds since 1990
+    #
+    def now(self):
+        seconds, nanoseconds = pakbus.time_to_nsec(time.time())
+        return seconds * 1000000000 + nanoseconds
+
+    #
+    # Number of the newest record (-1 if the table is empty)
+    #
+    def newest(self):
+        if self.live:
+            return (self.now() - self.base) // self.interval
+        return self.count - 1
+
+    #
+    # Store a new record (event-driven tables or interval tables that are not live)
+    #
+    def store(self, TimeOfRec = None, values = None):
+        # TimeOfRec: time of the record in nanoseconds since 1990 (event-driven
+        #            tables, default: now)
+        # values:    list of field values (default: generated)
+
+        if self.live:
+            raise StandardError('records of table %s are stored automatically' % self.TableName)
+        self.lock.acquire()
+        try:
+            RecNbr = self.count
+            if self.interval:
+                TimeOfRec = self.base + RecNbr * self.interval
+            elif TimeOfRec is None:
+                TimeOfRec = self.now()
+            self.ring[RecNbr % self.size] = self.make_record(RecNbr, TimeOfRec, values)
+            self.count += 1
+        finally:
+            self.lock.release()
+        return RecNbr
+
+    #
+    # Generate values of a record and encode them
+    #
+    def make_record(self, RecNbr, TimeOfRec, values = None):
+        TimeOfRec = divmod(TimeOfRec, 1000000000)
+        if values is None:
+            values = []
+            for i in range(len(self.fields)):
+                fld = self.fields[i]
+                value = fld['value']
+                if value is None:
+                    value = self.default_value(fld, i, RecNbr)
+                elif callable(value):
+                    value = value(RecNbr, TimeOfRec)
+                values.append(value)
+
+        encoded = []
+        for fld, value in zip(self.fields, values):
+            if fld['FieldType'] == 'ASCII':
+                encoded.append(fld['codec'].encode([value[:fld['Dimension']].ljust(fld['Dimension'], '\0')]))
+            else:
+                if fld['Dimension'] == 1:
+                    value = [value]
+                encoded.append(fld['codec'].encode([raw_value(fld['FieldType'], v) for v in value]))
+        return RecNbr, TimeOfRec, values, encoded
+
+    #
+    # Default field values (a smooth signal shifted by the record number)
+    #
+    def default_value(self, fld, i, RecNbr):
+        if fld['FieldType'] == 'ASCII':
+            return '%s %d' % (fld['FieldName'], RecNbr)
+        values = []
+        for j in range(fld['Dimension']):
+            if fld['FieldType'] in ('FP2', 'FP3', 'FP4', 'IEEE4B', 'IEEE4L', 'IEEE8B', 'IEEE8L'):
+                values.append(round(20 + 10 * math.sin(0.1 * (RecNbr + j) + i), 2))
+            elif fld['FieldType'] in ('NSec', 'SecNano'):
+                values.append((RecNbr, 0))
+            elif fld['FieldType'].startswith('Bool'):
+                values.append((RecNbr + j) % 2)
+            else:
+                values.append((RecNbr + j) % 100)
+        if fld['Dimension'] == 1:
+            return values[0]
+        return values
+
+    #
+    # Get (RecNbr, TimeOfRec, values, encoded values) of a record (None if not available)
+    #
+    def record(self, RecNbr):
+        newest = self.newest()
+        if RecNbr < 0 or RecNbr > newest or RecNbr <= newest - self.size:
+            return None
+        self.lock.acquire()
+        try:
+            record = self.ring[RecNbr % self.size]
+            if (record is None or record[0] != RecNbr) and self.interval:
+                record = self.ring[RecNbr % self.size] = self.make_record(RecNbr, self.base + RecNbr * self.interval)
+        finally:
+            self.lock.release()
+        if record is None or record[0] != RecNbr:
+            return None
+        return record
+
+    #
+    # Binary table definition (as in the .TDF file)
+    #
+    def tabledef(self):
+        raw = pakbus.encode_bin(['ASCIIZ', 'UInt4', 'Byte', 'NSec', 'NSec'], [self.TableName, self.size, 0x0e, (0, 0), divmod(self.interval, 1000000000)])
+        for fld in self.fields:
+            if fld['FieldType'] in ('FP2', 'FP3', 'FP4', 'IEEE4B', 'IEEE4L', 'IEEE8B', 'IEEE8L'):
+                Processing = 'Smp'
+            else:
+                Processing = ''
+            raw += chr(pakbus.datatype[fld['FieldType']]['code'])
+            raw += pakbus.encode_bin(['ASCIIZ', 'ASCIIZ', 'ASCIIZ', 'ASCIIZ', 'ASCIIZ', 'UInt4', 'UInt4', 'UInt4'], [fld['FieldName'], '', Processing, '', '', 1, fld['Dimension'], 0])
+        return raw + '\0'
+
+    #
+    # Get range of record numbers [begin, end) for a collect data request
+    #
+    def select(self, CollectMode, P1, P2):
+        newest = self.newest()
+        oldest = max(newest - self.size + 1, 0)
+        if CollectMode == 0x03:     # all records
+            return oldest, newest + 1
+        elif CollectMode == 0x04:   # from record P1
+            return max(P1, oldest), newest + 1
+        elif CollectMode == 0x05:   # most recent P1 records
+            return max(newest - P1 + 1, oldest), newest + 1
+        elif CollectMode == 0x06:   # records P1 up to P2 (exclusive)
+            return max(P1, oldest), min(P2, newest + 1)
+        elif CollectMode == 0x07:   # time range P1 up to P2 (exclusive)
+            P1 = P1[0] * 1000000000 + P1[1]
+            P2 = P2[0] * 1000000000 + P2[1]
+            if self.interval:
+                return max(-((self.base - P1) // self.interval), oldest), min(-((self.base - P2) // self.interval), newest + 1)
+            selected = [r[0] for r in self.ring if r and r[0] >= oldest and P1 <= r[1][0] * 1000000000 + r[1][1] < P2]
+            if not selected:
+                return 0, 0
+            return min(selected), max(selected) + 1
+        return 0, 0
+
+    #
+    # Encode records for a collect data response
+    #
+    # Returns the record data (without the response code) and the
+    # MoreRecsExist flag. A record that does not fit into the packet on its own
+    # is sent as a fragment (a record image with NSec time stamp).
+    #
+    def collect(self, TableNbr, CollectMode, P1, P2, FieldNbr, space):
+        # TableNbr:    table number
+        # CollectMode: collection mode code (0x03 ... 0x08)
+        # P1, P2:      parameters of the collection mode
+        # FieldNbr:    list of field numbers (empty for all fields)
+        # space:       number of bytes available for the record data
+
+        FieldNbr = FieldNbr or range(1, len(self.fields) + 1)
+        if CollectMode == 0x08:     # fragment of record P1 from byte P2
+            return self.fragment(TableNbr, self.record(P1), FieldNbr, P2, space), False
+
+        begin, end = self.select(CollectMode, P1, P2)
+        if self.interval:
+            header = 16     # TableNbr, BegRecNbr, NbrOfRecs, TimeOfRec
+        else:
+            header = 8      # TableNbr, BegRecNbr, NbrOfRecs
+        data = []
+        size = header
+        RecNbr = begin
+        first = None
+        while RecNbr < end and RecNbr - begin < 0x7FFF:
+            record = self.record(RecNbr)
+            if record is None:      # overwritten meanwhile
+                break
+            image = ''.join([record[3][i - 1] for i in FieldNbr])
+            if not self.interval:
+                image = pakbus.encode_bin(['NSec'], [record[1]]) + image
+            if size + len(image) > space:
+                break
+            if first is None:
+                first = record
+            data.append(image)
+            size += len(image)
+            RecNbr += 1
+
+        if first is None:
+            if begin >= end:
+                return '', False
+            return self.fragment(TableNbr, self.record(begin), FieldNbr, 0, space), begin + 1 < end
+
+        if self.interval:
+            header = pakbus.encode_bin(['UInt2', 'UInt4', 'UInt2', 'NSec'], [TableNbr, begin, len(data), first[1]])
+        else:
+            header = pakbus.encode_bin(['UInt2', 'UInt4', 'UInt2'], [TableNbr, begin, len(data)])
+        return header + ''.join(data), RecNbr < end
+
+    #
+    # Encode fragment of a record starting at ByteOffset
+    #
+    def fragment(self, TableNbr, record, FieldNbr, ByteOffset, space):
+        if record is None:
+            return ''
+        image = pakbus.encode_bin(['NSec'], [record[1]]) + ''.join([record[3][i - 1] for i in FieldNbr])
+        return pakbus.encode_bin(['UInt2', 'UInt4', 'UInt4'], [TableNbr, record[0], 0x80000000 | ByteOffset]) + image[ByteOffset:ByteOffset + space - 10]
+
+    #
+    # Get values of a field in the newest record
+    #
+    def values(self, FieldName):
+        # FieldName: field name, optionally with index of the first value (e.g. 'Soil(2)')
+
+        match = re.match(r'^([^(]*)(?:\((\d+)\))?$', FieldName)
+        index = int(match.group(2) or 1) - 1
+        for i in range(len(self.fields)):
+            if self.fields[i]['FieldName'] == match.group(1):
+                record = self.record(self.newest())
+                if record is None:
+                    return None
+                value = record[2][i]
+                if self.fields[i]['FieldType'] == 'ASCII' or self.fields[i]['Dimension'] == 1:
+                    value = [value]
+                return value[index:]
+        return None
+
+
+#
+# Fixed-size fields following the response code of BMP5 responses
+#
+response_padding = {
+    0x17: 8 * '\0',    # Time
+    0x1c: 4 * '\0',    # FileOffset
+    0x1d: 4 * '\0',    # FileOffset
+    0x1e: 2 * '\0',    # HoldOff
+}
+
+
+#
+# Simulated data logger
+#
+class Node(object):
+
+    def __init__(self, NodeId, tables = [], files = {}, SecurityCode = 0x0000, SerialNbr = '1234', OSVer = 'CR1000.Std.32', ProgName = 'CPU:sim.cr1', packet_size = 1000, max_swath = pakbus.swath_max):
+        # NodeId:       PakBus node ID (12-bit int)
+        # tables:       list of Table objects (table numbers in list order)
+        # files:        dictionary of file names and contents (downloaded
+        #               files are stored in it)
+        # SecurityCode: 16-bit security code (0x0000: no security)
+        # SerialNbr:    serial number reported by get programming statistics
+        # OSVer:        operating system version
+        # ProgName:     name of the running program
+        # packet_size:  largest message received or sent [bytes] (longer
+        #               commands are dropped, responses are limited to it)
+        # max_swath:    largest amount of file data returned by one upload response
+
+        self.NodeId = NodeId
+        self.tables = tables
+        self.files = dict(files)
+        self.SecurityCode = SecurityCode
+        self.SerialNbr = SerialNbr
+        self.OSVer = OSVer
+        self.ProgName = ProgName
+        self.packet_size = packet_size
+        self.max_swath = max_swath
+        self.clock_offset = 0.0     # offset of the data logger clock [seconds]
+        self.lock = threading.Lock()
+        self.tdf = chr(1) + ''.join([table.tabledef() for table in tables])
+        self.TableDef = pakbus.parse_tabledef(self.tdf)
+        self.updated = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())
+
+    #
+    # Handle command message, return response message or None
+    #
+    def handle(self, HiProtoCode, msg):
+        # HiProtoCode: high level protocol code (0: PakCtrl, 1: BMP5)
+        # msg:         decoded message as returned by pakbus.decode_pkt()
+
+        raw = msg['raw']
+        if HiProtoCode == 0:
+            if msg['MsgType'] == 0x09:  # hello
+                return pakbus.encode_bin(['Byte', 'Byte', 'Byte', 'Byte', 'UInt2'], [0x89, msg['TranNbr'], 0x00, 0x02, 1800])
+            return None
+
+        try:
+            handler = {
+                0x09: self.collectdata,
+                0x17: self.clock,
+                0x18: self.getprogstat,
+                0x1a: self.getvalues,
+                0x1c: self.filedownload,
+                0x1d: self.fileupload,
+                0x1e: self.filecontrol,
+            }[msg['MsgType']]
+        except KeyError:
+            return None
+        [SecurityCode], size = pakbus.decode_bin(['UInt2'], raw, offset = 2)
+        if self.SecurityCode and SecurityCode != self.SecurityCode:
+            # permission denied (followed by the fixed-size fields of the response)
+            return pakbus.encode_bin(['Byte', 'Byte', 'Byte'], [msg['MsgType'] | 0x80, msg['TranNbr'], 0x01]) + response_padding.get(msg['MsgType'], '')
+
+        self.lock.acquire()
+        try:
+            return pakbus.encode_bin(['Byte', 'Byte'], [msg['MsgType'] | 0x80, msg['TranNbr']]) + handler(raw)
+        finally:
+            self.lock.release()
+
+    def collectdata(self, raw):
+        [CollectMode, TableNbr, TableDefSig], size = pakbus.decode_bin(['Byte', 'UInt2', 'UInt2'], raw, offset = 4)
+        offset = 4 + size
+        P1 = P2 = 0
+        if CollectMode in (0x04, 0x05):
+            [P1], size = pakbus.decode_bin(['UInt4'], raw, offset = offset)
+        elif CollectMode in (0x06, 0x08):
+            [P1, P2], size = pakbus.decode_bin(['UInt4', 'UInt4'], raw, offset = offset)
+        elif CollectMode == 0x07:
+            [P1, P2], size = pakbus.decode_bin(['NSec', 'NSec'], raw, offset = offset)
+        else:
+            size = 0
+        offset += size
+        FieldNbr = []
+        while True:
+            [field], size = pakbus.decode_bin(['UInt2'], raw, offset = offset)
+            offset += size
+            if field == 0:
+                break
+            FieldNbr.append(field)
+
+        if not 1 <= TableNbr <= len(self.tables) or TableDefSig != self.TableDef[TableNbr - 1]['Signature'] or CollectMode not in range(0x03, 0x09):
+            return chr(0x07)    # invalid table definition
+        table = self.tables[TableNbr - 1]
+        if [field for field in FieldNbr if field > len(table.fields)]:
+            return chr(0x07)
+        data, MoreRecsExist = table.collect(TableNbr, CollectMode, P1, P2, FieldNbr, self.packet_size - 4)
+        return chr(0x00) + data + chr(MoreRecsExist and 1 or 0)
+
+    def clock(self, raw):
+        [Adjustment], size = pakbus.decode_bin(['NSec'], raw, offset = 4)
+        Time = pakbus.time_to_nsec(time.time() + self.clock_offset)
+        self.clock_offset += Adjustment[0] + Adjustment[1] * 1e-9
+        return pakbus.encode_bin(['Byte', 'NSec'], [0x00, Time])
+
+    def getprogstat(self, raw):
+        ProgSig = pakbus.calcSigFor(self.files.get(self.ProgName, self.tdf))
+        return pakbus.encode_bin(['Byte', 'ASCIIZ', 'UInt2', 'ASCIIZ', 'ASCIIZ', 'Byte', 'ASCIIZ', 'UInt2', 'NSec', 'ASCIIZ'],
+            [0x00, self.OSVer, 0x1234, self.SerialNbr, self.ProgName, self.ProgName and 1 or 0, self.ProgName, ProgSig, pakbus.time_to_nsec(time.time()), self.ProgName and 'Program running' or ''])
+
+    def getvalues(self, raw):
+        [TableName, TypeCode, FieldName, Swath], size = pakbus.decode_bin(['ASCIIZ', 'Byte', 'ASCIIZ', 'UInt2'], raw, offset = 4)
+        for Type in pakbus.datatype.keys():
+            if pakbus.datatype[Type]['code'] == TypeCode and Type not in ('ASCII', 'ASCIIZ', 'USec'):
+                break
+        else:
+            return chr(0x08)    # data type conversion not supported
+        values = None
+        for table in self.tables:
+            if table.TableName == TableName:
+                values = table.values(FieldName)
+        if not values or len(values) < Swath:
+            return chr(0x07)    # invalid table or field name
+        return chr(0x00) + pakbus.encode_bin(Swath * [Type], [raw_value(Type, value) for value in values[:Swath]])
+
+    def fileupload(self, raw):
+        [FileName, CloseFlag, FileOffset, Swath], size = pakbus.decode_bin(['ASCIIZ', 'Byte', 'UInt4', 'UInt2'], raw, offset = 4)
+        if FileName == '.TDF':
+            FileData = self.tdf
+        elif FileName == '.DIR':
+            FileData = self.filedir()
+        elif self.files.has_key(FileName):
+            FileData = self.files[FileName]
+        else:
+            return chr(0x0d)    # invalid file name
+        Swath = min(Swath, self.max_swath, self.packet_size - 7)   # MsgType, TranNbr, RespCode, FileOffset
+        return pakbus.encode_bin(['Byte', 'UInt4'], [0x00, FileOffset]) + str(FileData[FileOffset:FileOffset + Swath])
+
+    def filedownload(self, raw):
+        [FileName, Attribute, CloseFlag, FileOffset], size = pakbus.decode_bin(['ASCIIZ', 'Byte', 'Byte', 'UInt4'], raw, offset = 4)
+        FileData = raw[4 + size:]
+        if FileOffset == 0 or not self.files.has_key(FileName):
+            self.files[FileName] = bytearray()
+        image = self.files[FileName]
+        if not isinstance(image, bytearray):
+            image = self.files[FileName] = bytearray(image)
+        if FileOffset > len(image):
+            return pakbus.encode_bin(['Byte', 'UInt4'], [0x09, FileOffset])    # invalid fragment (offset)
+        image[FileOffset:FileOffset + len(FileData)] = FileData
+        self.updated = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())
+        return pakbus.encode_bin(['Byte', 'UInt4'], [0x00, FileOffset])
+
+    def filecontrol(self, raw):
+        [FileName, FileCmd], size = pakbus.decode_bin(['ASCIIZ', 'Byte'], raw, offset = 4)
+        if FileCmd in (1, 2, 6, 13):        # compile and run
+            if not self.files.has_key(FileName):
+                return pakbus.encode_bin(['Byte', 'UInt2'], [0x0d, 0])
+            self.ProgName = FileName
+        elif FileCmd in (7, 8):             # stop program (and delete files)
+            if FileCmd == 8 and self.ProgName:
+                self.files.pop(self.ProgName, None)
+            self.ProgName = ''
+        elif FileCmd == 4:                  # delete file
+            if not self.files.has_key(FileName):
+                return pakbus.encode_bin(['Byte', 'UInt2'], [0x0d, 0])
+            del self.files[FileName]
+            if FileName == self.ProgName:
+                self.ProgName = ''
+        return pakbus.encode_bin(['Byte', 'UInt2'], [0x00, 0])
+
+    #
+    # File directory (see pakbus.parse_filedir())
+    #
+    def filedir(self):
+        raw = chr(1)
+        for FileName in sorted(self.files.keys()):
+            Attribute = []
+            if FileName == self.ProgName:
+                Attribute = [1, 2]  # running now, run on power up
+            raw += pakbus.encode_bin(['ASCIIZ', 'UInt4', 'ASCIIZ'], [FileName, len(self.files[FileName]), self.updated]) + ''.join(map(chr, Attribute)) + '\0'
+        return raw + '\0'
+
+
+#
+# Simulated link: drops commands, delays and drops responses (one sender thread per connection)
+#
+class Link(object):
+
+    def __init__(self, s, latency, bandwidth, ber):
+        # s:         socket object
+        # latency:   delay of each response [seconds]
+        # bandwidth: link bandwidth [bytes per second] (None: unlimited)
+        # ber:       probability that a byte is corrupted on the link (a
+        #            command or response is lost if any of its bytes is
+        #            corrupted)
+
+        self.s = s
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.ber = ber
+        self.busy = 0.0     # link is occupied until this time
+        self.arrived = 0.0  # arrival time of the last command
+        self.queue = []     # heap of (due time, sequence number, packet)
+        self.sequence = 0
+        self.closed = False
+        self.cond = threading.Condition()
+        t = threading.Thread(target = self.run)
+        t.setDaemon(True)
+        t.start()
+
+    #
+    # Occupy link for transmission of n bytes starting at the given time
+    #
+    def transmit(self, start, n):
+        if not self.bandwidth:
+            return start
+        self.busy = max(self.busy, start) + n / float(self.bandwidth)
+        return self.busy
+
+    #
+    # Packet of n bytes corrupted on the link?
+    #
+    def corrupted(self, n):
+        return self.ber and random.random() >= (1 - self.ber) ** n
+
+    #
+    # Receive command, return False if it was corrupted on the way (the data
+    # logger never sees it)
+    #
+    def receive(self, command):
+        # command: command packet
+        self.cond.acquire()
+        try:
+            self.arrived = self.transmit(time.time(), len(command))
+        finally:
+            self.cond.release()
+        return not self.corrupted(len(command))
+
+    #
+    # Queue response to the last command (optionally preceded by a notice, e.g. "please wait")
+    #
+    def send(self, reply, delay = 0.0, notice = None):
+        # reply:   response packet
+        # delay:   additional delay of the response [seconds]
+        # notice:  packet sent without the additional delay
+
+        self.cond.acquire()
+        try:
+            for due, pkt in ((0.0, notice), (delay, reply)):
+                if pkt and not self.corrupted(len(pkt)):
+                    self.sequence += 1
+                    heapq.heappush(self.queue, (self.transmit(self.arrived + self.latency + due, len(pkt)), self.sequence, pkt))
+            self.cond.notify()
+        finally:
+            self.cond.release()
+
+    def run(self):
+        while True:
+            self.cond.acquire()
+            try:
+                while not self.closed and (not self.queue or self.queue[0][0] > time.time()):
+                    if self.queue:
+                        self.cond.wait(self.queue[0][0] - time.time())
+                    else:
+                        self.cond.wait()
+                if self.closed:
+                    return
+                due, sequence, pkt = heapq.heappop(self.queue)
+            finally:
+                self.cond.release()
+            try:
+                pakbus.send(self.s, pkt)
+            except socket.error:
+                return
+
+    def close(self):
+        self.cond.acquire()
+        self.closed = True
+        self.cond.notify()
+        self.cond.release()
+
+
+class Handler(SocketServer.BaseRequestHandler):
+
+    def handle(self):
+        server = self.server
+        link = Link(self.request, server.latency, server.bandwidth, server.ber)
+        try:
+            while True:
+                try:
+                    rcv = pakbus.recv(self.request)
+                except socket.error:
+                    return
+                if not link.receive(rcv):
+                    continue    # command lost
+                hdr, msg = pakbus.decode_pkt(rcv)
+                node = server.nodes.get(hdr['DstNodeId'])
+                if node is None or msg['MsgType'] is None:
+                    continue
+                if len(msg['raw']) > node.packet_size:
+                    continue    # too long for the receive buffer of the data logger
+                reply = node.handle(hdr['HiProtoCode'], msg)
+                if reply is None:
+                    continue
+                reply = pakbus.PakBus_hdr(hdr['SrcNodeId'], hdr['DstNodeId'], hdr['HiProtoCode']) + reply
+                if hdr['HiProtoCode'] == 1 and server.please_wait and random.random() < server.please_wait:
+                    notice = pakbus.pkt_pleasewait(hdr['SrcNodeId'], hdr['DstNodeId'], msg['TranNbr'], msg['MsgType'], int(math.ceil(server.wait)))
+                    link.send(reply, server.wait, notice)
+                else:
+                    link.send(reply)
+        finally:
+            link.close()
+
+
+#
+# Simulator: TCP server for a group of simulated data loggers
+#
+class Simulator(SocketServer.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 512
+
+    def __init__(self, address = ('127.0.0.1', 0), latency = 0.0, bandwidth = None, ber = 0.0, please_wait = 0.0, wait = 1.0):
+        # address:     (host, port) to listen on (port 0: any free port)
+        # latency:     delay of each response [seconds]
+        # bandwidth:   link bandwidth [bytes per second] (None: unlimited)
+        # ber:         probability that a byte is corrupted on the link
+        # please_wait: probability that a BMP5 command is answered with a
+        #              "please wait" message first
+        # wait:        delay of responses after a "please wait" message [seconds]
+
+        SocketServer.ThreadingTCPServer.__init__(self, address, Handler)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.ber = ber
+        self.please_wait = please_wait
+        self.wait = wait
+        self.nodes = {}     # NodeId -> Node
+
+    #
+    # Add simulated data logger (arguments as for Node), return the Node object
+    #
+    def add_node(self, NodeId, tables = [], **options):
+        self.nodes[NodeId] = Node(NodeId, tables, **options)
+        return self.nodes[NodeId]
+
+    #
+    # Serve in a background thread, return (host, port)
+    #
+    def start(self):
+        t = threading.Thread(target = self.serve_forever)
+        t.setDaemon(True)
+        t.start()
+        return self.server_address
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def handle_error(self, request, client_address):
+        pass    # connections are simply dropped at interpreter shutdown
+
+    def shutdown_request(self, request):
+        try:
+            SocketServer.ThreadingTCPServer.shutdown_request(self, request)
+        except:
+            pass    # module globals may already be gone at interpreter shutdown
+
+
+#
+# Start a simulator for each of count data loggers, return list of (host, port, NodeId)
+#
+def start_fleet(count, tables, nodes_per_port = 1, files = {}, **options):
+    # count:          number of simulated data loggers
+    # tables:         function(i) returning the list of Table objects of the
+    #                 i-th data logger
+    # nodes_per_port: number of data loggers sharing one port (node IDs 1, 2, ...)
+    # files:          files stored on each data logger (see Node)
+    # options:        Simulator options (latency, bandwidth, ...)
+
+    loggers = []
+    sim = None
+    for i in range(count):
+        if i % nodes_per_port == 0:
+            sim = Simulator(**options)
+            host, port = sim.start()
+        NodeId = i % nodes_per_port + 1
+        sim.add_node(NodeId, tables(i), files = files)
+        loggers.append((host, port, NodeId))
+    return loggers
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+#
+# Tests for pakbus.TableDefCache with the data logger simulator
+#
+
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python'))
+import pakbus
+import pakbus_sim
+
+
+class TableDefCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        # .TDF file spread over many packets
+        fields = [('Value%d' % i, 'IEEE4B') for i in range(40)]
+        self.sim = pakbus_sim.Simulator()
+        self.node = self.sim.add_node(0x001, [pakbus_sim.Table('Meteo', fields, interval = 60)], max_swath = 64)
+        host, port = self.sim.start()
+        self.s = pakbus.open_socket(host, port, 10)
+        self.directory = tempfile.mkdtemp()
+        self.cache = pakbus.TableDefCache(self.directory)
+
+    def tearDown(self):
+        self.s.close()
+        self.sim.stop()
+        shutil.rmtree(self.directory)
+
+    #
+    # Let the data logger answer upload commands for the .TDF file after the
+    # first count swaths with RespCode
+    #
+    def fail_upload(self, count, RespCode):
+        fileupload = self.node.fileupload
+        calls = []
+        def failing(raw):
+            calls.append(raw)
+            if len(calls) > count:
+                [FileOffset], size = pakbus.decode_bin(['UInt4'], raw, offset = 4 + len('.TDF') + 2)
+                return pakbus.encode_bin(['Byte', 'UInt4'], [RespCode, FileOffset])
+            return fileupload(raw)
+        self.node.fileupload = failing
+
+    def test_complete_upload(self):
+        tabledef = self.cache.get(self.s, 0x001, 0x802)
+        self.assertEqual(tabledef, pakbus.parse_tabledef(self.node.tdf))
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+
+    def test_failed_upload_not_cached(self):
+        self.fail_upload(3, 0x01)
+        self.assertRaises(StandardError, self.cache.get, self.s, 0x001, 0x802)
+        self.assertEqual(os.listdir(self.directory), [])
+        self.assertEqual(self.cache.memory, {})
+
+        # the next attempt uploads and stores the complete file
+        del self.node.fileupload
+        tabledef = self.cache.get(self.s, 0x001, 0x802)
+        self.assertEqual(tabledef, pakbus.parse_tabledef(self.node.tdf))
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()